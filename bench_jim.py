@@ -0,0 +1,59 @@
+import json
+import timeit
+import argparse
+
+import settings as sett
+import jim
+
+
+def bench(cases: dict, number: int) -> dict:
+    """
+    Time the cases
+    :param cases: dictionary of (current path, optimized path) callable pairs with case names as keys
+    :param number: number of calls of every callable
+    :return: dictionary of (current, optimized) seconds per call pairs with case names as keys
+    """
+    return {name: tuple(timeit.timeit(path, number=number) / number for path in paths)
+            for name, paths in cases.items()}
+
+
+def bench_responses(number: int) -> dict:
+    """ Compare encoding of the standard responses: building Response objects vs pre-encoded templates """
+    return bench({
+        "OK": (lambda: jim.Response(**jim.Responses.OK.response).json.encode(sett.DEFAULT_ENCODING),
+               lambda: jim.encode_response(jim.Responses.OK)),
+        "BAD_REQUEST": (lambda: jim.Response(**jim.Responses.BAD_REQUEST.response).json.encode(sett.DEFAULT_ENCODING),
+                        lambda: jim.encode_response(jim.Responses.BAD_REQUEST)),
+    }, number)
+
+
+def bench_codec(number: int) -> dict:
+    """ Compare message codec paths: str-based standard JSON vs bytes-native JSON backend """
+    message_bytes = jim.Message(jim.Actions.MESSAGE, to="all", **{"from": "test"},
+                                message="Тестовое сообщение").json.encode(sett.DEFAULT_ENCODING)
+    return bench({
+        "decode": (lambda: jim.Message.from_dict(json.loads(message_bytes.decode(sett.DEFAULT_ENCODING))),
+                   lambda: jim.Message.from_bytes(message_bytes)),
+        "decode + encode": (lambda: jim.Message.from_dict(json.loads(message_bytes.decode(
+                                sett.DEFAULT_ENCODING))).json.encode(sett.DEFAULT_ENCODING),
+                            lambda: jim.Message.from_bytes(message_bytes).encoded),
+    }, number)
+
+
+def report(title: str, results: dict):
+    print(title)
+    for name, (current, optimized) in results.items():
+        print("  {:<20} {:>10.0f} ns -> {:>10.0f} ns  x{:.1f}".format(
+            name, current * 1e9, optimized * 1e9, current / optimized))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JIM codec microbenchmarks")
+    parser.add_argument('-number', required=False, type=int, default=100000)
+    args = parser.parse_args()
+    report("Responses (Response(...).json -> encode_response):", bench_responses(args.number))
+    report("Codec (str, json -> bytes, {}):".format(jim.JSON_BACKEND), bench_codec(args.number))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import gc
+import argparse
+import tracemalloc
+
+import jim
+import routing
+import registry
+import metrics
+import server_select
+import server_threads
+import server_asyncio
+
+"""
+Memory footprint of the per-connection state and the messages in flight, measured with tracemalloc:
+Python objects only - the kernel socket buffers and the transport/selector bookkeeping come on top.
+An idle connection is one that has introduced itself with PRESENCE and is waiting for data.
+"""
+
+PRESENCE_FRAME = jim.encode_frame(jim.Message(jim.Actions.PRESENCE, type="status", framing="length",
+                                              user={"account_name": "idle", "status": "Online"}).encoded)
+
+
+def measure(make, count: int) -> float:
+    """
+    :param make: callable making one object, called with its number
+    :return: bytes allocated per object, the objects being kept alive
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [make(number) for number in range(count)]
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del objects
+    return allocated / count
+
+
+def introduce(connection):
+    for _ in connection.chat.process_data(PRESENCE_FRAME):
+        pass
+    return connection
+
+
+def idle_connections(count: int) -> dict:
+    """ Bytes per idle connection of every server engine """
+    server_metrics = metrics.Metrics()
+    connections = registry.ConnectionRegistry(routing.Router())
+    return {
+        "select": measure(lambda number: introduce(server_select.Connection(jim.Chat(), None, ("127.0.0.1", number))),
+                          count),
+        "threads": measure(lambda number: introduce(server_threads.Connection(
+            None, ("127.0.0.1", number), None, connections, None, server_metrics=server_metrics)), count),
+        "asyncio": measure(lambda number: introduce(server_asyncio.Connection(
+            set(), connections.router, server_metrics=server_metrics)), count),
+    }
+
+
+def messages_in_flight(count: int) -> dict:
+    """ Bytes per chat message: decoded as the client queues it and as received, the way the server queues it """
+    def payload(number: int) -> bytes:
+        return jim.Message(jim.Actions.MESSAGE, to="bob", message="Сообщение {}".format(number),
+                           id=number, **{"from": "alice"}).encoded
+
+    def received(number: int) -> bytes:
+        decoder = jim.FrameDecoder(jim.Framing.LENGTH)
+        decoder.feed(jim.encode_frame(payload(number), jim.Framing.LENGTH))
+        return decoder.next_frame()
+
+    return {
+        "Message": measure(lambda number: jim.Message.from_bytes(payload(number)), count),
+        "encoded": measure(received, count),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JIM server memory footprint")
+    parser.add_argument('-counts', default="10000,100000", help="numbers of objects to measure at: n,n,...")
+    args = parser.parse_args()
+    for count in (int(count) for count in args.counts.split(",")):
+        print("{} объектов, байт на объект:".format(count))
+        for title, results in (("Соединение без нагрузки", idle_connections(count)),
+                               ("Сообщение в обработке", messages_in_flight(count))):
+            print("  {:<24} {}".format(title, ", ".join("{} {:.0f}".format(name, value)
+                                                      for name, value in results.items())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import enum
+import socket
+
+import settings as sett
+
+
+class OverflowPolicy(str, enum.Enum):
+    DROP = "drop"                   # drop data that would take the buffer above the high watermark
+    DISCONNECT = "disconnect"       # disconnect the consumer once the buffer is above the high watermark
+    PAUSE = "pause"                 # stop reading from the consumer until its buffer drains to the low watermark
+
+
+class OutputBuffer:
+    """
+    Per-connection output buffer with watermarks. Above the high watermark the consumer is too slow
+    and the overflow policy applies; at or below the low watermark it has caught up.
+    Whatever the policy, the buffer never grows beyond the hard limit.
+    ATTRIBUTES:
+    policy - overflow policy
+    high_watermark - buffer size the consumer is considered slow above
+    low_watermark - buffer size the consumer is considered to have caught up at
+    hard_limit - maximum buffer size
+    queued_bytes - number of bytes ever queued
+    sent_bytes - number of bytes ever sent
+    dropped_bytes - number of bytes dropped by the DROP policy
+    """
+    __slots__ = ("policy", "high_watermark", "low_watermark", "hard_limit", "queued_bytes", "sent_bytes",
+                 "dropped_bytes", "_buffer")
+
+    def __init__(self, policy: OverflowPolicy = None, high_watermark: int = None, low_watermark: int = None,
+                 hard_limit: int = None):
+        """
+        If any of the parameters are not specified, defaults are used.
+        """
+        self.policy = OverflowPolicy(policy if policy else sett.SERVER_OUTPUT_POLICY)
+        self.high_watermark = high_watermark if high_watermark else sett.SERVER_OUTPUT_HIGH_WATERMARK
+        self.low_watermark = low_watermark if low_watermark is not None else sett.SERVER_OUTPUT_LOW_WATERMARK
+        self.hard_limit = hard_limit if hard_limit else sett.SERVER_OUTPUT_HARD_LIMIT
+        self.queued_bytes = 0
+        self.sent_bytes = 0
+        self.dropped_bytes = 0
+        self._buffer = bytearray()
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    @property
+    def full(self) -> bool:
+        """ True if the buffer is above the high watermark """
+        return len(self._buffer) > self.high_watermark
+
+    @property
+    def drained(self) -> bool:
+        """ True if the buffer is at or below the low watermark """
+        return len(self._buffer) <= self.low_watermark
+
+    def put(self, data: bytes, droppable: bool = True) -> bool:
+        """
+        Queue the data according to the overflow policy
+        :param droppable: False for the data that can't be dropped on its own, e.g. frames of a compressed stream -
+        the DROP policy queues it up to the hard limit then, see drops()
+        :return: True if the data is queued or dropped, False if the consumer is to be disconnected
+        """
+        size = len(self._buffer) + len(data)
+        if size > self.high_watermark:
+            if self.policy == OverflowPolicy.DROP and droppable:
+                self.dropped_bytes += len(data)
+                return True
+            if self.policy == OverflowPolicy.DISCONNECT or size > self.hard_limit:
+                return False
+        self._buffer += data
+        self.queued_bytes += len(data)
+        return True
+
+    def drops(self, data: bytes) -> bool:
+        """
+        Drop the data for a slow consumer before it is made into what put() can't drop, e.g. before it is compressed:
+        the DROP policy drops such data once the buffer is above the high watermark
+        :return: True if the data is dropped
+        """
+        if self.policy == OverflowPolicy.DROP and self.full:
+            self.dropped_bytes += len(data)
+            return True
+        return False
+
+    def send_to(self, connection: socket.socket, flags: int = 0) -> int:
+        """
+        Send as much of the buffered data as the socket takes
+        :return: number of bytes sent
+        :raises OSError: if sending failed, BlockingIOError if the socket took nothing
+        """
+        sent = connection.send(self._buffer, flags)
+        del self._buffer[:sent]
+        self.sent_bytes += sent
+        return sent
+
+    def clear(self):
+        """ Drop the buffered data, e.g. when the connection is closed """
+        self._buffer.clear()
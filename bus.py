@@ -0,0 +1,250 @@
+import asyncio
+import logging
+
+import settings as sett
+import jim
+import routing
+
+"""
+Inter-process bus of the multi-process server (see launcher.py).
+The launcher runs the hub on a Unix socket, every worker process connects to it with a BusClient.
+The hub is the authority on which worker every account is connected to: workers report the accounts
+registered and unregistered by their clients, the hub arbitrates concurrent registrations of the same account
+and replicates the bindings to the other workers, so that every worker knows all the accounts of the server.
+Messages for accounts connected to other workers and broadcasts are relayed by the hub.
+
+The bus uses LENGTH framing; the first byte of a frame is its kind, the rest is its body:
+worker -> hub:
+    R<account>                  account registered by a client of the worker
+    U<account>                  account unregistered
+    D<account>\\n<message>       deliver the message to the account connected to another worker
+    B<message>                  deliver the message to the clients of all the other workers
+hub -> worker:
+    +<account>                  account is connected to another worker
+    -<account>                  account is no longer connected to another worker
+    !<account>                  account registered by the worker has been registered by another worker first
+    D<account>\\n<message>       deliver the message to the account connected to the worker
+    B<message>                  deliver the message to all the clients of the worker
+"""
+
+REGISTER = b"R"
+UNREGISTER = b"U"
+DELIVER = b"D"
+BROADCAST = b"B"
+BOUND = b"+"
+UNBOUND = b"-"
+CONFLICT = b"!"
+SEPARATOR = b"\n"
+BUS_MAX_FRAME_LEN = 2 * sett.MAX_FRAME_LEN      # Bus frames carry a JIM message along with the account name
+
+log = logging.getLogger(sett.SERVER_LOG_NAME)
+
+
+def bus_frame(kind: bytes, account_name: str = None, message: bytes = None) -> bytes:
+    """ Build a bus frame of the kind for the account and/or the message """
+    body = kind
+    if account_name is not None:
+        body += account_name.encode(sett.DEFAULT_ENCODING)
+        if message is not None:
+            body += SEPARATOR
+    if message is not None:
+        body += message
+    return jim.encode_frame(body, jim.Framing.LENGTH)
+
+
+def parse_bus_frame(frame: bytes) -> (bytes, str | None, bytes | None):
+    """
+    Parse a bus frame
+    :return: frame kind, account name or None, message or None
+    """
+    kind, body = frame[:1], frame[1:]
+    if kind == BROADCAST:
+        return kind, None, body
+    if kind == DELIVER:
+        account_name, _, message = body.partition(SEPARATOR)
+        return kind, account_name.decode(sett.DEFAULT_ENCODING), message
+    return kind, body.decode(sett.DEFAULT_ENCODING), None
+
+
+class BusProtocol(asyncio.Protocol):
+    """
+    Framed bus connection; frames received are passed to the handler
+    ATTRIBUTES:
+    handler - function called with every frame received and the protocol
+    opened - function called with the protocol when the connection is established
+    closed - function called with the protocol when the connection is lost
+    transport - connection transport
+    decoder - frame decoder
+    """
+    def __init__(self, handler, opened=None, closed=None):
+        self.handler = handler
+        self.opened = opened
+        self.closed = closed
+        self.transport = None
+        self.decoder = jim.FrameDecoder(jim.Framing.LENGTH, BUS_MAX_FRAME_LEN)
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        if self.opened:
+            self.opened(self)
+
+    def connection_lost(self, exc: Exception | None):
+        if self.closed:
+            self.closed(self)
+
+    def data_received(self, data: bytes):
+        self.decoder.feed(data)
+        for frame in self.decoder:
+            self.handler(frame, self)
+
+    def send(self, frame: bytes):
+        if not self.transport.is_closing():
+            self.transport.write(frame)
+
+
+class BusHub:
+    """
+    Bus hub run by the launcher
+    ATTRIBUTES:
+    path - Unix socket path the workers connect to
+    workers - worker connections
+    accounts - worker connections dictionary with account names as keys
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.workers = set()
+        self.accounts = {}
+
+    async def start(self) -> asyncio.AbstractServer:
+        """ Start accepting the workers """
+        return await asyncio.get_running_loop().create_unix_server(
+            lambda: BusProtocol(self._handle, self._worker_added, self._worker_lost), self.path)
+
+    def _others(self, worker: BusProtocol):
+        return (other for other in self.workers if other is not worker)
+
+    def _worker_added(self, worker: BusProtocol):
+        """ Tell the new worker about the accounts connected """
+        self.workers.add(worker)
+        for account_name in self.accounts:
+            worker.send(bus_frame(BOUND, account_name))
+
+    def _handle(self, frame: bytes, worker: BusProtocol):
+        kind, account_name, message = parse_bus_frame(frame)
+        if kind == REGISTER:
+            owner = self.accounts.get(account_name)
+            if owner is not None and owner is not worker:
+                log.warning("Шина: учетная запись %s уже подключена к другому процессу.", account_name)
+                worker.send(bus_frame(CONFLICT, account_name))
+            elif owner is None:
+                self.accounts[account_name] = worker
+                for other in self._others(worker):
+                    other.send(bus_frame(BOUND, account_name))
+        elif kind == UNREGISTER:
+            if self.accounts.get(account_name) is worker:
+                self._unbind(account_name, worker)
+        elif kind == DELIVER:
+            owner = self.accounts.get(account_name)
+            if owner is None:                           # Disconnected while the message was on its way
+                log.info("Шина: адресат %s недоступен.", account_name)
+            else:
+                owner.send(jim.encode_frame(frame, jim.Framing.LENGTH))
+        elif kind == BROADCAST:
+            for other in self._others(worker):
+                other.send(jim.encode_frame(frame, jim.Framing.LENGTH))
+        else:
+            log.error("Шина: неизвестный кадр %s.", frame[:1])
+
+    def _unbind(self, account_name: str, worker: BusProtocol):
+        del self.accounts[account_name]
+        for other in self._others(worker):
+            other.send(bus_frame(UNBOUND, account_name))
+
+    def _worker_lost(self, worker: BusProtocol):
+        """ Forget the accounts of the worker that has exited """
+        self.workers.discard(worker)
+        for account_name in [name for name, owner in self.accounts.items() if owner is worker]:
+            self._unbind(account_name, worker)
+
+
+class RemoteAccount:
+    """
+    Account connected to another worker - messages are delivered to it through the bus
+    ATTRIBUTES:
+    account_name - account name
+    bus - bus client of the worker
+    """
+    def __init__(self, account_name: str, bus: "BusClient"):
+        self.account_name = account_name
+        self.bus = bus
+
+    def deliver(self, message: bytes):
+        self.bus.send(bus_frame(DELIVER, self.account_name, message))
+
+
+class ClusterRouter(routing.RemoteRouter):
+    """
+    Account index of a worker - knows the accounts connected to the other workers and reports
+    the accounts of its own clients to the hub.
+    Replication is asynchronous: a concurrent registration of the same account by two workers is resolved
+    by the hub afterwards, and an account is found by other workers once its binding reaches them.
+    ATTRIBUTES:
+    bus - bus client of the worker
+    """
+    def __init__(self, bus: "BusClient"):
+        super().__init__()
+        self.bus = bus
+
+    def account_added(self, account_name: str):
+        self.bus.send(bus_frame(REGISTER, account_name))
+
+    def account_removed(self, account_name: str):
+        self.bus.send(bus_frame(UNREGISTER, account_name))
+
+
+class BusClient:
+    """
+    Bus connection of a worker
+    ATTRIBUTES:
+    path - hub Unix socket path
+    router - account index of the worker, kept up to date with the bindings received from the hub
+    connections - connections of the worker to deliver broadcasts to
+    protocol - bus connection protocol
+    """
+    def __init__(self, path: str, connections: set):
+        self.path = path
+        self.connections = connections
+        self.router = ClusterRouter(self)
+        self.protocol = None
+
+    async def start(self):
+        _, self.protocol = await asyncio.get_running_loop().create_unix_connection(
+            lambda: BusProtocol(self._handle, closed=self._lost), self.path)
+
+    def send(self, frame: bytes):
+        self.protocol.send(frame)
+
+    def broadcast(self, message: bytes):
+        """ Deliver the message to the clients of all the other workers """
+        self.send(bus_frame(BROADCAST, message=message))
+
+    def _handle(self, frame: bytes, protocol: BusProtocol):
+        kind, account_name, message = parse_bus_frame(frame)
+        if kind == BOUND:
+            self.router.bind_remote(account_name, RemoteAccount(account_name, self))
+        elif kind == UNBOUND:
+            self.router.unbind_remote(account_name)
+        elif kind == CONFLICT:
+            connection = self.router.drop_local(account_name)
+            if connection is not None:
+                connection.disconnect(jim.Responses.CONFLICT)
+        elif kind == DELIVER:
+            connection = self.router.local(account_name)
+            if connection is not None:
+                connection.deliver(message)
+        elif kind == BROADCAST:
+            for connection in self.connections:
+                connection.deliver(message, shared=True)
+
+    def _lost(self, protocol: BusProtocol):
+        log.critical("Шина: соединение с процессом запуска потеряно.")
@@ -0,0 +1,230 @@
+import socket
+import asyncio
+import logging
+import itertools
+
+import settings as sett
+import jim
+
+"""
+Asyncio JIM client library for the console client, bots and load tests.
+Every frame from the server carrying "response" answers a request of the client, any other one is a message
+pushed by the server - a chat message from another client or PROBE. Every request is sent with a request id
+the server echoes in the response, so up to a window of requests may be outstanding at once:
+    client = AsyncClient("alice")
+    await client.connect()
+    responses = await asyncio.gather(*(client.send_message("bob", text) for text in texts))
+    async for message in client:
+        print(message.kwargs["message"])
+PROBE is answered with PRESENCE by the client itself. A response without an id is taken for the response
+to the oldest request outstanding. The client may request the binary wire format and the compression at PRESENCE
+(see jim.py); the payloads received are decoded whatever format they are in.
+"""
+
+log = logging.getLogger(sett.CLIENT_LOG_NAME)
+
+
+class AsyncClient:
+    """
+    ATTRIBUTES:
+    account_name - account name the client introduces itself with
+    address, port - server address and port
+    reader, writer - connection streams
+    decoder - frame decoder of the data received from the server
+    framing - framing of the frames sent to the server
+    wire - wire format requested at PRESENCE
+    wire_in_effect - wire format of the payloads sent to the server
+    compression - compression requested at PRESENCE
+    compressor - compression state of the connection, None unless the compression is requested
+    compressing - the payloads sent to the server are compressed
+    decompressing - the payloads received from the server are compressed
+    pending - (future, framing, compression) of the requests waiting for responses with request ids as keys, in order;
+    the framing and the compression are the ones in effect for the payloads received after the response to the request,
+    None if they don't change
+    messages - queue of the messages pushed by the server, None after the last one
+    window - semaphore limiting the number of the requests outstanding
+    negotiation - lock held while PRESENCE waits for its response, so that nothing is sent meanwhile
+    """
+    def __init__(self, account_name: str = None, address: str = None, port: int = None,
+                 messages_maxsize: int = 0, window: int = None, wire: str = None, compression: str = None):
+        """
+        :param messages_maxsize: maximum number of the messages received and not taken yet;
+        the client stops reading from the server when the queue is full, 0 for no limit
+        :param window: maximum number of the requests outstanding, CLIENT_REQUEST_WINDOW if not specified;
+        the requests beyond it wait for the responses to the previous ones before they are sent
+        :param wire: wire format to request at PRESENCE, CLIENT_WIRE if not specified
+        :param compression: compression to request at PRESENCE, CLIENT_COMPRESSION if not specified
+        :raises ValueError: if the binary wire format or the compression is requested without LENGTH framing
+        """
+        self.account_name = account_name if account_name else sett.DEFAULT_ACCOUNT_NAME
+        self.address = address if address else sett.DEFAULT_SERVER_ADDRESS
+        self.port = port if port else sett.DEFAULT_PORT
+        self.reader = None
+        self.writer = None
+        self.decoder = jim.FrameDecoder(jim.Framing(sett.DEFAULT_FRAMING))
+        self.framing = self.decoder.framing
+        self.wire = jim.Wire(wire if wire else sett.CLIENT_WIRE)
+        if self.wire == jim.Wire.BINARY and jim.Framing(sett.CLIENT_FRAMING) != jim.Framing.LENGTH:
+            raise ValueError("Двоичный формат сообщений требует кадров '{}'".format(jim.Framing.LENGTH.value))
+        self.wire_in_effect = jim.Wire.JSON
+        self.compression = jim.Compression(compression if compression else sett.CLIENT_COMPRESSION)
+        if self.compression != jim.Compression.NONE and jim.Framing(sett.CLIENT_FRAMING) != jim.Framing.LENGTH:
+            raise ValueError("Сжатие требует кадров '{}'".format(jim.Framing.LENGTH.value))
+        self.compressor = jim.StreamCompressor() if self.compression != jim.Compression.NONE else None
+        self.compressing = self.decompressing = False
+        self.pending = {}
+        self.messages = asyncio.Queue(messages_maxsize)
+        self.window = asyncio.Semaphore(window if window else sett.CLIENT_REQUEST_WINDOW)
+        self.negotiation = asyncio.Lock()
+        self._ids = itertools.count(1)
+        self._reader_task = None
+
+    async def connect(self) -> jim.Response:
+        """
+        Connect to the server and introduce the client with PRESENCE, negotiating CLIENT_FRAMING
+        :return: response to PRESENCE
+        :raises OSError: if failed to connect
+        """
+        self.reader, self.writer = await asyncio.open_connection(self.address, self.port)
+        self.writer.transport.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        log.info("Соединение с сервером установлено с адреса %s", self.writer.get_extra_info("sockname"))
+        self._reader_task = asyncio.create_task(self._read())
+        return await self.request(self._presence())
+
+    def _presence(self) -> jim.Message:
+        return jim.Message(jim.Actions.PRESENCE, type="status", framing=sett.CLIENT_FRAMING, wire=self.wire.value,
+                           compression=self.compression.value,
+                           user={"account_name": self.account_name, "status": "Online"})
+
+    async def request(self, message: jim.Message) -> jim.Response:
+        """
+        Send the message with a request id, unless it has one already, and wait for the response
+        :raises ConnectionError: if the connection is closed before the response is received
+        """
+        async with self.window:
+            async with self.negotiation:
+                if self.writer is None or self.writer.is_closing():
+                    raise ConnectionError("Нет соединения с сервером")
+                request_id = message.kwargs.setdefault("id", next(self._ids))
+                response = asyncio.get_running_loop().create_future()
+                framing = compression = None
+                payload = message.binary if self.wire_in_effect == jim.Wire.BINARY else message.encoded
+                if self.compressing:
+                    payload = self.compressor.compress(payload)
+                self.writer.write(jim.encode_frame(payload, self.framing))
+                if message.action == jim.Actions.PRESENCE:
+                    framing = jim.Framing(message.kwargs.get("framing", self.framing))
+                    compression = jim.Compression(message.kwargs.get("compression", jim.Compression.NONE))
+                self.pending[request_id] = response, framing, compression
+                await self.writer.drain()
+                if framing:
+                    # The server switches to the framing, the wire format and the compression requested right after
+                    # reading PRESENCE unless it rejects it - nothing is sent until the response tells which
+                    result = await response
+                    if result.response != jim.Responses.BAD_REQUEST:
+                        self.framing = framing
+                        self.wire_in_effect = jim.Wire(message.kwargs.get("wire", self.wire_in_effect))
+                        self.compressing = compression != jim.Compression.NONE
+                    return result
+            return await response
+
+    async def history(self, peer: str, **kwargs) -> jim.Response:
+        """
+        Request a page of the history of the conversation with the peer
+        :param kwargs: since, until, cursor, limit - see the HISTORY format in jim.py
+        """
+        return await self.request(jim.Message(jim.Actions.HISTORY, peer=peer, **kwargs))
+
+    async def send_message(self, to: str, text: str) -> jim.Response:
+        """ Send the chat message to the account or to everyone for BROADCAST_RECIPIENT """
+        return await self.request(jim.Message(jim.Actions.MESSAGE, to=to, message=text,
+                                              **{"from": self.account_name}))
+
+    async def stats(self) -> jim.Response:
+        return await self.request(jim.Message(jim.Actions.STATS))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> jim.Message:
+        """ Return the next message pushed by the server, stop when the connection is closed """
+        message = await self.messages.get()
+        if message is None:
+            self.messages.put_nowait(None)          # For the other readers, if any
+            raise StopAsyncIteration
+        return message
+
+    async def _read(self):
+        """ Read the frames from the server until the connection is closed """
+        try:
+            while data := await self.reader.read(sett.MAX_DATA_LEN):
+                self.decoder.feed(data)
+                for frame in self.decoder:
+                    if self.decompressing:
+                        frame = self.compressor.decompress(frame)
+                    await self._process_frame(frame)
+            log.info("Соединение закрыто сервером.")
+        except jim.FrameError as e:
+            log.error("Некорректный кадр от сервера: %s", e)
+            self.writer.close()
+        except OSError as e:
+            log.error("Нет соединения с сервером: %s", e)
+        finally:
+            for response, _, _ in self.pending.values():
+                if not response.done():
+                    response.set_exception(ConnectionError("Соединение закрыто сервером"))
+            self.pending.clear()
+            await self.messages.put(None)
+
+    async def _process_frame(self, frame: bytes):
+        try:
+            obj = jim.loads(frame)
+            if isinstance(obj, dict) and "response" in obj:
+                response = jim.Response.from_dict(obj)
+                request_id = response.kwargs.get("id")
+                if request_id is None and self.pending:
+                    request_id = next(iter(self.pending))
+                if request_id not in self.pending:
+                    log.error("Получен ответ без запроса: %s", frame)
+                    return
+                future, framing, compression = self.pending.pop(request_id)
+                if framing and response.response != jim.Responses.BAD_REQUEST:
+                    self.decoder.framing = framing
+                    self.decompressing = compression != jim.Compression.NONE
+                if not future.done():
+                    future.set_result(response)
+                return
+            message = jim.Message.from_dict(obj)
+        except ValueError as e:
+            log.error("Получено некорректное сообщение от сервера (%s): %s", e, frame)
+            return
+        if message.action == jim.Actions.PROBE:
+            log.debug("Сервер проверяет присутствие клиента.")
+            asyncio.create_task(self._answer_probe())
+            return
+        await self.messages.put(message)
+
+    async def _answer_probe(self):
+        try:
+            response = await self.request(self._presence())
+        except ConnectionError:
+            return
+        if response.response != jim.Responses.OK:
+            log.error("Сервер отклонил ответ на PROBE: %s", response.kwargs.get("error", ""))
+
+    async def close(self, quit_message: bool = True):
+        """
+        Close the connection
+        :param quit_message: send QUIT and wait for the server to close the connection
+        """
+        if self.writer is None:
+            return
+        if quit_message and not self.writer.is_closing():
+            try:
+                await self.request(jim.Message(jim.Actions.QUIT))
+            except ConnectionError:
+                pass
+        self.writer.close()
+        if self._reader_task:
+            self._reader_task.cancel()          # Might wait for room in the message queue otherwise
+            await asyncio.gather(self._reader_task, return_exceptions=True)
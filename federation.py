@@ -0,0 +1,311 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+
+import settings as sett
+import jim
+import routing
+
+"""
+Server federation: several server_asyncio.py nodes, each with its own clients, form a full mesh of server links
+so that clients of different nodes can talk to each other.
+Every node listens for links on its link port and keeps links to the configured peers, reconnecting them
+when they are lost. Links carry JIM messages with LENGTH framing (see the server link formats in jim.py):
+- LINK introduces the node at each end; of two links between the same nodes the one initiated by the node
+  with the lesser name is kept, the other one is refused with CONFLICT;
+- ROUTE tells the other node which accounts have connected to / disconnected from the node;
+- RELAY carries a client message to the node hosting the recipient, or to every node for broadcasts.
+Loop prevention: a node only advertises and relays for its own clients, a relayed message is delivered
+to the clients of the receiving node and never relayed further, a link to the node itself is refused
+and relays already seen are dropped.
+"""
+
+log = logging.getLogger(sett.SERVER_LOG_NAME)
+RELAY_PAYLOAD = b',"payload":'        # RELAY ends with the payload, which follows the header fields
+
+
+class LinkProtocol(asyncio.Protocol):
+    """
+    Server link to another node
+    ATTRIBUTES:
+    federation - federation of the node
+    peer - (address, port) the link has been initiated to, None for the links initiated by the other node
+    node - name of the node at the other end, None until it is introduced with LINK
+    transport - link transport
+    decoder - frame decoder
+    closed - future done when the link is lost
+    """
+    def __init__(self, federation: "Federation", peer: (str, int) = None):
+        self.federation = federation
+        self.peer = peer
+        self.node = None
+        self.transport = None
+        self.decoder = jim.FrameDecoder(jim.Framing.LENGTH)
+        self.closed = asyncio.get_running_loop().create_future()
+
+    @property
+    def outbound(self) -> bool:
+        return self.peer is not None
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        if self.outbound:
+            self.send(jim.Message(jim.Actions.LINK, node=self.federation.node).encoded)
+
+    def connection_lost(self, exc: Exception | None):
+        self.federation.link_lost(self)
+        self.closed.set_result(None)
+
+    def send(self, payload: bytes):
+        if not self.transport.is_closing():
+            self.transport.write(jim.encode_frame(payload, jim.Framing.LENGTH))
+
+    def refuse(self, status: jim.Responses):
+        """ Reply with the error status and close the link """
+        self.send(jim.encode_response(status))
+        self.transport.close()
+
+    def data_received(self, data: bytes):
+        self.decoder.feed(data)
+        try:
+            for frame in self.decoder:
+                obj = jim.json_loads(frame)
+                if isinstance(obj, dict) and "response" in obj:
+                    log.warning("Связь %s Узел отказал в связи: %s", self.node or self.peer, obj)
+                    self.transport.close()
+                    return
+                self.federation.handle(self, jim.MessageView(obj), frame)
+        except ValueError as e:             # FrameError, ValidationError, malformed JSON
+            log.error("Связь %s Связь разрывается - некорректное сообщение: %s", self.node or self.peer, e)
+            self.transport.abort()
+
+
+class NodeAccount:
+    """
+    Account connected to another node - messages are relayed to it over the link to that node
+    ATTRIBUTES:
+    account_name - account name
+    node - name of the node hosting the account
+    federation - federation of the node
+    """
+    def __init__(self, account_name: str, node: str, federation: "Federation"):
+        self.account_name = account_name
+        self.node = node
+        self.federation = federation
+
+    def deliver(self, message: bytes):
+        self.federation.relay(self.node, self.account_name, message)
+
+
+class FederationRouter(routing.RemoteRouter):
+    """
+    Account index of a node - knows the accounts connected to the other nodes and advertises the accounts
+    of its own clients to them.
+    ATTRIBUTES:
+    federation - federation of the node
+    """
+    def __init__(self, federation: "Federation"):
+        super().__init__()
+        self.federation = federation
+
+    def account_added(self, account_name: str):
+        self.federation.advertise(add=[account_name])
+
+    def account_removed(self, account_name: str):
+        self.federation.advertise(remove=[account_name])
+
+
+class Federation:
+    """
+    ATTRIBUTES:
+    node - name of the node
+    address - link address to listen on
+    port - link port to listen on
+    peers - (address, port) list of the nodes to keep links to
+    connections - client connections of the node to deliver broadcasts to
+    router - account index of the node
+    links - LinkProtocol dictionary with names of the linked nodes as keys
+    peer_nodes - node names dictionary with peer (address, port) as keys, learned when the links are established
+    recent - ids of the relays received recently, the set is for lookups and the queue is for expiry;
+    relay ids carry the start time of the node, so that a restarted node doesn't repeat the ids it used before
+    """
+    def __init__(self, node: str, address: str, port: int, peers: list, connections: set):
+        self.node = node
+        self.address = address
+        self.port = port
+        self.peers = peers
+        self.connections = connections
+        self.router = FederationRouter(self)
+        self.links = {}
+        self.peer_nodes = {}
+        self.recent = set()
+        self._recent_order = deque()
+        self._relay_epoch = "{:x}".format(time.time_ns())
+        self._relay_ids = itertools.count()
+        self._tasks = set()
+
+    async def start(self) -> asyncio.AbstractServer:
+        """ Start listening for links and linking to the peers """
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: LinkProtocol(self), self.address if self.address else None,
+                                          self.port)
+        log.critical("Узел %s ожидает связей по адресу %s:%d, узлы для связи: %s",
+                     self.node, self.address if self.address else '(все)', self.port, self.peers)
+        for peer in self.peers:
+            task = asyncio.create_task(self._keep_link(peer))
+            self._tasks.add(task)
+        return server
+
+    async def _keep_link(self, peer: (str, int)):
+        """ Keep a link to the peer, reconnecting with exponential backoff """
+        loop = asyncio.get_running_loop()
+        delay = sett.FEDERATION_RECONNECT_DELAY
+        while True:
+            if self.peer_nodes.get(peer) not in self.links:     # Not linked by the peer itself
+                try:
+                    _, link = await loop.create_connection(lambda: LinkProtocol(self, peer), *peer)
+                except OSError as e:
+                    log.info("Связь %s Не удалось установить связь: %s", peer, e)
+                else:
+                    await link.closed
+                    if link.node is not None:
+                        delay = sett.FEDERATION_RECONNECT_DELAY
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, sett.FEDERATION_RECONNECT_MAX_DELAY)
+
+    def _route_messages(self, add: list = (), remove: list = ()):
+        """ Generate ROUTE messages, every one small enough to fit in a frame """
+        batch = sett.FEDERATION_ROUTE_BATCH
+        for start in range(0, max(len(add), len(remove)), batch):
+            yield jim.Message(jim.Actions.ROUTE, node=self.node,
+                              add=add[start:start + batch], remove=remove[start:start + batch]).encoded
+
+    def advertise(self, add: list = (), remove: list = ()):
+        """ Tell the linked nodes the accounts of the node connected / disconnected """
+        for message in self._route_messages(add, remove):
+            for link in self.links.values():
+                link.send(message)
+
+    def _relay_frame(self, account_name: str, message: bytes) -> bytes:
+        """ Wrap the client message into RELAY without encoding it once more """
+        relay_id = "{}:{}:{}".format(self.node, self._relay_epoch, next(self._relay_ids))
+        header = jim.Message(jim.Actions.RELAY, node=self.node, id=relay_id, to=account_name).encoded
+        return header[:-1] + RELAY_PAYLOAD + message + b"}"
+
+    def relay(self, node: str, account_name: str, message: bytes):
+        """ Relay the client message to the account connected to the node """
+        link = self.links.get(node)
+        if link is None:                    # The link has been lost, the route is about to be withdrawn
+            log.info("Связь %s Нет связи с узлом, сообщение для %s не доставлено.", node, account_name)
+            return
+        link.send(self._relay_frame(account_name, message))
+
+    def broadcast(self, message: bytes):
+        """ Relay the client message to the clients of all the other nodes """
+        if self.links:
+            frame = self._relay_frame(jim.BROADCAST_RECIPIENT, message)
+            for link in self.links.values():
+                link.send(frame)
+
+    def handle(self, link: LinkProtocol, message: jim.MessageView, frame: bytes):
+        """
+        Process the message received over the link
+        :param message: decoded message
+        :param frame: the message as received
+        """
+        if message.action == jim.Actions.LINK:
+            self._link(link, message.fields["node"])
+        elif link.node is None or message.fields.get("node") != link.node:
+            log.error("Связь %s Связь разрывается - сообщение %s до представления узла или от чужого узла.",
+                      link.node or link.peer, message.action.value)
+            link.transport.abort()
+        elif message.action == jim.Actions.ROUTE:
+            self._route(link, message.fields.get("add") or (), message.fields.get("remove") or ())
+        elif message.action == jim.Actions.RELAY:
+            self._deliver(message, frame)
+        else:
+            log.error("Связь %s Неподдерживаемое сообщение: %s", link.node, message.action.value)
+
+    def _link(self, link: LinkProtocol, node: str):
+        if link.node is not None:
+            return
+        if node == self.node:
+            log.error("Связь %s Отказ в связи узла с самим собой.", link.peer or node)
+            link.refuse(jim.Responses.CONFLICT)
+            return
+        if link.outbound:
+            self.peer_nodes[link.peer] = node       # Don't link to the peer while it links to the node itself
+        else:
+            link.send(jim.Message(jim.Actions.LINK, node=self.node).encoded)
+        existing = self.links.get(node)
+        if existing is not None:
+            # Both nodes keep the link initiated by the node with the lesser name
+            initiator = self.node if link.outbound else node
+            if initiator != min(self.node, node):
+                log.info("Связь %s Отказ в повторной связи с узлом.", node)
+                link.refuse(jim.Responses.CONFLICT)
+                return
+            existing.transport.close()
+        link.node = node
+        self.links[node] = link
+        log.critical("Связь %s Связь с узлом установлена.", node)
+        for message in self._route_messages(add=list(self.router.accounts)):
+            link.send(message)
+
+    def _route(self, link: LinkProtocol, add, remove):
+        for account_name in add:
+            if not isinstance(account_name, str):
+                continue
+            if self.router.local(account_name) is not None:
+                log.warning("Связь %s Учетная запись %s подключена и к этому узлу.", link.node, account_name)
+            self.router.bind_remote(account_name, NodeAccount(account_name, link.node, self))
+        for account_name in remove:
+            remote_account = self.router.remote.get(account_name)
+            if remote_account is not None and remote_account.node == link.node:
+                self.router.unbind_remote(account_name, remote_account)
+
+    def _deliver(self, message: jim.MessageView, frame: bytes):
+        """
+        Deliver the relayed message to the clients of the node - never relay it any further.
+        The payload is forwarded as received, so it is validated as a client message on its own: the link port
+        takes connections from anyone.
+        """
+        relay_id = message.fields["id"]
+        if relay_id in self.recent:
+            log.info("Повторное сообщение %s отброшено.", relay_id)
+            return
+        start = frame.find(RELAY_PAYLOAD)
+        payload = frame[start + len(RELAY_PAYLOAD):-1] if start >= 0 and frame.endswith(b"}") else b""
+        try:
+            if jim.MessageView(jim.json_loads(payload)).action != jim.Actions.MESSAGE:
+                raise jim.ValidationError("Пересылаются только сообщения")
+        except ValueError as e:             # ValidationError, malformed JSON
+            log.error("Связь %s Некорректное пересланное сообщение %s отброшено: %s", message.fields["node"],
+                      relay_id, e)
+            return
+        self.recent.add(relay_id)
+        self._recent_order.append(relay_id)
+        if len(self._recent_order) > sett.FEDERATION_RECENT_RELAYS:
+            self.recent.discard(self._recent_order.popleft())
+        account_name = message.fields["to"]
+        if account_name == jim.BROADCAST_RECIPIENT:
+            for connection in self.connections:
+                connection.deliver(payload, shared=True)
+            return
+        connection = self.router.local(account_name)
+        if connection is None:
+            log.info("Адресат %s пересланного сообщения %s недоступен.", account_name, relay_id)
+        else:
+            connection.deliver(payload)
+
+    def link_lost(self, link: LinkProtocol):
+        """ Withdraw the routes to the node if the link was the one to it """
+        if link.node is None or self.links.get(link.node) is not link:
+            return
+        del self.links[link.node]
+        log.critical("Связь %s Связь с узлом потеряна.", link.node)
+        for account_name, remote_account in list(self.router.remote.items()):
+            if remote_account.node == link.node:
+                self.router.unbind_remote(account_name, remote_account)
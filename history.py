@@ -0,0 +1,170 @@
+import queue
+import sqlite3
+import logging
+import threading
+import time
+
+import settings as sett
+import jim
+
+"""
+Chat history: every message routed by the server is recorded to an SQLite database in WAL mode
+and may be requested back with HISTORY (see jim.py) by the participants of the conversation.
+A conversation is either the direct messages of two accounts, in both directions, or the broadcasts.
+The history is read page by page, oldest first: the response to HISTORY has the "cursor" of the next page
+unless the page is the last one. Pages are found with the (conversation, time, id) index, the cursor being
+the (time, id) of the last message of the previous page, so no page takes a scan of the messages before it.
+All database access is done by the history thread: messages are queued to it and written in batches,
+one transaction per batch, so the servers never wait for the disk.
+"""
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY, conversation TEXT NOT NULL, "
+    "time INTEGER NOT NULL, sender TEXT NOT NULL, recipient TEXT NOT NULL, message TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS history_conversation ON history (conversation, time, id)",
+)
+INSERT = "INSERT INTO history (conversation, time, sender, recipient, message) VALUES (?, ?, ?, ?, ?)"
+SELECT_PAGE = ("SELECT id, time, sender, recipient, message FROM history "
+               "WHERE conversation = ? AND time >= ? AND time < ? AND (time, id) > (?, ?) ORDER BY time, id LIMIT ?")
+MAX_TIME = 2 ** 63 - 1
+
+log = logging.getLogger(sett.SERVER_LOG_NAME)
+
+
+def conversation_key(account_name: str, peer: str) -> str:
+    """ Return the conversation the accounts' messages belong to, broadcasts being a conversation of their own """
+    if peer == jim.BROADCAST_RECIPIENT:
+        return jim.BROADCAST_RECIPIENT
+    return jim.json_dumps(sorted((account_name, peer))).decode(sett.DEFAULT_ENCODING)
+
+
+def parse_cursor(cursor: str | None) -> (int, int):
+    """
+    :return: (time, id) of the last message of the previous page, (-1, -1) for the first page
+    :raises ValueError: if the cursor is malformed
+    """
+    if cursor is None:
+        return -1, -1
+    timestamp, _, message_id = cursor.partition(":")
+    return int(timestamp), int(message_id)
+
+
+class HistoryStore(threading.Thread):
+    """
+    History thread owning the database
+    ATTRIBUTES:
+    path - database file path
+    requests - queue of the requests to the history thread
+    """
+    def __init__(self, path: str = None, *args, **kwargs):
+        """
+        If path is not specified, the default one is used.
+        """
+        super().__init__(*args, **kwargs)
+        self.daemon = True
+        self.path = path if path else sett.HISTORY_DATABASE
+        self.requests = queue.SimpleQueue()
+        self._db = None
+
+    def record(self, sender: str, message: bytes):
+        """ Record the message routed; returns at once, the message is parsed and written by the history thread """
+        self.requests.put((sender, message, time.time_ns()))
+
+    def query(self, account_name: str, request: dict, callback):
+        """
+        Find a page of the history requested; returns at once
+        :param account_name: account requesting the history
+        :param request: HISTORY message fields: "peer", optional "since", "until", "cursor" and "limit"
+        :param callback: function called by the history thread with the encoded response to HISTORY
+        """
+        self.requests.put((account_name, request, callback))
+
+    # Everything below is called by the history thread only
+
+    def open(self):
+        self._db = sqlite3.connect(self.path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")        # WAL stays consistent, only the last batches may be lost
+        for statement in SCHEMA:
+            self._db.execute(statement)
+        self._db.commit()
+
+    def _rows(self, records: list):
+        """ Convert the (sender, message, time) records to database rows, skipping the ones not to be recorded """
+        for sender, message, received in records:
+            try:
+                obj = jim.json_loads(message)
+                recipient, text = obj["to"], obj["message"]
+            except (ValueError, KeyError, TypeError) as e:
+                log.error("История: сообщение не записано (%s): %s", e, message)
+                continue
+            yield conversation_key(sender, recipient), received, sender, recipient, text
+
+    def _write(self, records: list):
+        with self._db:
+            self._db.executemany(INSERT, self._rows(records))
+
+    def _page(self, account_name: str, request: dict) -> bytes:
+        """ Find the page requested and encode the response with it """
+        try:
+            after = parse_cursor(request.get("cursor"))
+        except ValueError:
+            return jim.encode_response(jim.Responses.BAD_REQUEST, text="Недопустимое значение поля 'cursor'",
+                                       request_id=request.get("id"))
+        limit = max(min(request.get("limit") or sett.HISTORY_PAGE_SIZE, sett.HISTORY_PAGE_SIZE), 1)
+        try:
+            rows = self._db.execute(SELECT_PAGE, (conversation_key(account_name, request["peer"]),
+                                                  int(request.get("since") or 0), int(request.get("until") or MAX_TIME),
+                                                  *after, limit + 1)).fetchall()
+        except OverflowError:               # Doesn't fit in SQLite integer
+            return jim.encode_response(jim.Responses.BAD_REQUEST, text="Недопустимое значение времени",
+                                       request_id=request.get("id"))
+        messages = []
+        size = 0
+        for message_id, timestamp, sender, recipient, text in rows[:limit]:
+            record = {"time": timestamp, "from": sender, "to": recipient, "message": text}
+            size += len(jim.json_dumps(record)) + 1         # Measured encoded, as escaping may take several times more
+            if size > sett.HISTORY_PAGE_BYTES and messages:
+                break
+            messages.append(record)
+            after = timestamp, message_id
+        response = {"alert": "OK", "messages": messages}
+        if request.get("id") is not None:
+            response["id"] = request["id"]
+        if len(messages) < len(rows):
+            response["cursor"] = "{}:{}".format(*after)
+        return jim.Response(jim.Responses.OK, **response).encoded
+
+    def _process(self, requests: list):
+        """ Process a batch of requests: messages are written in one transaction, before the queries after them """
+        records = []
+        for account_name, request, argument in requests:
+            if isinstance(request, bytes):
+                records.append((account_name, request, argument))
+                continue
+            if records:
+                self._write(records)
+                records = []
+            try:
+                response = self._page(account_name, request)
+            except sqlite3.Error as e:
+                log.critical("История: ошибка базы данных: %s", e)
+                response = jim.encode_response(jim.Responses.SERVER_ERROR, request_id=request.get("id"))
+            argument(response)
+        if records:
+            self._write(records)
+
+    def run(self):
+        try:
+            self.open()
+        except sqlite3.Error as e:
+            log.critical("История: не удалось открыть базу данных %s: %s", self.path, e)
+            return
+        while True:
+            requests = [self.requests.get()]
+            while len(requests) < sett.HISTORY_BATCH and not self.requests.empty():
+                requests.append(self.requests.get())
+            try:
+                self._process(requests)
+            except sqlite3.Error as e:
+                log.critical("История: ошибка базы данных: %s", e)
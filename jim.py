@@ -1,11 +1,16 @@
 import enum
 import time
 import json
+import struct
+import zlib
 import logging
+import functools
+import importlib
 
 import settings as sett
 
 DEFAULT_LOGGER_NAME = __name__ + ".null"
+BROADCAST_RECIPIENT = "all"                 # MESSAGE recipient to deliver the message to everyone
 
 """
 # message text - maximum 500 characters
@@ -19,14 +24,194 @@ MESSAGE FORMATS:
         "status": "Yep, I am here!"
     }
 }
+{
+    "action": "msg",
+    "time": <unix timestamp>,
+    "to": "account_name",                   # 25 characters max, "all" for everyone
+    "from": "account_name",
+    "message": "message"                    # 500 characters max
+}
+{
+    "action": "history",                    # history of the conversation with the peer, oldest first
+    "time": <unix timestamp>,
+    "peer": "account_name",                 # "all" for the broadcasts
+    "since": <unix timestamp>,              # optional, inclusive
+    "until": <unix timestamp>,              # optional, exclusive
+    "cursor": "cursor",                     # optional, "cursor" of the previous page response
+    "limit": <number of messages>           # optional, the server may return less
+}
+{
+    "action": "stats",                      # server metrics, for the admin accounts only
+    "time": <unix timestamp>
+}
+SERVER LINK MESSAGE FORMATS (see federation.py):
+{
+    "action": "link",                       # introduces the node at the other end of a server link
+    "time": <unix timestamp>,
+    "node": "node name"                     # 64 characters max
+}
+{
+    "action": "route",                      # accounts connected to the node appeared / disappeared
+    "time": <unix timestamp>,
+    "node": "node name",
+    "add": ["account_name", ...],
+    "remove": ["account_name", ...]
+}
+{
+    "action": "relay",                      # message relayed to the node hosting the recipient
+    "time": <unix timestamp>,
+    "node": "node name",                    # node the message has been received by from the client
+    "id": "relay id",                       # unique for the node, across its restarts too
+    "to": "account_name",                   # "all" for everyone
+    "payload": {"action": "msg", ...}
+}
+Every client message may carry an optional request id, a string or an integer chosen by the client:
+    "id": "request id"                      # 36 characters max
+The response to the message echoes it, so that the client may send requests without waiting for the responses
+to the previous ones and match the responses to the requests by their ids. The responses to the messages read
+from the connection at once are sent at once too, in the order of the messages, save for HISTORY:
+its response is sent once the history is read and may come after the responses to the messages following it.
 RESPONSE FORMATS:
 {
     "response": <код ответа>,               # 3 digits
+    "id": "request id",                     # only if the request had one
     {"alert"|"error"}: <текст ответа> 
 }
+{
+    "response": 200,                        # response to HISTORY
+    "time": <unix timestamp>,
+    "alert": "OK",
+    "messages": [{"time": <unix timestamp>, "from": "account_name", "to": "account_name", "message": "message"}, ...],
+    "cursor": "cursor"                      # absent for the last page
+}
+{
+    "response": 200,                        # response to STATS, see metrics.py
+    "time": <unix timestamp>,
+    "alert": "OK",
+    "stats": {"uptime": <seconds>, "counters": {...}, "gauges": {...}, "latency_us": {...}}
+}
+FRAMING:
+Messages are sent over the stream as frames, by default delimited with a newline (JSON text never contains a raw one).
+PRESENCE may request another framing with the "framing" field, e.g. "framing": "length" - 4-byte big-endian
+payload length before every payload. The response to PRESENCE is framed the old way, everything after it - the new way.
+BINARY WIRE FORMAT:
+PRESENCE may also request "wire": "binary" along with "framing": "length" to have the payloads packed instead of JSON,
+again from the response to PRESENCE on. The server translates the messages between the JSON and the binary clients.
+A binary payload is a header, then the fields other than "action" / "response" packed as a dictionary:
+    message header: 0x01, action code - 1 byte, index of the action in Actions
+    response header: 0x02, response code - 2 bytes
+Values are a tag byte followed by the value, numbers big-endian:
+    0x00 null, 0x01 false, 0x02 true
+    0x03 integer - 8 bytes signed, 0x04 number - 8-byte double, also integers beyond 64 bits
+    0x05 string - 2-byte length in bytes, UTF-8 bytes
+    0x06 list - 2-byte number of items, items
+    0x07 dictionary - 2-byte number of items, keys and values
+A dictionary key is its 1-byte index in BINARY_KEYS or 0xFF, 2-byte length and UTF-8 bytes for any other key.
+Lists and dictionaries are nested BINARY_MAX_DEPTH levels deep at most; a message nested deeper isn't delivered
+to the binary peers.
+New actions and keys are only appended to Actions and BINARY_KEYS, so the codes never change.
+COMPRESSION:
+PRESENCE may also request "compression": "zlib" along with "framing": "length" to have the payloads compressed,
+again from the response to PRESENCE on. Every payload then starts with a flag byte:
+    0x00 - the payload follows as is, e.g. if it is shorter than COMPRESSION_THRESHOLD
+    0x01 - the payload is compressed in the deflate stream of the connection, flushed with Z_SYNC_FLUSH
+    0x02 - the payload is compressed on its own, as a complete deflate stream: the server sends a broadcast
+           the same way to every recipient rather than compressing it in every connection stream
+Each direction of the connection has a stream of its own. Both the streams and the payloads compressed
+on their own are raw deflate (no zlib header) with COMPRESSION_DICTIONARY preset. A corrupt compressed payload
+closes the connection, as the stream can't be decompressed after it. For the same reason a frame, once compressed,
+is never dropped: a server dropping the messages for slow consumers drops them before they are compressed.
 """
 
 
+def load_json_backend(name: str = None):
+    """
+    Load a JSON backend: the one named or the fastest one installed (see JSON_BACKENDS).
+    All the backends accept str or bytes and produce the same JSON semantics, but not the same bytes:
+    e.g. orjson output is compact and not ASCII-escaped.
+    :param name: backend name, one of JSON_BACKENDS
+    :return: backend name, loads(str | bytes) function and dumps(obj) -> bytes function
+    """
+    for backend in (name, ) if name else JSON_BACKENDS:
+        try:
+            module = importlib.import_module(backend)
+        except ImportError:
+            continue
+        if backend == "orjson":
+            return backend, module.loads, module.dumps
+        if backend == "ujson":
+            return backend, module.loads, lambda obj: module.dumps(
+                obj, ensure_ascii=False, escape_forward_slashes=False).encode(sett.DEFAULT_ENCODING)
+        return backend, module.loads, lambda obj: module.dumps(obj).encode(sett.DEFAULT_ENCODING)
+    raise ImportError("JSON backend {} is not available".format(name))
+
+
+JSON_BACKENDS = ("orjson", "ujson", "json")         # Optional fast backends first, standard library last
+JSON_BACKEND, json_loads, json_dumps = load_json_backend(sett.JIM_JSON_BACKEND)
+
+
+MAX_ACTION_LEN = 15
+MAX_ACCOUNT_NAME_LEN = 25
+MAX_STATUS_LEN = 500
+MAX_MESSAGE_TEXT_LEN = 500
+MAX_NODE_NAME_LEN = 64
+MAX_RELAY_ID_LEN = 128
+MAX_CURSOR_LEN = 50
+MAX_REQUEST_ID_LEN = 36
+
+
+class Field:
+    """
+    Schema field description
+    ATTRIBUTES:
+    name - field name
+    types - allowed value types
+    max_len - maximum length of a string value, None if not limited
+    required - the field must be present
+    fields - schema of a nested object
+    """
+    __slots__ = ("name", "types", "max_len", "required", "fields")
+
+    def __init__(self, name: str, types: type | tuple, max_len: int = None, required: bool = False,
+                 fields: tuple = ()):
+        self.name = name
+        self.types = types
+        self.max_len = max_len
+        self.required = required
+        self.fields = fields
+
+
+def compile_validator(fields: tuple):
+    """
+    Compile the schema into a validator function
+    :param fields: tuple of Field objects
+    :return: function taking a decoded object and returning None if it is valid or the reason it is not
+    """
+    checks = []
+    for field in fields:
+        nested = compile_validator(field.fields) if field.fields else None
+        checks.append((field.name, field.types, field.max_len, field.required, nested))
+
+    def validate(obj: dict) -> str | None:
+        for name, types, max_len, required, nested in checks:
+            value = obj.get(name)
+            if value is None:
+                if required:
+                    return "Отсутствует поле '{}'".format(name)
+                continue
+            if not isinstance(value, types) or isinstance(value, bool):
+                return "Недопустимый тип поля '{}'".format(name)
+            if max_len is not None and isinstance(value, str) and len(value) > max_len:
+                return "Поле '{}' длиннее {} символов".format(name, max_len)
+            if nested is not None:
+                reason = nested(value)
+                if reason:
+                    return "{} в поле '{}'".format(reason, name)
+        return None
+
+    return validate
+
+
 # Max 15 characters
 class Actions(str, enum.Enum):
     PRESENCE = "presence"
@@ -36,6 +221,11 @@ class Actions(str, enum.Enum):
     AUTHENTICATE = "authenticate"
     JOIN = "join"
     LEAVE = "leave"
+    HISTORY = "history"
+    STATS = "stats"
+    LINK = "link"                   # server link actions
+    ROUTE = "route"
+    RELAY = "relay"
 
 
 class Responses(enum.IntEnum):
@@ -59,34 +249,587 @@ class Responses(enum.IntEnum):
 
     @property
     def response(self):
-        messages = {
-            self.NOTIFY_BASIC: {"alert": "Базовое уведомление"},
-            self.NOTIFY_IMPORTANT: {"alert": "Важное уведомление"},
-            self.OK: {"alert": "OK"},
-            self.CREATED: {"alert": "Объект создан"},
-            self.ACCEPTED: {"alert": "Подтверждение"},
-            self.BAD_REQUEST: {"error": "Неправильный запрос / JSON - объект"},
-            self.LOGIN_REQUIRED: {"error": "Не авторизован"},
-            self.BAD_LOGIN: {"error": "Неправильный логин / пароль"},
-            self.FORBIDDEN: {"error": "Пользователь заблокирован"},
-            self.NOT_FOUND: {"error": "Пользователь / чат отсутствует на сервере"},
-            self.CONFLICT: {"error": "Уже имеется подключение с указанным логином"},
-            self.GONE: {"error": "Адресат существует, но недоступен (offline)"},
-            self.SERVER_ERROR: {"error": "Ошибка сервера"}
-        }
-
         message = {
             "response": self.value,
         }
-        message.update(messages.get(self.value, {"error": "Неизвестный код ответа"}))
+        message.update(RESPONSE_TEXTS.get(self.value, {"error": "Неизвестный код ответа"}))
         return message
 
 
+RESPONSE_TEXTS = {
+    Responses.NOTIFY_BASIC: {"alert": "Базовое уведомление"},
+    Responses.NOTIFY_IMPORTANT: {"alert": "Важное уведомление"},
+    Responses.OK: {"alert": "OK"},
+    Responses.CREATED: {"alert": "Объект создан"},
+    Responses.ACCEPTED: {"alert": "Подтверждение"},
+    Responses.BAD_REQUEST: {"error": "Неправильный запрос / JSON - объект"},
+    Responses.LOGIN_REQUIRED: {"error": "Не авторизован"},
+    Responses.BAD_LOGIN: {"error": "Неправильный логин / пароль"},
+    Responses.FORBIDDEN: {"error": "Пользователь заблокирован"},
+    Responses.NOT_FOUND: {"error": "Пользователь / чат отсутствует на сервере"},
+    Responses.CONFLICT: {"error": "Уже имеется подключение с указанным логином"},
+    Responses.GONE: {"error": "Адресат существует, но недоступен (offline)"},
+    Responses.SERVER_ERROR: {"error": "Ошибка сервера"}
+}
+
+
+def _response_template(response: Responses) -> (bytes, bytes):
+    """
+    Pre-encode the standard response as it is produced by Response(**response.response).json
+    :return: encoded parts of the response before and after the time value
+    """
+    prefix = '{{"response": {}, "time": '.format(int(response))
+    suffix = json.dumps(RESPONSE_TEXTS[response])
+    suffix = ", " + suffix[1:] if suffix != "{}" else "}"
+    return prefix.encode(sett.DEFAULT_ENCODING), suffix.encode(sett.DEFAULT_ENCODING)
+
+
+RESPONSE_TEMPLATES = {response: _response_template(response) for response in Responses}
+
+
+def encode_response(response: Responses, timestamp: int = None, text: str = None,
+                    request_id: str | int = None) -> bytes:
+    """
+    Return encoded response with the standard text for the response code - the same bytes
+    Response(**response.response).json would be encoded to, spliced from a pre-encoded template
+    :param response: response code
+    :param timestamp: response time; current time if not specified
+    :param text: response text instead of the standard one, e.g. the reason of the error; slow path
+    :param request_id: id of the request to echo, if any
+    """
+    if text is not None:
+        key = next(iter(RESPONSE_TEXTS[response]))
+        fields = {"time": timestamp if timestamp else time.time_ns(), key: text}
+        if request_id is not None:
+            fields["id"] = request_id
+        return Response(response, **fields).json.encode(sett.DEFAULT_ENCODING)
+    prefix, suffix = RESPONSE_TEMPLATES[response]
+    if request_id is not None:
+        return b'%b%d, "id": %b%b' % (prefix, timestamp if timestamp else time.time_ns(), json_dumps(request_id),
+                                      suffix)
+    return b"%b%d%b" % (prefix, timestamp if timestamp else time.time_ns(), suffix)
+
+
+TIME_TYPES = (int, float)
+REQUEST_ID_FIELD = Field("id", (str, int), MAX_REQUEST_ID_LEN)
+MESSAGE_SCHEMAS = {
+    Actions.PRESENCE: (
+        Field("time", TIME_TYPES),
+        REQUEST_ID_FIELD,
+        Field("type", str, MAX_ACTION_LEN),
+        Field("framing", str, MAX_ACTION_LEN),
+        Field("wire", str, MAX_ACTION_LEN),
+        Field("compression", str, MAX_ACTION_LEN),
+        Field("user", dict, fields=(
+            Field("account_name", str, MAX_ACCOUNT_NAME_LEN, required=True),
+            Field("status", str, MAX_STATUS_LEN),
+        )),
+    ),
+    Actions.MESSAGE: (
+        Field("time", TIME_TYPES),
+        REQUEST_ID_FIELD,
+        Field("to", str, MAX_ACCOUNT_NAME_LEN, required=True),
+        Field("from", str, MAX_ACCOUNT_NAME_LEN),
+        Field("message", str, MAX_MESSAGE_TEXT_LEN, required=True),
+    ),
+    Actions.HISTORY: (
+        Field("time", TIME_TYPES),
+        REQUEST_ID_FIELD,
+        Field("peer", str, MAX_ACCOUNT_NAME_LEN, required=True),
+        Field("since", TIME_TYPES),
+        Field("until", TIME_TYPES),
+        Field("cursor", str, MAX_CURSOR_LEN),
+        Field("limit", int),
+    ),
+    Actions.LINK: (
+        Field("time", TIME_TYPES),
+        Field("node", str, MAX_NODE_NAME_LEN, required=True),
+    ),
+    Actions.ROUTE: (
+        Field("time", TIME_TYPES),
+        Field("node", str, MAX_NODE_NAME_LEN, required=True),
+        Field("add", list),
+        Field("remove", list),
+    ),
+    Actions.RELAY: (
+        Field("time", TIME_TYPES),
+        Field("node", str, MAX_NODE_NAME_LEN, required=True),
+        Field("id", str, MAX_RELAY_ID_LEN, required=True),
+        Field("to", str, MAX_ACCOUNT_NAME_LEN, required=True),
+        Field("payload", dict, required=True),
+    ),
+}
+DEFAULT_MESSAGE_SCHEMA = (
+    Field("time", TIME_TYPES),
+    REQUEST_ID_FIELD,
+)
+RESPONSE_SCHEMA = (
+    Field("response", int, required=True),
+    Field("time", TIME_TYPES),
+    REQUEST_ID_FIELD,
+    Field("alert", str, MAX_MESSAGE_TEXT_LEN),
+    Field("error", str, MAX_MESSAGE_TEXT_LEN),
+)
+MESSAGE_VALIDATORS = {action: compile_validator(MESSAGE_SCHEMAS.get(action, DEFAULT_MESSAGE_SCHEMA))
+                      for action in Actions}
+validate_response = compile_validator(RESPONSE_SCHEMA)
+validate_request_id = compile_validator((REQUEST_ID_FIELD, ))
+ACTIONS_BY_VALUE = {action.value: action for action in Actions}        # Faster than Actions(value)
+
+
+def validate_message(message: dict) -> str | None:
+    """
+    Validate decoded message against its action schema
+    :return: None if the message is valid, the reason it is not otherwise
+    """
+    action = message.get("action")
+    if not isinstance(action, str) or len(action) > MAX_ACTION_LEN:
+        return "Недопустимое поле 'action'"
+    validator = MESSAGE_VALIDATORS.get(action)          # Actions members hash and compare as their values
+    if validator is None:
+        return "Неизвестное действие '{}'".format(action)
+    return validator(message)
+
+
+class Framing(str, enum.Enum):
+    LINE = "line"               # frame is a payload followed by FRAME_DELIMITER
+    LENGTH = "length"           # frame is FRAME_HEADER with payload length followed by payload
+
+
+FRAME_DELIMITER = b"\n"
+FRAME_HEADER = struct.Struct("!I")
+
+
+class ValidationError(ValueError):
+    """ Message or response doesn't match its schema; the error text is the reason to tell the peer """
+    pass
+
+
+class FrameError(ValueError):
+    """ Stream can't be split into frames any more - the frame is too long or corrupt """
+    pass
+
+
+def encode_frame(payload: bytes, framing: Framing = Framing.LINE) -> bytes:
+    """
+    Wrap the payload into a frame
+    :param payload: encoded message or response
+    :param framing: framing to use
+    :return: frame ready to be sent to the stream
+    """
+    if framing == Framing.LENGTH:
+        return FRAME_HEADER.pack(len(payload)) + payload
+    return payload + FRAME_DELIMITER
+
+
+class FrameDecoder:
+    """
+    Incremental per-connection frame decoder: feed it whatever recv() returned
+    and iterate over it to get every complete frame; a partial tail is kept until the next feed().
+    ATTRIBUTES:
+    framing - framing in effect; may be switched between frames, is applied to the rest of the buffer
+    max_frame_len - maximum payload length of a frame
+    """
+    __slots__ = ("framing", "max_frame_len", "_buffer", "_start")
+
+    def __init__(self, framing: Framing = Framing.LINE, max_frame_len: int = sett.MAX_FRAME_LEN):
+        self.framing = Framing(framing)
+        self.max_frame_len = max_frame_len
+        self._buffer = bytearray()
+        self._start = 0                 # start of the unprocessed data in the buffer
+
+    @property
+    def pending(self) -> int:
+        """ Number of buffered bytes not yet returned as frames """
+        return len(self._buffer) - self._start
+
+    @property
+    def has_frame(self) -> bool:
+        """ True if the buffer holds at least one complete frame """
+        if self.framing == Framing.LENGTH:
+            if self.pending < FRAME_HEADER.size:
+                return False
+            length, = FRAME_HEADER.unpack_from(self._buffer, self._start)
+            return self.pending >= FRAME_HEADER.size + length
+        return self._buffer.find(FRAME_DELIMITER, self._start) >= 0
+
+    def feed(self, data: bytes):
+        self._buffer += data
+
+    def next_frame(self) -> bytes | None:
+        """
+        Cut the next complete frame from the buffer
+        :return: frame payload or None if there is no complete frame in the buffer
+        :raises FrameError: if the frame exceeds max_frame_len
+        """
+        if self.framing == Framing.LENGTH:
+            start = self._start + FRAME_HEADER.size
+            if len(self._buffer) >= start:
+                length, = FRAME_HEADER.unpack_from(self._buffer, self._start)
+                if length > self.max_frame_len:
+                    raise FrameError("Длина кадра {} превышает максимальную ({})".format(length, self.max_frame_len))
+                end = start + length
+                if len(self._buffer) >= end:
+                    self._start = end
+                    return bytes(self._buffer[start:end])
+        else:
+            end = self._buffer.find(FRAME_DELIMITER, self._start)
+            if end >= 0:
+                if end - self._start > self.max_frame_len:
+                    raise FrameError("Длина кадра {} превышает максимальную ({})".format(
+                        end - self._start, self.max_frame_len))
+                frame = bytes(self._buffer[self._start:end])
+                self._start = end + len(FRAME_DELIMITER)
+                return frame
+            if self.pending > self.max_frame_len:
+                raise FrameError("Не найден конец кадра в пределах максимальной длины ({})".format(self.max_frame_len))
+        # No complete frames left - drop the processed data at once rather than after every frame
+        del self._buffer[:self._start]
+        self._start = 0
+        return None
+
+    def __iter__(self):
+        while (frame := self.next_frame()) is not None:
+            yield frame
+
+
+class Wire(str, enum.Enum):
+    JSON = "json"               # payload is JSON text
+    BINARY = "binary"           # payload is packed as described in BINARY WIRE FORMAT, requires LENGTH framing
+
+
+BINARY_MESSAGE = 1
+BINARY_RESPONSE = 2
+BINARY_HEADERS = {BINARY_MESSAGE: struct.Struct("!BB"), BINARY_RESPONSE: struct.Struct("!BH")}
+ACTION_CODES = tuple(action.value for action in Actions)
+ACTION_INDEX = {action: code for code, action in enumerate(ACTION_CODES)}
+BINARY_KEYS = ("time", "id", "to", "from", "message", "user", "account_name", "status", "type", "framing", "wire",
+               "peer", "since", "until", "cursor", "limit", "messages", "alert", "error", "stats",
+               "node", "payload", "add", "remove", "compression")
+BINARY_KEY_INDEX = {key: code.to_bytes(1, "big") for code, key in enumerate(BINARY_KEYS)}
+BINARY_KEY_INLINE = 0xFF
+TAG_NONE, TAG_FALSE, TAG_TRUE, TAG_INT, TAG_FLOAT, TAG_STR, TAG_LIST, TAG_DICT = range(8)
+TAGGED_INT = struct.Struct("!Bq")
+TAGGED_FLOAT = struct.Struct("!Bd")
+TAGGED_LENGTH = struct.Struct("!BH")            # string length in bytes or number of items
+INT_RANGE = range(-2 ** 63, 2 ** 63)
+BINARY_MAX_DEPTH = 32                   # Maximum nesting of the lists and dictionaries packed
+BINARY_TRANSLATION_CACHE = 64           # JSON payloads translated for the binary peers kept for the broadcasts
+
+
+def _dump_value(value, parts: list, depth: int):
+    """ :param depth: nesting depth of the value, the top level fields being at 1 """
+    if value is None:
+        parts.append(b"\x00")
+    elif value is True:
+        parts.append(b"\x02")
+    elif value is False:
+        parts.append(b"\x01")
+    elif isinstance(value, int) and value in INT_RANGE:
+        parts.append(TAGGED_INT.pack(TAG_INT, value))
+    elif isinstance(value, (int, float)):
+        parts.append(TAGGED_FLOAT.pack(TAG_FLOAT, value))       # Integers beyond 64 bits as well
+    elif isinstance(value, str):
+        data = value.encode(sett.DEFAULT_ENCODING)
+        parts.append(TAGGED_LENGTH.pack(TAG_STR, len(data)))
+        parts.append(data)
+    elif depth >= BINARY_MAX_DEPTH:
+        raise ValueError("Вложенность превышает {}".format(BINARY_MAX_DEPTH))
+    elif isinstance(value, (list, tuple)):
+        parts.append(TAGGED_LENGTH.pack(TAG_LIST, len(value)))
+        for item in value:
+            _dump_value(item, parts, depth + 1)
+    elif isinstance(value, dict):
+        parts.append(TAGGED_LENGTH.pack(TAG_DICT, len(value)))
+        _dump_items(value.items(), parts, depth + 1)
+    else:
+        raise ValueError("Значение не может быть упаковано: {!r}".format(value))
+
+
+def _dump_items(items, parts: list, depth: int = 1):
+    append = parts.append
+    for key, value in items:
+        code = BINARY_KEY_INDEX.get(key)
+        if code is None:
+            data = key.encode(sett.DEFAULT_ENCODING)
+            append(TAGGED_LENGTH.pack(BINARY_KEY_INLINE, len(data)))
+            append(data)
+        else:
+            append(code)
+        # Strings and integers inline - they are most of the fields
+        if value.__class__ is str:
+            data = value.encode(sett.DEFAULT_ENCODING)
+            append(TAGGED_LENGTH.pack(TAG_STR, len(data)))
+            append(data)
+        elif value.__class__ is int and value in INT_RANGE:
+            append(TAGGED_INT.pack(TAG_INT, value))
+        else:
+            _dump_value(value, parts, depth)
+
+
+def binary_dumps(obj: dict) -> bytes:
+    """
+    Pack the message or the response (see BINARY WIRE FORMAT)
+    :raises ValueError: if it is neither or can't be packed
+    """
+    try:
+        fields = obj.copy()
+        if "action" in fields:
+            parts = [BINARY_HEADERS[BINARY_MESSAGE].pack(BINARY_MESSAGE, ACTION_INDEX[fields.pop("action")])]
+        else:
+            parts = [BINARY_HEADERS[BINARY_RESPONSE].pack(BINARY_RESPONSE, fields.pop("response"))]
+        parts.append(TAGGED_LENGTH.pack(TAG_DICT, len(fields)))
+        _dump_items(fields.items(), parts)
+    except (KeyError, TypeError, AttributeError, struct.error, RecursionError) as e:
+        raise ValueError("Сообщение не может быть упаковано: {!r}".format(e))
+    return b"".join(parts)
+
+
+def _load_value(payload: bytes, offset: int) -> (object, int):
+    """ :return: value unpacked at the offset and offset of the next one """
+    tag = payload[offset]
+    if tag == TAG_STR:
+        _, length = TAGGED_LENGTH.unpack_from(payload, offset)
+        start = offset + TAGGED_LENGTH.size
+        if start + length > len(payload):
+            raise ValueError("Строка выходит за пределы сообщения")
+        return payload[start:start + length].decode(sett.DEFAULT_ENCODING), start + length
+    if tag == TAG_INT:
+        return TAGGED_INT.unpack_from(payload, offset)[1], offset + TAGGED_INT.size
+    if tag == TAG_DICT:
+        _, count = TAGGED_LENGTH.unpack_from(payload, offset)
+        value = {}
+        return value, _load_items(payload, offset + TAGGED_LENGTH.size, count, value)
+    if tag == TAG_LIST:
+        _, count = TAGGED_LENGTH.unpack_from(payload, offset)
+        offset += TAGGED_LENGTH.size
+        value = []
+        for _ in range(count):
+            item, offset = _load_value(payload, offset)
+            value.append(item)
+        return value, offset
+    if tag == TAG_FLOAT:
+        return TAGGED_FLOAT.unpack_from(payload, offset)[1], offset + TAGGED_FLOAT.size
+    if tag <= TAG_TRUE:
+        return (None, False, True)[tag], offset + 1
+    raise ValueError("Неизвестный тип значения {}".format(tag))
+
+
+def _load_items(payload: bytes, offset: int, count: int, obj: dict) -> int:
+    """ Unpack count items at the offset to the dictionary, return offset of the data after them """
+    for _ in range(count):
+        code = payload[offset]
+        if code == BINARY_KEY_INLINE:
+            _, length = TAGGED_LENGTH.unpack_from(payload, offset)
+            offset += TAGGED_LENGTH.size
+            key = payload[offset:offset + length].decode(sett.DEFAULT_ENCODING)
+            offset += length
+        else:
+            key = BINARY_KEYS[code]
+            offset += 1
+        # Strings and integers inline - they are most of the fields
+        tag = payload[offset]
+        if tag == TAG_STR:
+            _, length = TAGGED_LENGTH.unpack_from(payload, offset)
+            offset += TAGGED_LENGTH.size
+            if offset + length > len(payload):
+                raise ValueError("Строка выходит за пределы сообщения")
+            obj[key] = payload[offset:offset + length].decode(sett.DEFAULT_ENCODING)
+            offset += length
+        elif tag == TAG_INT:
+            obj[key] = TAGGED_INT.unpack_from(payload, offset)[1]
+            offset += TAGGED_INT.size
+        else:
+            obj[key], offset = _load_value(payload, offset)
+    return offset
+
+
+def binary_loads(payload: bytes) -> dict:
+    """
+    Unpack the message or the response packed by binary_dumps
+    :raises ValueError: if the payload is corrupt
+    """
+    try:
+        kind = payload[0]
+        header = BINARY_HEADERS[kind]
+        _, code = header.unpack_from(payload)
+        obj = {"action": ACTION_CODES[code]} if kind == BINARY_MESSAGE else {"response": code}
+        offset = header.size
+        if payload[offset] != TAG_DICT:
+            raise ValueError("Ожидаются поля сообщения")
+        _, count = TAGGED_LENGTH.unpack_from(payload, offset)
+        if _load_items(payload, offset + TAGGED_LENGTH.size, count, obj) != len(payload):
+            raise ValueError("Лишние данные после сообщения")
+    except (IndexError, KeyError, struct.error, RecursionError) as e:
+        raise ValueError("Некорректное двоичное сообщение: {!r}".format(e))
+    return obj
+
+
+def _binary_response_template(response: Responses) -> (bytes, bytes, bytes):
+    """
+    Pre-pack the standard response as it is packed by Response(**response.response).binary
+    :return: packed parts of the response before the time value without and with the request id, and after it
+    """
+    header = BINARY_HEADERS[BINARY_RESPONSE].pack(BINARY_RESPONSE, response)
+    count = 1 + len(RESPONSE_TEXTS[response])
+    suffix = []
+    _dump_items(RESPONSE_TEXTS[response].items(), suffix)
+    return (header + TAGGED_LENGTH.pack(TAG_DICT, count) + BINARY_KEY_INDEX["time"],
+            header + TAGGED_LENGTH.pack(TAG_DICT, count + 1) + BINARY_KEY_INDEX["time"], b"".join(suffix))
+
+
+BINARY_RESPONSE_TEMPLATES = {response: _binary_response_template(response) for response in Responses}
+
+
+def encode_binary_response(response: Responses, timestamp: int = None, text: str = None,
+                           request_id: str | int = None) -> bytes:
+    """ Return packed response with the standard text for the response code, see encode_response """
+    if text is not None:
+        fields = {"time": timestamp if timestamp else time.time_ns(), next(iter(RESPONSE_TEXTS[response])): text}
+        if request_id is not None:
+            fields["id"] = request_id
+        return Response(response, **fields).binary
+    prefix, prefix_with_id, suffix = BINARY_RESPONSE_TEMPLATES[response]
+    if request_id is None:
+        return prefix + TAGGED_INT.pack(TAG_INT, timestamp if timestamp else time.time_ns()) + suffix
+    parts = [prefix_with_id, TAGGED_INT.pack(TAG_INT, timestamp if timestamp else time.time_ns())]
+    _dump_items((("id", request_id), ), parts)
+    parts.append(suffix)
+    return b"".join(parts)
+
+
+@functools.lru_cache(maxsize=BINARY_TRANSLATION_CACHE)
+def json_to_binary(payload: bytes) -> bytes:
+    """ Translate the JSON payload to the binary one; the last ones are cached for the broadcasts """
+    return binary_dumps(json_loads(payload))
+
+
+def binary_to_json(payload: bytes) -> bytes:
+    """ Translate the binary payload to the JSON one, to be forwarded and stored """
+    # Copied, as some orjson versions leave the whole output buffer allocated behind the bytes returned
+    return bytes(memoryview(json_dumps(binary_loads(payload))))
+
+
+def loads(payload: bytes) -> dict:
+    """ Decode the payload, JSON or binary - a JSON object starts with a brace, a binary payload never does """
+    return json_loads(payload) if payload[:1] == b"{" else binary_loads(payload)
+
+
+class Compression(str, enum.Enum):
+    NONE = "none"
+    ZLIB = "zlib"               # deflate with COMPRESSION_DICTIONARY, see COMPRESSION, requires LENGTH framing
+
+
+COMPRESSED_RAW = b"\x00"
+COMPRESSED_STREAM = b"\x01"
+COMPRESSED_SHARED = b"\x02"
+COMPRESSED_SHARED_CACHE = 64            # Broadcast payloads compressed once for all the recipients
+INFLATE_WINDOW_BITS = 15                # Any peer window size is accepted
+# Typical payloads, compact and spaced JSON alike, the most frequent ones last - deflate encodes the matches
+# closer to the end shorter. Both peers must have the same dictionary, so it is never changed:
+# another dictionary takes another Compression value.
+COMPRESSION_DICTIONARY = (
+    b'{"action":"presence","time":1700000000000000000,"type":"status","user":{"account_name":"","status":"Online"},'
+    b'"framing":"length","wire":"json","compression":"zlib"}'
+    b'{"action": "presence", "time": 1700000000000000000, "type": "status", '
+    b'"user": {"account_name": "", "status": "Online"}, "framing": "length", "wire": "json", "compression": "zlib"}'
+    b'{"action": "history", "time": 1700000000000000000, "id": 1, "peer": "", "cursor": "", "limit": 100}'
+    b'{"action": "stats", "time": 1700000000000000000, "id": 1}{"action": "probe", "time": 1700000000000000000}'
+    b'{"response": 400, "time": 1700000000000000000, "id": 1, "error": "'
+    b'{"response":200,"time":1700000000000000000,"alert":"OK","messages":[{"action":"msg","time":1700000000000000000,'
+    b'"to":"","from":"","message":""}],"cursor":""}'
+    b'{"response": 200, "time": 1700000000000000000, "id": 1, "alert": "OK"}'
+    b'{"action":"msg","time":1700000000000000000,"id":1,"to":"all","from":"","message":"'
+    b'{"action": "msg", "time": 1700000000000000000, "id": 1, "to": "all", "from": "", "message": "'
+)
+
+
+def _deflater():
+    return zlib.compressobj(sett.COMPRESSION_LEVEL, zlib.DEFLATED, -sett.COMPRESSION_WINDOW_BITS,
+                            sett.COMPRESSION_MEM_LEVEL, zdict=COMPRESSION_DICTIONARY)
+
+
+def _inflater():
+    return zlib.decompressobj(-INFLATE_WINDOW_BITS, zdict=COMPRESSION_DICTIONARY)
+
+
+def _inflate(inflater, data: bytes) -> bytes:
+    """ Decompress the data without letting it grow beyond the maximum frame """
+    try:
+        payload = inflater.decompress(data, sett.MAX_FRAME_LEN)
+    except zlib.error as e:
+        raise FrameError("Некорректные сжатые данные: {}".format(e))
+    if inflater.unconsumed_tail:
+        raise FrameError("Длина распакованного кадра превышает максимальную ({})".format(sett.MAX_FRAME_LEN))
+    return payload
+
+
+@functools.lru_cache(maxsize=COMPRESSED_SHARED_CACHE)
+def compress_shared(payload: bytes) -> bytes:
+    """ Compress the payload on its own, see COMPRESSION; the last ones are cached for the broadcasts """
+    deflater = _deflater()
+    return COMPRESSED_SHARED + deflater.compress(payload) + deflater.flush()
+
+
+class StreamCompressor:
+    """
+    Compression state of a connection, see COMPRESSION.
+    The streams are created at the first payload long enough to be compressed,
+    so the connections exchanging short messages only don't hold their buffers.
+    ATTRIBUTES:
+    threshold - payloads shorter than this are sent uncompressed
+    deflater - stream of the payloads sent, None until the first one compressed
+    inflater - stream of the payloads received, None until the first one compressed
+    """
+    __slots__ = ("threshold", "deflater", "inflater")
+
+    def __init__(self, threshold: int = None):
+        """ :param threshold: COMPRESSION_THRESHOLD if not specified """
+        self.threshold = threshold if threshold is not None else sett.COMPRESSION_THRESHOLD
+        self.deflater = None
+        self.inflater = None
+
+    def compress(self, payload: bytes, shared: bool = False) -> bytes:
+        """
+        :param shared: the same payload is sent to many peers - compress it on its own, once for all of them
+        :return: compressed payload with its flag byte
+        """
+        if len(payload) < self.threshold:
+            return COMPRESSED_RAW + payload
+        if shared:
+            return compress_shared(payload)
+        if self.deflater is None:
+            self.deflater = _deflater()
+        return COMPRESSED_STREAM + self.deflater.compress(payload) + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+
+    def decompress(self, data: bytes) -> bytes:
+        """
+        :param data: compressed payload with its flag byte
+        :raises FrameError: if the data is corrupt - the stream can't be decompressed any more
+        """
+        flag = data[:1]
+        if flag == COMPRESSED_RAW:
+            return data[1:]
+        if flag == COMPRESSED_STREAM:
+            if self.inflater is None:
+                self.inflater = _inflater()
+            return _inflate(self.inflater, data[1:])
+        if flag == COMPRESSED_SHARED:
+            inflater = _inflater()
+            payload = _inflate(inflater, data[1:])
+            if not inflater.eof:
+                raise FrameError("Неполные сжатые данные")
+            return payload
+        raise FrameError("Неизвестный признак сжатия: {!r}".format(flag))
+
+
 # ATTRIBUTES:
 # _action - message action
 # _time - UNIX timestamp passed to initializer or timestamp of the moment the Message object was created
 # _kwargs - other arguments dictionary
 class Message:
+    __slots__ = ("action", "time", "kwargs")
+
     def __init__(self, action: Actions, **kwargs):
         self.action = Actions(action)
         self.time = kwargs.get("time")
@@ -94,11 +837,33 @@ class Message:
             self.time = time.time_ns()
         self.kwargs = kwargs
 
+    # class object constructor from decoded JSON; raises ValidationError if it doesn't match the schema
+    @classmethod
+    def from_dict(cls, message: dict):
+        if not isinstance(message, dict):
+            raise ValidationError("Ожидается JSON-объект")
+        reason = validate_message(message)
+        if reason:
+            raise ValidationError(reason)
+        try:
+            return cls(**message)
+        except TypeError as e:              # No action or not string keys
+            raise ValueError(e)
+
     # class object constructor from JSON string
     @classmethod
     def from_str(cls, json_str: str):
-        message = json.loads(json_str)
-        return cls(**message)
+        return cls.from_dict(json_loads(json_str))
+
+    # class object constructor from encoded JSON
+    @classmethod
+    def from_bytes(cls, json_bytes: bytes):
+        return cls.from_dict(json_loads(json_bytes))
+
+    # class object constructor from binary payload
+    @classmethod
+    def from_binary(cls, payload: bytes):
+        return cls.from_dict(binary_loads(payload))
 
     # return JSON string with the message
     @property
@@ -110,12 +875,68 @@ class Message:
         message.update(**self.kwargs)
         return json.dumps(message)
 
+    # return encoded JSON with the message, serialized by the JSON backend
+    @property
+    def encoded(self) -> bytes:
+        message = {
+            "action": self.action.value,
+            "time": self.time
+        }
+        message.update(self.kwargs)
+        return json_dumps(message)
+
+    # return binary payload with the message
+    @property
+    def binary(self) -> bytes:
+        message = {
+            "action": self.action.value,
+            "time": self.time
+        }
+        message.update(self.kwargs)
+        return binary_dumps(message)
+
+
+class MessageView:
+    """
+    Lazy view of a decoded message for the server: the message is validated, but only the fields
+    it is routed by are looked up, and the Message object is only built if asked for.
+    The message itself is forwarded as the payload received, never encoded again.
+    ATTRIBUTES:
+    action - message action
+    fields - decoded message, "action" included
+    """
+    __slots__ = ("action", "fields")
+
+    def __init__(self, fields: dict):
+        """ :raises ValidationError: if the message doesn't match the schema of its action """
+        if not isinstance(fields, dict):
+            raise ValidationError("Ожидается JSON-объект")
+        reason = validate_message(fields)
+        if reason:
+            raise ValidationError(reason)
+        self.action = ACTIONS_BY_VALUE[fields["action"]]
+        self.fields = fields
+
+    @property
+    def to(self) -> str | None:
+        return self.fields.get("to")
+
+    @property
+    def request_id(self) -> str | int | None:
+        return self.fields.get("id")
+
+    @property
+    def message(self) -> Message:
+        return Message(**self.fields)
+
 
 # ATTRIBUTES:
 # _action - message action
 # _time - UNIX timestamp passed to initializer or timestamp of the moment the Message object was created
 # _kwargs - other arguments dictionary
 class Response:
+    __slots__ = ("response", "time", "kwargs")
+
     def __init__(self, response: Responses, **kwargs):
         self.response = Responses(response)
         self.time = kwargs.get("time")
@@ -123,11 +944,33 @@ class Response:
             self.time = time.time_ns()
         self.kwargs = kwargs
 
+    # class object constructor from decoded JSON; raises ValidationError if it doesn't match the schema
+    @classmethod
+    def from_dict(cls, response: dict):
+        if not isinstance(response, dict):
+            raise ValidationError("Ожидается JSON-объект")
+        reason = validate_response(response)
+        if reason:
+            raise ValidationError(reason)
+        try:
+            return cls(**response)
+        except TypeError as e:              # No response code or not string keys
+            raise ValueError(e)
+
     # class object constructor from JSON string
     @classmethod
     def from_str(cls, json_str: str):
-        response = json.loads(json_str)
-        return cls(**response)
+        return cls.from_dict(json_loads(json_str))
+
+    # class object constructor from encoded JSON
+    @classmethod
+    def from_bytes(cls, json_bytes: bytes):
+        return cls.from_dict(json_loads(json_bytes))
+
+    # class object constructor from binary payload
+    @classmethod
+    def from_binary(cls, payload: bytes):
+        return cls.from_dict(binary_loads(payload))
 
     # return JSON string with the response
     @property
@@ -139,66 +982,217 @@ class Response:
         response.update(**self.kwargs)
         return json.dumps(response)
 
+    # return encoded JSON with the response, serialized by the JSON backend
+    @property
+    def encoded(self) -> bytes:
+        response = {
+            "response": self.response.value,
+            "time": self.time
+        }
+        response.update(self.kwargs)
+        return json_dumps(response)
+
+    # return binary payload with the response
+    @property
+    def binary(self) -> bytes:
+        response = {
+            "response": self.response.value,
+            "time": self.time
+        }
+        response.update(self.kwargs)
+        return binary_dumps(response)
+
+
+def null_logger() -> logging.Logger:
+    """ Return the logger DEFAULT_LOGGER_NAME, adding its handler once rather than for every Chat """
+    logger = logging.getLogger(DEFAULT_LOGGER_NAME)
+    if not logger.handlers:
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+    return logger
+
 
 class Chat:
     """
     ATTRIBUTES:
     log - python logger to write log messages to (not used yet)
     error_str - error string of the last unsuccessful chat operation
+    error_reason - reason of the last error to tell the peer instead of the standard response text, if any
+    action - action of the last processed message, None if the message couldn't be parsed
+    account_name - peer account name given at PRESENCE
+    framing - framing negotiated with the peer
+    wire - wire format negotiated with the peer
+    wire_in_effect - wire format of the payloads being exchanged, switched to the negotiated one like the framing
+    compression - compression negotiated with the peer
+    compressor - compression state of the connection once the compression is in effect, None before that
+    history_request - fields of the last HISTORY message processed, to be served by the server
+    request_id - id of the last message processed, None if it had none
+    decoder - frame decoder of the incoming stream
     """
+    __slots__ = ("log", "error_str", "error_reason", "action", "account_name", "framing", "wire", "wire_in_effect",
+                 "compression", "compressor", "history_request", "request_id", "decoder")
+
     def __init__(self, logger: logging.Logger = None):
         """
-        :param logger: logger to log messages to; if None, creates a logger DEFAULT_LOGGER_NAME
+        :param logger: logger to log messages to; if None, the logger DEFAULT_LOGGER_NAME
         with logger.NullHandler as handler without propagating messages to the root logger
         """
-        self.log = logger
-        if not logger:
-            self.log = logging.getLogger(DEFAULT_LOGGER_NAME)
-            self.log.addHandler(logging.NullHandler())
-            self.log.propagate = False
+        self.log = logger if logger else null_logger()
         self.error_str = None
+        self.error_reason = None
+        self.action = None
+        self.account_name = None
+        self.framing = Framing(sett.DEFAULT_FRAMING)
+        self.wire = self.wire_in_effect = Wire.JSON
+        self.compression = Compression.NONE
+        self.compressor = None
+        self.history_request = None
+        self.request_id = None
+        self.decoder = FrameDecoder(self.framing)
 
-    def process_message(self, message_str: str) -> (bool, str):
+    def _process_message(self, message_json: str | bytes) -> (bool, Responses, list):
         """
         Process the message passed
-        :param message_str: message to process
-        :return: success status and message string to return to user;
-        if it is a MESSAGE to other user(s) or group(s), return list of users to forward message to;
-        if status is False, error_str attribute contains error message.
+        :param message_json: message to process, JSON string or encoded JSON, or binary payload
+        :return: success status, code of the response to return to user and list of users to forward message to;
+        see process_message
         """
         status = False                                  # Prepare for worse
-        response = ""
+        response = Responses.BAD_REQUEST
         forward_list = None
         self.error_str = ""
+        self.error_reason = None
+        self.action = None
+        self.request_id = None
+        if len(message_json) > sett.MAX_MESSAGE_LEN:
+            # Don't spend time parsing whatever a hostile client may have sent
+            self.error_reason = "Длина сообщения превышает {}".format(sett.MAX_MESSAGE_LEN)
+            self.error_str = "Некорректный запрос ({}): {}...".format(self.error_reason, message_json[:100])
+            return status, response, forward_list
         try:
-            message = Message.from_str(message_str)
-        except ValueError as e:
-            self.error_str = "Некорректный запрос ({}): {}".format(e, message_str)
-            response = Response(**Responses.BAD_REQUEST.response).json
+            obj = binary_loads(message_json) if self.wire_in_effect == Wire.BINARY else json_loads(message_json)
+            message = MessageView(obj)
+        except ValidationError as e:
+            self.error_reason = str(e)
+            if isinstance(obj, dict) and not validate_request_id(obj):
+                self.request_id = obj.get("id")         # Let the client tell which request has been rejected
+            self.error_str = "Некорректный запрос ({}): {}".format(e, message_json)
+        except (ValueError, RecursionError) as e:      # The standard library json recurses into nested arrays
+            self.error_str = "Некорректный запрос ({}): {}".format(e, message_json)
         else:
+            self.action = message.action
+            self.request_id = message.request_id
             if message.action == Actions.PRESENCE:
-                response = Response(**Responses.OK.response).json
-                status = True
-            elif message.action == Actions.MESSAGE:
-                response = Response(**Responses.OK.response).json
+                user = message.fields.get("user")
                 try:
-                    forward_list = [message.kwargs["to"], ]
-                except KeyError:
-                    self.error_str = "Отсутствует поле адресата сообщения: {}".format(message_str)
-                    response = Response(**Responses.BAD_REQUEST.response).json
+                    framing = Framing(message.fields.get("framing", self.framing))
+                    wire = Wire(message.fields.get("wire", self.wire))
+                    compression = Compression(message.fields.get("compression", self.compression))
+                except ValueError:
+                    self.error_str = "Неподдерживаемый формат кадров, сообщений или сжатия: {}".format(message_json)
                 else:
-                    status = True
+                    if framing != Framing.LENGTH and (wire == Wire.BINARY or compression != Compression.NONE):
+                        self.error_reason = "{} требует кадров '{}'".format(
+                            "Двоичный формат сообщений" if wire == Wire.BINARY else "Сжатие", Framing.LENGTH.value)
+                        self.error_str = "Некорректный запрос ({}): {}".format(self.error_reason, message_json)
+                    else:
+                        self.framing = framing
+                        self.wire = wire
+                        self.compression = compression
+                        self.account_name = user.get("account_name") if isinstance(user, dict) else None
+                        response = Responses.OK
+                        status = True
+            elif message.action == Actions.MESSAGE:
+                forward_list = [message.to, ]          # Required by the schema
+                response = Responses.OK
+                status = True
+            elif message.action == Actions.HISTORY:
+                self.history_request = message.fields
+                response = Responses.OK
+                status = True
+            elif message.action in (Actions.QUIT, Actions.STATS):
+                response = Responses.OK
+                status = True
             else:
-                self.error_str = "Неподдерживаемый запрос ({}): {}".format(message.action, message_str)
-                response = Response(**Responses.BAD_REQUEST.response).json
+                self.error_str = "Неподдерживаемый запрос ({}): {}".format(message.action, message_json)
         return status, response, forward_list
 
+    def process_message(self, message_str: str) -> (bool, str):
+        """
+        Process the message passed
+        :param message_str: message to process
+        :return: success status and message string to return to user;
+        if it is a MESSAGE to other user(s) or group(s), return list of users to forward message to;
+        if it is a successful QUIT, the connection is to be closed after the response is sent;
+        if status is False, error_str attribute contains error message.
+        """
+        status, response, forward_list = self._process_message(message_str)
+        return status, self.encode_response(response, self.error_reason).decode(sett.DEFAULT_ENCODING), forward_list
+
     def process_encoded_message(self, message_bytes: bytes) -> (bool, bytes):
         """
-        Decodes and encodes message before processing it.
-        :param message_bytes: message to decode and send for processing
+        Process encoded message as is - the JSON backend parses bytes without decoding them to str first.
+        :param message_bytes: message to process
         :return: result of processing the message in encoded form
         """
-        message_str = message_bytes.decode(sett.DEFAULT_ENCODING)
-        success, response, forward_list = self.process_message(message_str)
-        return success, response.encode(sett.DEFAULT_ENCODING), forward_list
+        status, response, forward_list = self._process_message(message_bytes)
+        return status, self.encode_response(response, self.error_reason), forward_list
+
+    def encode_response(self, response: Responses, text: str = None) -> bytes:
+        """
+        Encode the response to the last message processed in the wire format in effect, echoing its request id
+        :param response: response code
+        :param text: response text instead of the standard one
+        """
+        if self.wire_in_effect == Wire.BINARY:
+            return encode_binary_response(response, text=text, request_id=self.request_id)
+        return encode_response(response, text=text, request_id=self.request_id)
+
+    def process_data(self, data: bytes):
+        """
+        Feed data received from the peer to the frame decoder and process every complete frame.
+        Framing, wire format and compression negotiated by a frame take effect once its result has been consumed.
+        :param data: data received from the peer
+        :return: generator of (success, response, forward_list, message) tuples, where the first three items
+        are the results of process_encoded_message and message is the unframed message itself,
+        encoded JSON of it for the binary peer if it is to be forwarded
+        :raises FrameError: if the stream can't be split into frames or decompressed
+        """
+        self.decoder.feed(data)
+        for message_bytes in self.decoder:
+            if self.compressor:
+                message_bytes = self.compressor.decompress(message_bytes)
+            success, response, forward_list = self.process_encoded_message(message_bytes)
+            if forward_list and self.wire_in_effect == Wire.BINARY:
+                message_bytes = binary_to_json(message_bytes)       # Forwarded and stored as JSON
+            yield success, response, forward_list, message_bytes
+            self.apply_negotiation()
+
+    def apply_negotiation(self):
+        """
+        Put the framing, wire format and compression negotiated into effect. process_data does it once the result
+        of the frame is consumed; a server framing for the peer from several threads does it along with sending
+        the response, so that no other thread frames anything in between.
+        """
+        self.decoder.framing = self.framing
+        self.wire_in_effect = self.wire
+        if self.compression == Compression.NONE:
+            self.compressor = None
+        elif self.compressor is None:
+            self.compressor = StreamCompressor()
+
+    def frame(self, payload: bytes, shared: bool = False) -> bytes:
+        """
+        Wrap the payload into a frame to be sent to the peer, translating JSON to the binary wire format in effect
+        and compressing it if the compression is in effect. The compressed frames must be sent in the order
+        they have been made in.
+        :raises ValueError: if the payload can't be translated to the binary wire format, e.g. is nested too deep
+        :param payload: encoded message or response
+        :param shared: the same payload is framed for many peers, e.g. a broadcast - compress it once for all of them
+        :return: frame in the framing currently in effect
+        """
+        if self.wire_in_effect == Wire.BINARY and payload[:1] == b"{":
+            payload = json_to_binary(payload)
+        if self.compressor:
+            payload = self.compressor.compress(payload, shared)
+        return encode_frame(payload, self.decoder.framing)
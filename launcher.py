@@ -0,0 +1,100 @@
+import os
+import sys
+import asyncio
+import argparse
+import logging
+import tempfile
+
+import settings as sett
+import bus
+import server_log_config
+
+"""
+Multi-process JIM server.
+Starts a number of server_asyncio.py worker processes sharing the server port with SO_REUSEPORT,
+so that the kernel balances the client connections among them and every worker parses and forwards
+the messages of its clients on its own core. The workers are connected to each other by the bus (see bus.py)
+run by the launcher: it keeps the account index consistent across the workers and relays the messages
+for the clients of other workers.
+"""
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server_asyncio.py")
+
+
+class Launcher:
+    """
+    ATTRIBUTES:
+    address - server address
+    port - server port
+    workers - number of worker processes
+    bus_path - Unix socket path of the bus hub
+    hub - bus hub
+    processes - worker processes
+    """
+    def __init__(self, address: str = None, port: int = None, workers: int = None, bus_path: str = None):
+        """
+        If any of the parameters are not specified, defaults are used.
+        """
+        self.address = address
+        self.port = port if port else sett.DEFAULT_PORT
+        self.workers = workers if workers else sett.CLUSTER_WORKERS
+        self.bus_path = bus_path if bus_path else os.path.join(tempfile.mkdtemp(prefix="jim-"), "bus.sock")
+        self.hub = bus.BusHub(self.bus_path)
+        self.processes = []
+
+    async def _run_worker(self, number: int):
+        """ Start the worker process and wait for it to exit """
+        args = [WORKER_SCRIPT, "-port", str(self.port), "-bus", self.bus_path]
+        if self.address:
+            args += ["-address", self.address]
+        process = await asyncio.create_subprocess_exec(sys.executable, *args)
+        self.processes.append(process)
+        log.info("Процесс %d (pid %d) запущен.", number, process.pid)
+        code = await process.wait()
+        log.critical("Процесс %d (pid %d) завершился с кодом %d.", number, process.pid, code)
+
+    async def run(self):
+        """ Run the bus hub and the workers until all the workers exit or the launcher is cancelled """
+        try:
+            hub_server = await self.hub.start()
+        except OSError as e:
+            log.critical("Ошибка запуска шины %s: %s", self.bus_path, e)
+            return
+        log.critical("Запуск %d процессов сервера на порту %d, шина %s.", self.workers, self.port, self.bus_path)
+        try:
+            await asyncio.gather(*(self._run_worker(number) for number in range(self.workers)))
+        finally:
+            for process in self.processes:
+                if process.returncode is None:
+                    process.terminate()
+            for process in self.processes:
+                await process.wait()
+            hub_server.close()
+            try:
+                os.unlink(self.bus_path)
+            except OSError:
+                pass
+
+
+def main():
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-address', required=False)
+    parser.add_argument('-port', required=False, type=int)
+    parser.add_argument('-workers', required=False, type=int, help="number of worker processes")
+    parser.add_argument('-bus', required=False, help="bus hub socket path")
+    args = parser.parse_args()
+    launcher = Launcher(args.address, args.port, args.workers, args.bus)
+    try:
+        asyncio.run(launcher.run())
+    except KeyboardInterrupt:
+        log.critical("Завершение работы сервера по прерыванию пользователя.")
+
+
+if __name__ == "__main__":
+    print("")
+    # Get logger object
+    log = logging.getLogger(sett.SERVER_LOG_NAME)
+    # Call main()
+    main()
+    print("")
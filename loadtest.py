@@ -0,0 +1,306 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import platform
+import subprocess
+
+import settings as sett
+import jim
+import client_asyncio
+
+"""
+Load generator for the JIM servers.
+Starts a server engine script (server_select.py, server_threads.py, server_asyncio.py, ...) on a local port,
+connects N simulated clients, introduces every one of them with PRESENCE and makes each send a number of messages,
+a configurable share of which is broadcast, the rest are sent to a random other client. Reports message rate,
+round-trip latency of the requests, fanout latency of the delivered messages (measured from their "time" field),
+connection setup rate, server CPU time and memory per connection. The report may be saved as JSON
+to be compared between releases; the random seed makes the load itself reproducible.
+"""
+
+
+def percentiles(values: list, quantiles: tuple = (0.5, 0.95, 0.99)) -> dict:
+    """ Return {"p50": ..., ...} for the values, None for each if there are no values """
+    values = sorted(values)
+    return {"p{}".format(round(q * 100)): values[round(q * (len(values) - 1))] if values else None
+            for q in quantiles}
+
+
+def process_stats(pid: int) -> dict | None:
+    """
+    Read CPU time and resident memory of a process from /proc
+    :return: {"cpu": seconds, "rss": bytes} or None if not available on this platform
+    """
+    try:
+        with open("/proc/{}/stat".format(pid)) as stat_file:
+            stat = stat_file.read().rsplit(")", 1)[1].split()
+        with open("/proc/{}/statm".format(pid)) as statm_file:
+            rss_pages = int(statm_file.read().split()[1])
+    except OSError:
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    return {"cpu": (int(stat[11]) + int(stat[12])) / ticks, "rss": rss_pages * os.sysconf("SC_PAGE_SIZE")}
+
+
+def raise_open_files_limit():
+    """ Raise the soft limit of open file descriptors up to the hard one - every client is a socket """
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass
+
+
+class LoadClient(client_asyncio.AsyncClient):
+    """
+    Simulated JIM client
+    ATTRIBUTES:
+    round_trips - round-trip times of the messages sent, ns
+    fanouts - delivery latencies of the messages received from other clients, ns
+    errors - number of error responses
+    """
+    def __init__(self, account_name: str, address: str, port: int, window: int = 1, wire: str = None,
+                 compression: str = None):
+        super().__init__(account_name, address, port, window=window, wire=wire, compression=compression)
+        self.round_trips = []
+        self.fanouts = []
+        self.errors = 0
+        self._receiver_task = None
+
+    async def connect(self) -> jim.Response:
+        response = await super().connect()
+        self._receiver_task = asyncio.create_task(self._receive())
+        return response
+
+    async def _receive(self):
+        async for message in self:
+            self.fanouts.append(time.time_ns() - message.time)
+
+    async def timed_request(self, message: jim.Message) -> jim.Response:
+        """ Send the message, wait for the response and record the round trip """
+        sent = time.time_ns()
+        response = await self.request(message)
+        self.round_trips.append(time.time_ns() - sent)
+        if response.response != jim.Responses.OK:
+            self.errors += 1
+        return response
+
+    async def close(self, quit_message: bool = False):
+        await super().close(quit_message)
+        if self._receiver_task:
+            await asyncio.gather(self._receiver_task, return_exceptions=True)
+
+
+class LoadTest:
+    """
+    ATTRIBUTES:
+    address, port - server to load
+    clients - number of clients
+    messages - number of messages every client sends
+    broadcast - share of broadcast messages
+    text_len - message text length
+    rng - random generator making the load reproducible
+    window - number of the requests every client keeps outstanding
+    wire - wire format of the clients
+    compression - compression of the clients
+    """
+    def __init__(self, address: str, port: int, clients: int, messages: int, broadcast: float, text_len: int,
+                 seed: int, window: int = 1, wire: str = None, compression: str = None):
+        self.address = address
+        self.port = port
+        self.clients = clients
+        self.messages = messages
+        self.broadcast = broadcast
+        self.text_len = text_len
+        self.rng = random.Random(seed)
+        self.window = window
+        self.wire = wire
+        self.compression = compression
+
+    async def _send_messages(self, client: LoadClient, recipients: list):
+        """ Send the messages to the recipients keeping up to window of them outstanding """
+        text = "x" * self.text_len
+        recipients = iter(recipients)
+
+        async def send():
+            for recipient in recipients:
+                await client.timed_request(jim.Message(jim.Actions.MESSAGE, to=recipient, message=text,
+                                                       **{"from": client.account_name}))
+
+        await asyncio.gather(*(send() for _ in range(self.window)))
+
+    async def run(self, server_pid: int = None) -> dict:
+        result = {}
+        stats_before = process_stats(server_pid) if server_pid else None
+        # Connect and introduce the clients
+        clients = [LoadClient("load{}".format(i), self.address, self.port, self.window, self.wire, self.compression)
+                   for i in range(self.clients)]
+        start = time.perf_counter()
+        introduced = await asyncio.gather(*(client.connect() for client in clients), return_exceptions=True)
+        setup_time = time.perf_counter() - start
+        clients = [client for client, response in zip(clients, introduced)
+                   if isinstance(response, jim.Response) and response.response == jim.Responses.OK]
+        result["connections"] = len(clients)
+        result["connections_failed"] = self.clients - len(clients)
+        result["connection_rate"] = len(clients) / setup_time
+        stats_idle = process_stats(server_pid) if server_pid else None
+        if stats_before and stats_idle and clients:
+            result["rss_per_connection"] = (stats_idle["rss"] - stats_before["rss"]) / len(clients)
+        if len(clients) < 2:
+            return result
+
+        # Plan the load before starting it to keep the random sequence independent of timing
+        names = [client.account_name for client in clients]
+        plans = []
+        expected_deliveries = 0
+        for client in clients:
+            recipients = []
+            for _ in range(self.messages):
+                if self.rng.random() < self.broadcast:
+                    recipients.append(jim.BROADCAST_RECIPIENT)
+                    expected_deliveries += len(clients) - 1
+                else:
+                    recipients.append(self.rng.choice([name for name in names if name != client.account_name]))
+                    expected_deliveries += 1
+            plans.append(recipients)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(self._send_messages(client, plan) for client, plan in zip(clients, plans)))
+        send_time = time.perf_counter() - start
+        # Give the server some time to deliver the rest of the messages
+        deadline = time.perf_counter() + sett.LOADTEST_DELIVERY_TIMEOUT
+        while sum(len(client.fanouts) for client in clients) < expected_deliveries \
+                and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        stats_after = process_stats(server_pid) if server_pid else None
+
+        round_trips = [rtt for client in clients for rtt in client.round_trips]
+        fanouts = [latency for client in clients for latency in client.fanouts]
+        result["messages"] = len(round_trips)
+        result["errors"] = sum(client.errors for client in clients)
+        result["messages_per_second"] = len(round_trips) / send_time
+        result["deliveries"] = len(fanouts)
+        result["deliveries_expected"] = expected_deliveries
+        result["deliveries_per_second"] = len(fanouts) / (time.perf_counter() - start)
+        result["round_trip_us"] = {key: value / 1000 if value is not None else None
+                                   for key, value in percentiles(round_trips).items()}
+        result["fanout_us"] = {key: value / 1000 if value is not None else None
+                               for key, value in percentiles(fanouts).items()}
+        if stats_idle and stats_after:
+            result["server_cpu_seconds"] = stats_after["cpu"] - stats_idle["cpu"]
+            result["server_cpu_us_per_message"] = result["server_cpu_seconds"] * 1e6 / max(len(round_trips), 1)
+            result["server_rss"] = stats_after["rss"]
+        await asyncio.gather(*(client.close() for client in clients))
+        return result
+
+
+def start_server(script: str, port: int, *arguments: str, cwd: str = None) -> subprocess.Popen:
+    """
+    Start the server engine script on the port and wait until it accepts connections
+    :param arguments: more command line arguments of the script, e.g. "-mode", "pool"
+    :param cwd: directory to run the server in, the current one if not specified: its logs, history
+    and offline store are written there
+    """
+    os.makedirs(os.path.join(cwd if cwd else os.curdir, sett.LOG_DIRECTORY), exist_ok=True)
+    server = subprocess.Popen([sys.executable, os.path.abspath(script), "-port", str(port), *arguments], cwd=cwd,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + sett.LOADTEST_SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("Сервер {} завершился с кодом {}".format(script, server.returncode))
+        try:
+            socket.create_connection((sett.DEFAULT_SERVER_ADDRESS, port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("Сервер {} не принимает соединения".format(script))
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report: dict):
+    print("Сервер: {server}, клиентов: {clients}, сообщений на клиента: {messages}, "
+          "доля рассылок: {broadcast}, окно запросов: {window}, формат: {wire}, "
+          "сжатие: {compression}".format(**report["parameters"]))
+    for key, value in report["result"].items():
+        if isinstance(value, dict):
+            value = ", ".join("{} {:.0f}".format(k, v) if v is not None else "{} -".format(k)
+                              for k, v in value.items())
+        elif isinstance(value, float):
+            value = "{:.2f}".format(value)
+        print("  {:<28} {}".format(key, value))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JIM server load test")
+    parser.add_argument('-server', default="server_select.py", help="server engine script to start")
+    parser.add_argument('-address', default=None, help="load a running server instead of starting one")
+    parser.add_argument('-port', type=int, default=sett.LOADTEST_PORT)
+    parser.add_argument('-clients', type=int, default=50)
+    parser.add_argument('-messages', type=int, default=100, help="messages per client")
+    parser.add_argument('-broadcast', type=float, default=0.1, help="share of broadcast messages")
+    parser.add_argument('-text', type=int, default=100, help="message text length")
+    parser.add_argument('-seed', type=int, default=1)
+    parser.add_argument('-window', type=int, default=1, help="requests every client keeps outstanding")
+    parser.add_argument('-wire', default=sett.CLIENT_WIRE, choices=[wire.value for wire in jim.Wire])
+    parser.add_argument('-compression', default=sett.CLIENT_COMPRESSION,
+                        choices=[compression.value for compression in jim.Compression])
+    parser.add_argument('-report', default=None, help="JSON file to save the report to")
+    args = parser.parse_args()
+    raise_open_files_limit()
+
+    server = None if args.address else start_server(args.server, args.port)
+    try:
+        test = LoadTest(args.address if args.address else sett.DEFAULT_SERVER_ADDRESS, args.port,
+                        args.clients, args.messages, args.broadcast, args.text, args.seed, args.window, args.wire,
+                        args.compression)
+        result = asyncio.run(test.run(server.pid if server else None))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+    report = {
+        "parameters": {
+            "server": args.address if args.address else args.server,
+            "clients": args.clients,
+            "messages": args.messages,
+            "broadcast": args.broadcast,
+            "text": args.text,
+            "seed": args.seed,
+            "window": args.window,
+            "wire": args.wire,
+            "compression": args.compression,
+        },
+        "environment": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "json_backend": jim.JSON_BACKEND,
+            "cpus": os.cpu_count(),
+        },
+        "result": result,
+    }
+    print_report(report)
+    if args.report:
+        with open(args.report, "w") as report_file:
+            json.dump(report, report_file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import os
+import time
+import bisect
+import logging
+import threading
+from collections import Counter
+
+import settings as sett
+import jim
+
+"""
+Server metrics: counters, gauges and latency histograms kept in plain in-process structures,
+so that updating them on the hot path costs a dictionary or list increment.
+The metrics are read with the STATS action (see jim.py) by the accounts listed in SERVER_ADMIN_ACCOUNTS
+connected from the addresses listed in SERVER_ADMIN_ADDRESSES, and may be written to a snapshot file
+periodically by SnapshotWriter.
+Updates take no locks: when several threads of the threads server update the same counter at once,
+an increment may be lost now and then, which is fine for monitoring.
+"""
+
+LATENCY_BOUNDS_US = tuple(2 ** power for power in range(24))    # Histogram bucket upper bounds: 1 us ... 8 s
+
+log = logging.getLogger(sett.SERVER_LOG_NAME)
+
+
+class Histogram:
+    """
+    Histogram with fixed buckets
+    ATTRIBUTES:
+    bounds - bucket upper bounds, ascending; values above the last one go to the overflow bucket
+    counts - number of values in every bucket, the overflow bucket being the last one
+    count - number of values
+    total - sum of the values
+    """
+    __slots__ = ("bounds", "counts", "count", "total")
+
+    def __init__(self, bounds: tuple = LATENCY_BOUNDS_US):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+
+    def observe(self, value: int | float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, quantile: float) -> int | float | None:
+        """ Return upper bound of the bucket the quantile falls into, None if there are no values """
+        if not self.count:
+            return None
+        rank = quantile * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.bounds[-1]                  # In the overflow bucket - at least the last bound
+
+    def snapshot(self) -> dict:
+        return {"count": self.count, "mean": round(self.total / self.count) if self.count else None,
+                "p50": self.percentile(0.5), "p95": self.percentile(0.95), "p99": self.percentile(0.99)}
+
+
+class Metrics:
+    """
+    Metrics of a server
+    ATTRIBUTES:
+    counters - counter values with names as keys
+    histograms - latency histograms (microseconds) with names as keys
+    gauges - functions returning current values with names as keys, called when a snapshot is taken
+    started - server start time
+    """
+    def __init__(self):
+        self.counters = Counter()
+        self.histograms = {}
+        self.gauges = {}
+        self.started = time.time()
+
+    def count(self, name: str, value: int = 1):
+        self.counters[name] += value
+
+    def count_message(self, chat: jim.Chat, success: bool):
+        """ Count the message the chat has just processed by its action """
+        self.count("messages_" + chat.action.value if success else "bad_requests")
+
+    def observe(self, name: str, started_ns: int):
+        """ Add the time elapsed since started_ns (perf_counter_ns()) to the histogram """
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe((time.perf_counter_ns() - started_ns) // 1000)
+
+    def gauge(self, name: str, function):
+        self.gauges[name] = function
+
+    def snapshot(self) -> dict:
+        return {
+            "time": time.time_ns(),
+            "uptime": round(time.time() - self.started),
+            "counters": dict(self.counters),
+            "gauges": {name: function() for name, function in self.gauges.items()},
+            "latency_us": {name: histogram.snapshot() for name, histogram in list(self.histograms.items())},
+        }
+
+    def stats_response(self, account_name: str | None, address: (str, int), request_id: str | int = None) -> bytes:
+        """
+        Encode the response to STATS requested by the account, echoing the request id if any.
+        Any client may introduce itself with an admin account name, so the peer address is checked too.
+        :param address: peer address of the client
+        """
+        if account_name not in sett.SERVER_ADMIN_ACCOUNTS or address[0] not in sett.SERVER_ADMIN_ADDRESSES:
+            return jim.encode_response(jim.Responses.FORBIDDEN, request_id=request_id)
+        response = {"alert": "OK", "stats": self.snapshot()}
+        if request_id is not None:
+            response["id"] = request_id
+        return jim.Response(jim.Responses.OK, **response).encoded
+
+
+class SnapshotWriter(threading.Thread):
+    """
+    Writes the metrics snapshot to the file every interval seconds, replacing the file at once
+    ATTRIBUTES:
+    metrics - metrics to write
+    path - snapshot file path
+    interval - seconds between the snapshots
+    """
+    def __init__(self, metrics: Metrics, path: str, interval: float = None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.daemon = True
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval if interval else sett.SERVER_METRICS_INTERVAL
+
+    def write(self):
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "wb") as snapshot_file:
+            snapshot_file.write(jim.json_dumps(self.metrics.snapshot()))
+        os.replace(temporary_path, self.path)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.write()
+            except OSError as e:
+                log.error("Не удалось записать метрики в файл %s: %s", self.path, e)
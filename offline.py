@@ -0,0 +1,299 @@
+import os
+import mmap
+import time
+import queue
+import struct
+import logging
+import threading
+
+import settings as sett
+
+"""
+Offline message store: messages for accounts that have been connected before but are offline now
+are kept on disk and delivered when the account sends PRESENCE again.
+Every account has a queue of its own - a directory of append-only segment files named by their sequence numbers.
+A segment is a sequence of records, a record is RECORD_HEADER (time the message was stored in ns, payload length)
+followed by the message as received. Segments are rotated at OFFLINE_SEGMENT_SIZE and read with mmap.
+The index of the segments (sizes, record counts, time ranges) is kept in memory and rebuilt from the files
+at startup. Messages older than OFFLINE_TTL are dropped, the oldest segments of an account queue are dropped
+when it grows above OFFLINE_MAX_ACCOUNT_BYTES.
+A queue is drained in chunks of OFFLINE_DRAIN_BYTES, so that the connection takes them as its output drains.
+A chunk is removed once the connection acknowledges it has accepted the chunk for sending - until then,
+or if the connection is lost before, it is taken again by the next drain. The position the queue has been
+delivered up to is kept in memory only: after a restart the rest of a partly delivered segment is delivered again.
+All disk I/O is done by the store thread: the servers queue requests to it and never wait for the disk.
+"""
+
+RECORD_HEADER = struct.Struct("!QI")
+SEGMENT_SUFFIX = ".seg"
+
+log = logging.getLogger(sett.SERVER_LOG_NAME)
+
+
+class Segment:
+    """
+    Index entry of a segment file
+    ATTRIBUTES:
+    sequence - sequence number of the segment in the account queue, the file is named by it
+    head - file offset of the first record not delivered yet
+    size - file size
+    count - number of records
+    first_time, last_time - time range of the records, ns
+    """
+    __slots__ = ("sequence", "head", "size", "count", "first_time", "last_time")
+
+    def __init__(self, sequence: int):
+        self.sequence = sequence
+        self.head = 0
+        self.size = 0
+        self.count = 0
+        self.first_time = None
+        self.last_time = None
+
+    def add(self, timestamp: int, size: int):
+        self.size += size
+        self.count += 1
+        if self.first_time is None:
+            self.first_time = timestamp
+        self.last_time = timestamp
+
+
+def read_records(path: str, offset: int = 0):
+    """
+    Read the segment file
+    :param offset: file offset of the first record to read
+    :return: generator of (time, message) tuples; a truncated tail record is skipped
+    """
+    with open(path, "rb") as segment_file:
+        if os.fstat(segment_file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            while offset + RECORD_HEADER.size <= len(data):
+                timestamp, length = RECORD_HEADER.unpack_from(data, offset)
+                start = offset + RECORD_HEADER.size
+                if start + length > len(data):
+                    log.warning("Хранилище: неполная запись в конце сегмента %s отброшена.", path)
+                    return
+                yield timestamp, data[start:start + length]
+                offset = start + length
+
+
+class OfflineStore(threading.Thread):
+    """
+    Store thread owning the account queues on disk
+    ATTRIBUTES:
+    directory - store directory, an account queue is its subdirectory named by the hex-encoded account name
+    ttl - seconds a message is kept for
+    max_account_bytes - maximum size of an account queue
+    segment_size - size the segments are rotated at
+    drain_bytes - size of the chunks the queues are drained in
+    index - Segment lists with account names as keys; is only changed by the store thread
+    taken - (segment sequence, file offset) the chunks taken last and not acknowledged yet end at,
+    with account names as keys
+    requests - queue of the requests to the store thread
+    """
+    def __init__(self, directory: str = None, ttl: float = None, max_account_bytes: int = None,
+                 segment_size: int = None, drain_bytes: int = None, *args, **kwargs):
+        """
+        If any of the parameters are not specified, defaults are used.
+        """
+        super().__init__(*args, **kwargs)
+        self.daemon = True
+        self.directory = directory if directory else sett.OFFLINE_DIRECTORY
+        self.ttl = ttl if ttl else sett.OFFLINE_TTL
+        self.max_account_bytes = max_account_bytes if max_account_bytes else sett.OFFLINE_MAX_ACCOUNT_BYTES
+        self.segment_size = segment_size if segment_size else sett.OFFLINE_SEGMENT_SIZE
+        self.drain_bytes = drain_bytes if drain_bytes else sett.OFFLINE_DRAIN_BYTES
+        self.index = {}
+        self.taken = {}
+        self.requests = queue.SimpleQueue()
+        self._load_index()
+
+    def accounts(self) -> list:
+        """ Return names of the accounts having messages stored """
+        return list(self.index)
+
+    def put(self, account_name: str, message: bytes):
+        """ Store the message for the account; returns at once, the message is written by the store thread """
+        self.requests.put((account_name, message, time.time_ns()))
+
+    def drain(self, account_name: str, callback, acknowledged: bool = False):
+        """
+        Take the next chunk of the messages stored for the account, oldest first; returns at once
+        :param callback: function called by the store thread with the list of the messages, if there are any
+        :param acknowledged: the chunk taken last has been accepted for sending - remove it;
+        otherwise it is taken again
+        """
+        self.requests.put((account_name, None, (callback, acknowledged)))
+
+    # Everything below is called by the store thread only, except for _load_index() called at startup
+
+    def _account_directory(self, account_name: str) -> str:
+        return os.path.join(self.directory, account_name.encode(sett.DEFAULT_ENCODING).hex())
+
+    def _segment_path(self, account_name: str, sequence: int) -> str:
+        return os.path.join(self._account_directory(account_name), "{:016d}{}".format(sequence, SEGMENT_SUFFIX))
+
+    def _load_index(self):
+        """ Rebuild the index from the segment files """
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            try:
+                account_name = bytes.fromhex(name).decode(sett.DEFAULT_ENCODING)
+                files = sorted(os.listdir(os.path.join(self.directory, name)))
+            except (ValueError, OSError):
+                continue
+            segments = []
+            for file_name in files:
+                if not file_name.endswith(SEGMENT_SUFFIX):
+                    continue
+                segment = Segment(int(file_name[:-len(SEGMENT_SUFFIX)]))
+                for timestamp, message in read_records(self._segment_path(account_name, segment.sequence)):
+                    segment.add(timestamp, RECORD_HEADER.size + len(message))
+                if segment.count:
+                    segments.append(segment)
+                else:                           # Empty or truncated before the first record is complete
+                    self._remove_segment(account_name, segment)
+            if segments:
+                self.index[account_name] = segments
+        log.info("Хранилище: сообщения ожидают доставки %d учетным записям.", len(self.index))
+
+    def _append(self, account_name: str, records: list):
+        """
+        Append the (message, time) records to the account queue, rotating segments and applying the limits.
+        Queues and segments are indexed once a record has been written to them, so the index never has empty ones.
+        """
+        segments = self.index.get(account_name, [])
+        segment = segments[-1] if segments else None
+        os.makedirs(self._account_directory(account_name), exist_ok=True)
+        segment_file = None
+        try:
+            for message, timestamp in records:
+                if segment is None or segment.size >= self.segment_size:
+                    if segment_file:
+                        segment_file.close()
+                        segment_file = None
+                    segment = Segment(segment.sequence + 1 if segment else 0)
+                if segment_file is None:
+                    segment_file = open(self._segment_path(account_name, segment.sequence), "ab")
+                segment_file.write(RECORD_HEADER.pack(timestamp, len(message)) + message)
+                if not segment.count:
+                    segments.append(segment)
+                    self.index[account_name] = segments
+                segment.add(timestamp, RECORD_HEADER.size + len(message))
+            if sett.OFFLINE_FSYNC:
+                segment_file.flush()
+                os.fsync(segment_file.fileno())
+        finally:
+            if segment_file:
+                segment_file.close()
+        while sum(segment.size for segment in segments) > self.max_account_bytes and len(segments) > 1:
+            log.warning("Хранилище: очередь %s превысила %d байт, удаляются %d старых сообщений.",
+                        account_name, self.max_account_bytes, segments[0].count)
+            self._remove_segment(account_name, segments.pop(0))
+
+    def _remove_segment(self, account_name: str, segment: Segment):
+        try:
+            os.remove(self._segment_path(account_name, segment.sequence))
+        except OSError as e:
+            log.error("Хранилище: не удалось удалить сегмент очереди %s: %s", account_name, e)
+
+    def _remove_queue(self, account_name: str):
+        self.taken.pop(account_name, None)
+        for segment in self.index.pop(account_name, ()):
+            self._remove_segment(account_name, segment)
+        try:
+            os.rmdir(self._account_directory(account_name))
+        except OSError:
+            pass
+
+    def _take(self, account_name: str, acknowledged: bool) -> list:
+        """
+        Remove the chunk taken last if it has been acknowledged, read the next one
+        :return: messages of the chunk, up to drain_bytes unless the first one is longer
+        """
+        taken = self.taken.pop(account_name, None)
+        if acknowledged and taken:
+            self._remove_taken(account_name, *taken)
+        expired = time.time_ns() - int(self.ttl * 1e9)
+        messages = []
+        size = 0
+        for segment in self.index.get(account_name, ()):
+            if segment.last_time is None or segment.last_time < expired:
+                taken = segment.sequence, segment.size
+                continue
+            offset = segment.head
+            for timestamp, message in read_records(self._segment_path(account_name, segment.sequence), offset):
+                if timestamp >= expired:
+                    if messages and size + len(message) > self.drain_bytes:
+                        self.taken[account_name] = taken
+                        return messages
+                    messages.append(message)
+                    size += len(message)
+                offset += RECORD_HEADER.size + len(message)
+                taken = segment.sequence, offset
+        if messages:
+            self.taken[account_name] = taken
+        else:
+            self._remove_queue(account_name)
+        return messages
+
+    def _remove_taken(self, account_name: str, sequence: int, offset: int):
+        """ Remove the records of the account queue up to the file offset of the segment """
+        segments = self.index.get(account_name, [])
+        while segments and (segments[0].sequence < sequence
+                            or segments[0].sequence == sequence and offset >= segments[0].size):
+            self._remove_segment(account_name, segments.pop(0))
+        if segments and segments[0].sequence == sequence:
+            segments[0].head = offset
+        if not segments:
+            self._remove_queue(account_name)
+
+    def _expire(self):
+        """ Remove the segments with all the messages expired """
+        expired = time.time_ns() - int(self.ttl * 1e9)
+        for account_name, segments in list(self.index.items()):
+            while segments and (segments[0].last_time is None or segments[0].last_time < expired):
+                self._remove_segment(account_name, segments.pop(0))
+            if not segments:
+                self._remove_queue(account_name)
+
+    def _process(self, requests: list):
+        """ Process a batch of requests: writes are grouped by account, so every queue is opened once """
+        writes = {}
+        for account_name, message, argument in requests:
+            if message is not None:
+                writes.setdefault(account_name, []).append((message, argument))
+                continue
+            # Drain - write whatever has been queued for the account before reading it
+            if account_name in writes:
+                self._append(account_name, writes.pop(account_name))
+            callback, acknowledged = argument
+            messages = self._take(account_name, acknowledged)
+            if messages:
+                log.info("Хранилище: %s получает %d сохраненных сообщений.", account_name, len(messages))
+                callback(messages)
+        for account_name, records in writes.items():
+            self._append(account_name, records)
+
+    def run(self):
+        last_expiry = time.monotonic()
+        while True:
+            try:
+                requests = [self.requests.get(timeout=sett.OFFLINE_EXPIRE_INTERVAL)]
+                while len(requests) < sett.OFFLINE_BATCH and not self.requests.empty():
+                    requests.append(self.requests.get())
+                self._process(requests)
+            except queue.Empty:
+                pass
+            except Exception as e:
+                log.critical("Хранилище: ошибка: %s: %s", type(e), e)
+            if time.monotonic() - last_expiry >= sett.OFFLINE_EXPIRE_INTERVAL:
+                last_expiry = time.monotonic()
+                try:
+                    self._expire()
+                except Exception as e:
+                    log.critical("Хранилище: ошибка удаления устаревших сообщений: %s: %s", type(e), e)
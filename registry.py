@@ -0,0 +1,74 @@
+import threading
+
+import routing
+
+
+class ConnectionRegistry:
+    """
+    Server-wide connection registry for the servers updating it from several threads.
+    Updates are serialized by the lock and publish a new immutable snapshot of the connections,
+    so broadcasts iterate the snapshot without locking while connections come and go.
+    Any connection class having connection (socket) and address attributes will do.
+    ATTRIBUTES:
+    connections - snapshot of the connections, a tuple replaced on every update
+    sockets - connections dictionary with sockets as keys
+    addresses - connections dictionary with client addresses as keys
+    router - account index to look the connections up by account name
+    lock - lock serializing the updates
+    """
+    def __init__(self, router: routing.Router = None):
+        self.connections = ()
+        self.sockets = {}
+        self.addresses = {}
+        self.router = router if router else routing.Router()
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.connections)
+
+    def __iter__(self):
+        return iter(self.connections)
+
+    def __repr__(self) -> str:
+        return repr(self.connections)
+
+    def add(self, connection, limit: int = None) -> bool:
+        """
+        Register the connection
+        :param connection: connection to register
+        :param limit: maximum number of connections, no limit if not specified
+        :return: True if registered, False if the limit has been reached or the socket is registered already
+        """
+        with self.lock:
+            if limit is not None and len(self.connections) >= limit or connection.connection in self.sockets:
+                return False
+            self.sockets[connection.connection] = connection
+            self.addresses[connection.address] = connection
+            self.connections = self.connections + (connection,)
+        return True
+
+    def remove(self, connection) -> bool:
+        """
+        Forget the connection
+        :return: True if the connection has been registered, False otherwise
+        """
+        with self.lock:
+            if self.sockets.get(connection.connection) is not connection:
+                return False
+            del self.sockets[connection.connection]
+            if self.addresses.get(connection.address) is connection:
+                del self.addresses[connection.address]
+            self.connections = tuple(other for other in self.connections if other is not connection)
+        return True
+
+    def by_socket(self, sock) -> object:
+        """ Return the connection of the socket or None """
+        return self.sockets.get(sock)
+
+    def by_address(self, address: (str, int)) -> object:
+        """ Return the connection of the client address or None """
+        return self.addresses.get(address)
+
+    def by_account(self, account_name: str) -> object:
+        """ Return the connection the account is connected through or None """
+        return self.router.lookup(account_name)[1]
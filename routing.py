@@ -0,0 +1,134 @@
+import threading
+
+import jim
+
+
+class Router:
+    """
+    Server-wide account index - routes direct messages to recipient connections in O(1).
+    Connection objects are only stored and returned, so any hashable connection class will do.
+    ATTRIBUTES:
+    accounts - connections dictionary with account names as keys
+    names - account names dictionary with connections as keys
+    known_accounts - names of all the accounts that have ever been connected, to tell GONE from NOT_FOUND
+    lock - lock guarding the index for the servers updating it from several threads
+    """
+    def __init__(self):
+        self.accounts = {}
+        self.names = {}
+        self.known_accounts = set()
+        self.lock = threading.Lock()
+
+    def register(self, account_name: str, connection) -> jim.Responses:
+        """
+        Bind the account to the connection, replacing the account the connection was bound to before
+        :param account_name: account name given at PRESENCE
+        :param connection: connection the account is connected through
+        :return: Responses.OK if succeeded, Responses.CONFLICT if the account is bound to another connection
+        """
+        with self.lock:
+            current = self.accounts.get(account_name)
+            if current is not None and current is not connection:
+                return jim.Responses.CONFLICT
+            previous_name = self.names.get(connection)
+            if previous_name is not None and previous_name != account_name:
+                del self.accounts[previous_name]
+            self.accounts[account_name] = connection
+            self.names[connection] = account_name
+            self.known_accounts.add(account_name)
+        return jim.Responses.OK
+
+    def unregister(self, connection):
+        """ Unbind the account the connection is bound to, if any """
+        with self.lock:
+            account_name = self.names.pop(connection, None)
+            if account_name is not None:
+                del self.accounts[account_name]
+
+    def account_name(self, connection) -> str | None:
+        """ Return the name of the account bound to the connection """
+        return self.names.get(connection)
+
+    def lookup(self, account_name: str) -> (jim.Responses, object):
+        """
+        Find the recipient connection
+        :param account_name: recipient account name
+        :return: Responses.OK and the connection if the account is connected,
+        Responses.GONE and None if the account has been connected before,
+        Responses.NOT_FOUND and None if the account is unknown
+        """
+        connection = self.accounts.get(account_name)
+        if connection is not None:
+            return jim.Responses.OK, connection
+        if account_name in self.known_accounts:
+            return jim.Responses.GONE, None
+        return jim.Responses.NOT_FOUND, None
+
+
+class RemoteRouter(Router):
+    """
+    Account index of a server that is a part of a bigger one: looks up the accounts connected to the server itself,
+    then those connected elsewhere, and reports the changes of its own accounts to the subclass hooks.
+    An account connected elsewhere is represented by an object delivering messages to it with deliver(message).
+    ATTRIBUTES:
+    remote - remote account dictionary with names of the accounts connected elsewhere as keys
+    """
+    def __init__(self):
+        super().__init__()
+        self.remote = {}
+
+    def register(self, account_name: str, connection) -> jim.Responses:
+        if account_name in self.remote:
+            return jim.Responses.CONFLICT
+        previous_name = self.names.get(connection)
+        status = super().register(account_name, connection)
+        if status == jim.Responses.OK and previous_name != account_name:
+            if previous_name is not None:
+                self.account_removed(previous_name)
+            self.account_added(account_name)
+        return status
+
+    def unregister(self, connection):
+        account_name = self.names.get(connection)
+        super().unregister(connection)
+        if account_name is not None:
+            self.account_removed(account_name)
+
+    def lookup(self, account_name: str) -> (jim.Responses, object):
+        status, connection = super().lookup(account_name)
+        if connection is None and account_name in self.remote:
+            return jim.Responses.OK, self.remote[account_name]
+        return status, connection
+
+    def local(self, account_name: str) -> object:
+        """ Return the connection of the account connected to the server itself or None """
+        return self.accounts.get(account_name)
+
+    def drop_local(self, account_name: str) -> object:
+        """
+        Unbind the account of the server itself without reporting it, e.g. if it has been connected elsewhere first
+        :return: connection the account has been bound to or None
+        """
+        with self.lock:
+            connection = self.accounts.pop(account_name, None)
+            if connection is not None:
+                del self.names[connection]
+        return connection
+
+    def bind_remote(self, account_name: str, remote_account):
+        """ Bind the account to the object delivering messages to it elsewhere """
+        self.remote[account_name] = remote_account
+        self.known_accounts.add(account_name)
+
+    def unbind_remote(self, account_name: str, remote_account=None):
+        """ Unbind the account connected elsewhere - if it is still bound to remote_account, if specified """
+        if remote_account is None or self.remote.get(account_name) is remote_account:
+            self.remote.pop(account_name, None)
+
+    def account_added(self, account_name: str):
+        """ Hook called when the account has been registered by a client of the server """
+        pass
+
+    def account_removed(self, account_name: str):
+        """ Hook called when the account of a client of the server has been unregistered """
+        pass
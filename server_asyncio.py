@@ -0,0 +1,473 @@
+import time
+import socket
+import asyncio
+import argparse
+import logging
+
+import settings as sett
+import jim
+import routing
+import buffers
+import bus
+import federation
+import offline
+import history
+import metrics
+import wheel
+import server_log_config
+
+
+class Connection(asyncio.Protocol):
+    """
+    Connection protocol class - handles individual client connections inside the event loop
+    ATTRIBUTES:
+    chat: jim.Chat                  # chat instance
+    transport: asyncio.Transport    # connection transport
+    address: (str, int)             # client address
+    connections: set                # server connections set the connection adds itself to
+    router: routing.Router          # server account index to route direct messages
+    relay: bus.BusClient | federation.Federation    # bus to the other workers or federation of the node, else None
+    offline: offline.OfflineStore   # store of the messages for offline accounts, else None
+    history: history.HistoryStore   # history of the messages routed, else None
+    metrics: metrics.Metrics        # server metrics
+    idle_wheel: wheel.TimingWheel   # server timing wheel checking the connections for being idle, else None
+    last_activity: float            # time.monotonic() data has been received from the client at last
+    probed: float                   # last_activity PROBE has been sent to the client at, None if never
+    policy: buffers.OverflowPolicy  # slow consumer policy applied when the transport write buffer is full
+    writing_paused: bool            # the transport write buffer is above the high watermark
+    queued_bytes: int               # number of bytes ever queued to the transport
+    dropped_bytes: int              # number of bytes dropped by the DROP policy
+    draining: str                   # account the stored messages sent last are to be acknowledged for, else None
+    """
+    __slots__ = ("chat", "transport", "address", "connections", "router", "relay", "offline", "history", "metrics",
+                 "idle_wheel", "last_activity", "probed", "policy", "writing_paused", "queued_bytes", "dropped_bytes",
+                 "draining")
+
+    def __init__(self, connections: set, router: routing.Router,
+                 relay: bus.BusClient | federation.Federation = None, offline_store: offline.OfflineStore = None,
+                 history_store: history.HistoryStore = None, server_metrics: metrics.Metrics = None,
+                 idle_wheel: wheel.TimingWheel = None):
+        self.chat = jim.Chat()
+        self.transport = None
+        self.address = None
+        self.connections = connections
+        self.router = router
+        self.relay = relay
+        self.offline = offline_store
+        self.history = history_store
+        self.metrics = server_metrics if server_metrics else metrics.Metrics()
+        self.idle_wheel = idle_wheel
+        self.last_activity = time.monotonic()
+        self.probed = None
+        self.policy = buffers.OverflowPolicy(sett.SERVER_OUTPUT_POLICY)
+        self.writing_paused = False
+        self.queued_bytes = 0
+        self.dropped_bytes = 0
+        self.draining = None
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        self.address = transport.get_extra_info("peername")
+        transport.set_write_buffer_limits(high=sett.SERVER_OUTPUT_HIGH_WATERMARK, low=sett.SERVER_OUTPUT_LOW_WATERMARK)
+        # If maximum number of connections reached, send error message and close connection
+        if len(self.connections) >= sett.SERVER_ASYNCIO_MAX_CONNECTIONS:
+            log.error("Клиент %s Отказ в соединении - достигнут максимум (%d).",
+                      self.address, sett.SERVER_ASYNCIO_MAX_CONNECTIONS)
+            transport.write(self.chat.frame(jim.encode_response(jim.Responses.SERVER_ERROR)))
+            transport.close()
+            self.metrics.count("connections_rejected")
+            return
+        self.connections.add(self)
+        self.metrics.count("connections_accepted")
+        if self.idle_wheel is not None:
+            self.idle_wheel.schedule(self, self.last_activity + sett.CONNECTION_PROBE_INTERVAL)
+        log.info("Клиент %s Соединение установлено (всего %d соединений).", self.address, len(self.connections))
+
+    def connection_lost(self, exc: Exception | None):
+        if exc:
+            log.info("Клиент %s Соединение разорвано: %s", self.address, exc)
+        else:
+            log.info("Клиент %s Соединение закрыто.", self.address)
+        self.connections.discard(self)
+        self.router.unregister(self)
+
+    def pause_writing(self):
+        """ The transport write buffer is above the high watermark - the client is a slow consumer """
+        self.writing_paused = True
+        if self.policy == buffers.OverflowPolicy.DISCONNECT:
+            log.warning("Клиент %s Соединение закрывается - клиент не успевает получать данные (%d байт в очереди).",
+                        self.address, self.transport.get_write_buffer_size())
+            self.transport.abort()
+        elif self.policy == buffers.OverflowPolicy.PAUSE:
+            log.warning("Клиент %s Чтение приостановлено - клиент не успевает получать данные (%d байт в очереди).",
+                        self.address, self.transport.get_write_buffer_size())
+            self.transport.pause_reading()
+
+    def resume_writing(self):
+        """ The transport write buffer has drained to the low watermark """
+        self.writing_paused = False
+        if self.policy == buffers.OverflowPolicy.PAUSE and not self.transport.is_closing():
+            log.info("Клиент %s Чтение возобновлено.", self.address)
+            self.transport.resume_reading()
+        self._continue_draining()
+
+    def send(self, data: bytes, droppable: bool = True):
+        """
+        Queue data to the transport according to the overflow policy;
+        a slow consumer whose write buffer would grow beyond the hard limit is disconnected.
+        :param droppable: False if the DROP policy must not drop the data
+        """
+        if self.transport.is_closing():
+            return
+        if self.writing_paused:
+            # The frames compressed in the stream of the connection are dropped before they are compressed, see frame()
+            if self.policy == buffers.OverflowPolicy.DROP and droppable and self.chat.compressor is None:
+                self.dropped_bytes += len(data)
+                return
+            if self.transport.get_write_buffer_size() + len(data) > sett.SERVER_OUTPUT_HARD_LIMIT:
+                log.warning("Клиент %s Соединение закрывается - клиент не успевает получать данные (%d байт в очереди).",
+                            self.address, self.transport.get_write_buffer_size())
+                self.transport.abort()
+                return
+        self.transport.write(data)
+        self.queued_bytes += len(data)
+        self.metrics.count("bytes_out", len(data))
+
+    def frame(self, payload: bytes, shared: bool = False, droppable: bool = True) -> bytes:
+        """
+        Frame the payload for the client, see Chat.frame
+        :return: frame, empty if the payload can't be sent in the wire format of the client - it is skipped then,
+        or if it is droppable and dropped before it is compressed, see send()
+        """
+        if droppable and self.chat.compressor is not None and self.writing_paused \
+                and self.policy == buffers.OverflowPolicy.DROP:
+            self.dropped_bytes += len(payload)
+            return b""
+        try:
+            return self.chat.frame(payload, shared)
+        except ValueError as e:
+            log.error("Клиент %s Сообщение не отправлено (%s): %s", self.address, e, payload[:100])
+            return b""
+
+    def deliver(self, message: bytes, shared: bool = False):
+        """
+        Send the message forwarded from another client
+        :param shared: the message is broadcast to many clients, see Chat.frame
+        """
+        self.send(self.frame(message, shared))
+
+    def disconnect(self, status: jim.Responses):
+        """ Reply with the error status and close the connection """
+        log.warning("Клиент %s Соединение закрывается: %s", self.address, status.name)
+        self.send(self.frame(jim.encode_response(status)))
+        self.transport.close()
+
+    def _send_replies(self, replies: list):
+        """
+        Frame the replies and send them in one write. They are framed when written, not when made, as the frames
+        compressed in the stream of the connection must be sent in the order they have been compressed in -
+        and a message forwarded to the connection itself is framed and sent in between.
+        """
+        self.send(b"".join(self.frame(reply) for reply in replies))
+
+    def data_received(self, data: bytes):
+        """
+        Process every complete message received, reply to it and forward it to other clients if requested.
+        The replies to all the messages received at once are sent in one write.
+        """
+        started = time.perf_counter_ns()
+        self.last_activity = time.monotonic()
+        self.metrics.count("bytes_in", len(data))
+        trace = server_log_config.sample_messages()
+        if trace:
+            log.debug("Клиент %s Получены данные: %s", self.address, data)
+        replies = []
+        try:
+            for success, response, forward_list, message in self.chat.process_data(data):
+                self.metrics.count_message(self.chat, success)
+                if not success:
+                    log.error("Клиент %s %s", self.address, self.chat.error_str)
+                elif self.chat.action == jim.Actions.PRESENCE and self.chat.account_name:
+                    status = self.router.register(self.chat.account_name, self)
+                    if status != jim.Responses.OK:
+                        log.error("Клиент %s Учетная запись %s уже подключена.", self.address, self.chat.account_name)
+                        response = self.chat.encode_response(status)
+                    elif self.offline:
+                        self._drain_offline(self.chat.account_name)
+                elif self.chat.action == jim.Actions.HISTORY:
+                    response = self._query_history()
+                    if response is None:
+                        continue                        # The response is sent once the history is read
+                elif self.chat.action == jim.Actions.STATS:
+                    response = self.metrics.stats_response(self.router.account_name(self), self.address,
+                                                             self.chat.request_id)
+                elif forward_list:
+                    # Forward message to other clients
+                    if trace:
+                        log.debug("Клиент %s Пересылка сообщения адресатам %s: %s", self.address, forward_list, message)
+                    status = self._forward(message, forward_list)
+                    self.metrics.observe("fanout", started)
+                    if status != jim.Responses.OK:
+                        response = self.chat.encode_response(status)
+                    if self.history and status in (jim.Responses.OK, jim.Responses.ACCEPTED):
+                        self.history.record(self.chat.account_name or "", message)
+                if trace:
+                    log.debug("Клиент %s Отправляется ответ: %s", self.address, response)
+                replies.append(response)
+                if self.chat.action == jim.Actions.PRESENCE:
+                    # Framed as negotiated before, the PRESENCE negotiation takes effect with the next message
+                    self._send_replies(replies)
+                    replies.clear()
+                self.metrics.observe("processing", started)
+                if success and self.chat.action == jim.Actions.QUIT:
+                    log.info("Клиент %s Соединение закрывается по запросу клиента.", self.address)
+                    self._send_replies(replies)
+                    self.transport.close()
+                    return
+        except jim.FrameError as e:
+            log.error("Клиент %s Соединение закрывается - ошибка формата кадра: %s", self.address, e)
+            if replies:
+                self._send_replies(replies)
+            self.transport.close()
+            return
+        if replies:
+            self._send_replies(replies)
+
+    def _forward(self, message: bytes, forward_list: list) -> jim.Responses:
+        """
+        Forward the message to everyone else for BROADCAST_RECIPIENT or to the recipient's connection
+        :return: Responses.OK if forwarded to all the recipients, the status of the first failed recipient otherwise,
+        Responses.ACCEPTED if some of the recipients are offline and the message has been stored for them
+        """
+        status = jim.Responses.OK
+        for recipient in forward_list:
+            if recipient == jim.BROADCAST_RECIPIENT:
+                for other_connection in self.connections:
+                    if other_connection is not self:
+                        other_connection.deliver(message, shared=True)
+                if self.relay:
+                    self.relay.broadcast(message)       # To the clients of the other workers or nodes
+                continue
+            recipient_status, other_connection = self.router.lookup(recipient)
+            if recipient_status == jim.Responses.GONE and self.offline:
+                log.info("Клиент %s Адресат %s не в сети, сообщение сохраняется.", self.address, recipient)
+                self.offline.put(recipient, message)
+                if status == jim.Responses.OK:
+                    status = jim.Responses.ACCEPTED
+            elif other_connection is None:
+                log.info("Клиент %s Адресат %s недоступен: %s", self.address, recipient, recipient_status.name)
+                if status in (jim.Responses.OK, jim.Responses.ACCEPTED):
+                    status = recipient_status
+            else:
+                other_connection.deliver(message)         # May be an account of another worker or node
+        return status
+
+    def check_idle(self, now: float) -> float | None:
+        """
+        Probe the client silent for CONNECTION_PROBE_INTERVAL, disconnect it if it is still silent
+        when CONNECTION_TIMEOUT - CONNECTION_PROBE_INTERVAL more has passed
+        :return: time the connection is to be checked again at, None if it has been closed
+        """
+        if self.transport.is_closing():
+            return None
+        idle = now - self.last_activity
+        if idle < sett.CONNECTION_PROBE_INTERVAL:
+            return self.last_activity + sett.CONNECTION_PROBE_INTERVAL
+        if self.probed != self.last_activity:     # Not probed since the client has been heard from last
+            self.probed = self.last_activity
+            self.send(self.frame(jim.Message(jim.Actions.PROBE).encoded))
+            self.metrics.count("probes_sent")
+            return now + sett.CONNECTION_TIMEOUT - sett.CONNECTION_PROBE_INTERVAL
+        log.info("Клиент %s Соединение закрывается - нет ответа на PROBE (%d секунд).", self.address, idle)
+        self.metrics.count("connections_expired")
+        self.transport.close()
+        return None
+
+    def _query_history(self) -> bytes | None:
+        """
+        Have the history requested sent to the client when the history thread reads it
+        :return: None if the request has been queued, the encoded error response otherwise
+        """
+        if not self.history:
+            return self.chat.encode_response(jim.Responses.SERVER_ERROR, "История сообщений не ведется")
+        account_name = self.router.account_name(self)
+        if account_name is None:
+            return self.chat.encode_response(jim.Responses.LOGIN_REQUIRED)
+        loop = asyncio.get_running_loop()
+        self.history.query(account_name, self.chat.history_request,
+                           lambda response: loop.call_soon_threadsafe(self._send_later, response))
+        return None
+
+    def _send_later(self, payload: bytes):
+        """ Send the payload prepared by another thread unless the connection has been closed meanwhile """
+        if not self.transport.is_closing():
+            self.send(self.frame(payload))
+
+    def _drain_offline(self, account_name: str, acknowledged: bool = False):
+        """
+        Have the next chunk of the messages stored for the account sent to the connection, in one write,
+        when the store reads it
+        :param acknowledged: the chunk sent last has been queued to the transport, see OfflineStore.drain
+        """
+        loop = asyncio.get_running_loop()
+        self.offline.drain(account_name,
+                           lambda messages: loop.call_soon_threadsafe(self._deliver_stored, account_name, messages),
+                           acknowledged)
+
+    def _deliver_stored(self, account_name: str, messages: list):
+        """
+        Send a chunk of the messages stored for the account in one write. The chunk is acknowledged and the next one
+        taken once the transport takes more data; until then it stays stored, so a chunk the client is disconnected
+        before is delivered at its next PRESENCE
+        """
+        if self.transport.is_closing() or self.router.account_name(self) != account_name:
+            log.info("Клиент %s Учетная запись %s отключилась, сообщения остаются в хранилище.",
+                     self.address, account_name)
+            return
+        log.info("Клиент %s Доставляется %d сохраненных сообщений.", self.address, len(messages))
+        self.send(b"".join(self.frame(message, droppable=False) for message in messages), droppable=False)
+        self.draining = account_name
+        if not self.writing_paused:
+            self._continue_draining()
+
+    def _continue_draining(self):
+        """ Acknowledge the chunk of stored messages sent last and have the next one sent """
+        if self.draining is not None and not self.transport.is_closing():
+            self._drain_offline(self.draining, acknowledged=True)
+        self.draining = None
+
+
+class Server:
+    """
+    ATTRIBUTES:
+    address - server address
+    port - server port
+    connections - set of client connections
+    relay - bus to the other workers of the multi-process server or federation of the node, else None
+    router - account index to route direct messages, shared with the other workers or nodes if any
+    offline - store of the messages for offline accounts, standalone server only - else None
+    history - history of the messages routed, shared by the workers of the multi-process server,
+    None for the federation nodes
+    metrics - server metrics
+    metrics_file - file to write the metrics snapshot to periodically, if any
+    idle_wheel - timing wheel checking the connections for being idle
+    """
+    def __init__(self, address: str = None, port: int = None, bus_path: str = None, link_port: int = None,
+                 node: str = None, peers: list = (), metrics_file: str = None):
+        """
+        Initialize parameters
+        :param address: IP address of the interface to wait for client connections and server links on
+        :param port: port to wait for client connections on
+        :param bus_path: Unix socket path of the bus hub if run as a worker of the multi-process server
+        :param link_port: port to wait for server links on if run as a node of the federation
+        :param node: node name, "<host name>:<link_port>" if not specified
+        :param peers: (address, port) list of the nodes to link to
+        :param metrics_file: file to write the metrics snapshot to periodically
+        If any of the parameters are not specified, defaults are used.
+        """
+        self.address = address if address else sett.DEFAULT_LISTEN_ADDRESS
+        self.port = port if port else sett.DEFAULT_PORT
+        self.connections = set()
+        self.relay = None
+        if bus_path:
+            self.relay = bus.BusClient(bus_path, self.connections)
+        elif link_port:
+            node = node if node else "{}:{}".format(socket.gethostname(), link_port)[-jim.MAX_NODE_NAME_LEN:]
+            self.relay = federation.Federation(node, self.address, link_port, peers, self.connections)
+        self.router = self.relay.router if self.relay else routing.Router()
+        self.offline = None
+        if not self.relay:
+            self.offline = offline.OfflineStore(name="Offline")
+            self.router.known_accounts.update(self.offline.accounts())
+        self.history = None
+        if not isinstance(self.relay, federation.Federation):
+            self.history = history.HistoryStore(name="History")
+        self.metrics = metrics.Metrics()
+        self.metrics.gauge("connections", lambda: len(self.connections))
+        self.metrics.gauge("accounts", lambda: len(self.router.accounts))
+        self.metrics_file = metrics_file if metrics_file else sett.SERVER_METRICS_FILE
+        self.idle_wheel = wheel.TimingWheel(sett.IDLE_WHEEL_TICK, sett.IDLE_WHEEL_SLOTS, time.monotonic())
+
+    async def _check_idle(self):
+        """ Check the connections whose deadlines have passed every tick of the timing wheel """
+        while True:
+            await asyncio.sleep(self.idle_wheel.tick)
+            now = time.monotonic()
+            for connection in self.idle_wheel.advance(now):
+                deadline = connection.check_idle(now)
+                if deadline is not None:
+                    self.idle_wheel.schedule(connection, deadline)
+
+    async def serve(self):
+        """ Accept connections and process client messages until cancelled """
+        log.critical("Сервер ожидает соединений по адресу %s:%d", self.address if self.address else '(все)', self.port)
+        loop = asyncio.get_running_loop()
+        try:
+            if self.relay:
+                await self.relay.start()
+            if self.offline:
+                self.offline.start()
+            if self.history:
+                self.history.start()
+            if self.metrics_file:
+                metrics.SnapshotWriter(self.metrics, self.metrics_file, name="Metrics").start()
+            # Workers of the multi-process server share the port, the kernel balances the connections among them
+            server = await loop.create_server(lambda: Connection(self.connections, self.router, self.relay,
+                                                                     self.offline, self.history, self.metrics,
+                                                                     self.idle_wheel),
+                                              self.address if self.address else None, self.port,
+                                              backlog=sett.SERVER_ASYNCIO_BACKLOG,
+                                              reuse_port=isinstance(self.relay, bus.BusClient))
+        except OSError as e:
+            log.critical("Ошибка инициализации сервера: %s", e)
+            return
+        idle_task = asyncio.create_task(self._check_idle())
+        async with server:
+            try:
+                await server.serve_forever()
+            finally:
+                idle_task.cancel()
+
+
+def raise_open_files_limit():
+    """ Raise the soft limit of open file descriptors up to the hard one to hold many idle connections """
+    try:
+        import resource
+    except ImportError:             # Not available on Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError) as e:
+            log.warning("Не удалось увеличить лимит открытых файлов (%d): %s", soft, e)
+
+
+def main():
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-address', required=False)
+    parser.add_argument('-port', required=False, type=int)
+    parser.add_argument('-bus', required=False, help="bus hub socket path - run as a worker of launcher.py")
+    parser.add_argument('-link-port', required=False, type=int, help="server link port - run as a federation node")
+    parser.add_argument('-node', required=False, help="federation node name")
+    parser.add_argument('-peers', required=False, default="", help="federation nodes to link to: host:port,...")
+    parser.add_argument('-metrics', required=False, help="file to write the metrics snapshot to periodically")
+    args = parser.parse_args()
+    raise_open_files_limit()
+    peers = [(host, int(port)) for host, _, port in (peer.rpartition(":") for peer in args.peers.split(",") if peer)]
+    # Create a server and process client messages
+    server = Server(args.address, args.port, args.bus, args.link_port, args.node, peers, args.metrics)
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        log.critical("Завершение работы сервера по прерыванию пользователя.")
+
+
+if __name__ == "__main__":
+    print("")
+    # Get logger object
+    log = logging.getLogger(sett.SERVER_LOG_NAME)
+    # Call main()
+    main()
+    print("")
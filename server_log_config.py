@@ -1,9 +1,56 @@
+import atexit
+import itertools
 import logging
 import logging.handlers
+import queue
 
 import settings as sett
 import log_config               # Default logger config
 
+"""
+Server log config.
+In the queue mode (SERVER_LOG_QUEUE) the server threads only put the records to a bounded queue,
+the listener thread formats them and writes them to the log file and to the console, so the disk and stderr
+writes and the daily rollover never hold up the message processing. If the listener falls behind, the records
+that don't fit in the queue are dropped and counted rather than waited for.
+Per-message debug records are only written for the messages picked by sample_messages().
+"""
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that drops the records when the queue is full
+    ATTRIBUTES:
+    dropped - number of records dropped since the last one queued
+    """
+    def __init__(self, record_queue: queue.Queue):
+        super().__init__(record_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The listener is in the same process - leave the formatting to it rather than doing it here
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    "name": record.name, "levelno": logging.WARNING, "levelname": logging.getLevelName(logging.WARNING),
+                    "msg": "Журнал не успевает записывать, потеряно записей: %d", "args": (self.dropped, )}))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_sampled = itertools.count()
+
+
+def sample_messages() -> bool:
+    """ Return True if the debug records of the message being processed are to be written """
+    return sett.SERVER_LOG_MESSAGES_SAMPLE > 0 and next(_sampled) % sett.SERVER_LOG_MESSAGES_SAMPLE == 0
+
+
 log = logging.getLogger(sett.SERVER_LOG_NAME)
 log.propagate = True            # Propagate to the main logger to write to stderr
 log.setLevel(sett.SERVER_LOG_FILE_LEVEL)
@@ -13,4 +60,14 @@ log_handler = logging.handlers.TimedRotatingFileHandler(
     interval=1,
     backupCount=sett.SERVER_LOG_BACKUP_DAYS_COUNT)
 log_handler.setFormatter(logging.Formatter(sett.SERVER_LOG_FORMAT))
-log.addHandler(log_handler)
+if sett.SERVER_LOG_QUEUE:
+    # The listener writes to the log file and to the console handlers of the main logger instead
+    log.propagate = False
+    log_listener = logging.handlers.QueueListener(queue.Queue(sett.SERVER_LOG_QUEUE_SIZE),
+                                                  log_handler, *logging.getLogger().handlers,
+                                                  respect_handler_level=True)
+    log.addHandler(BoundedQueueHandler(log_listener.queue))
+    log_listener.start()
+    atexit.register(log_listener.stop)              # Write the records queued before the exit
+else:
+    log.addHandler(log_handler)
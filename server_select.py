@@ -1,21 +1,52 @@
+import time
 import socket
-import select
+import selectors
 import argparse
 import logging
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 import settings as sett
 import jim
+import routing
+import buffers
+import metrics
+import wheel
 import server_log_config
 
 
 # particular connection attributes
-@dataclass
+@dataclass(eq=False, slots=True)    # Compare and hash by identity to be used as a key
 class Connection:
-    # __slots__ = ('chat', 'connection', 'address')       # Optimize memory usage with slots
     chat: jim.Chat                  # chat instance
     connection: socket.socket       # connection instance
     address: (str, int)             # client address
+    output: buffers.OutputBuffer = field(default_factory=buffers.OutputBuffer)    # data waiting to be sent
+    paused: bool = False            # reading from the connection is paused until its output drains
+    events: int = selectors.EVENT_READ          # events the connection is registered in the selector for
+    last_activity: float = field(default_factory=time.monotonic)    # time data has been received at last
+    probed: float = None            # last_activity PROBE has been sent to the client at, None if never
+
+    def frame(self, payload: bytes, shared: bool = False) -> bytes:
+        """
+        Frame the payload for the client, see Chat.frame
+        :return: frame, empty if the payload can't be sent in the wire format of the client - it is skipped then,
+        or if it is dropped before it is compressed, see put()
+        """
+        if self.chat.compressor is not None and self.output.drops(payload):
+            return b""
+        try:
+            return self.chat.frame(payload, shared)
+        except ValueError as e:
+            log.error("Клиент %s Сообщение не отправлено (%s): %s", self.address, e, payload[:100])
+            return b""
+
+    def put(self, data: bytes) -> bool:
+        """
+        Queue data to the output buffer, see OutputBuffer.put: the frames compressed in the stream of the connection
+        can't be dropped without breaking the stream, so with the compression in effect they are dropped by frame()
+        :return: False if the client is to be disconnected
+        """
+        return self.output.put(data, droppable=self.chat.compressor is None)
 
     def fileno(self):
         """ (NOT USED) Return file descriptor to use with select.select() """
@@ -29,12 +60,20 @@ class Server:
     port - server port
     socket - server socket
     connections - server connections dictionary with sockets as keys
+    selector - readiness selector with the server socket and all the connections registered;
+    the server socket is registered with no data, connections - with the Connection object as data
+    accepting - True if the server socket is registered in the selector
+    router - account index to route direct messages
+    evicted - connections to be closed once the current event is processed
+    metrics - server metrics
+    idle_wheel - timing wheel checking the connections for being idle
     """
-    def __init__(self, address: str = None, port: int = None):
+    def __init__(self, address: str = None, port: int = None, metrics_file: str = None):
         """
         Initialize parameters and open a TCP server socket
         :param address: IP address of the interface to wait for client connections on
         :param port: port to wait for client connections on
+        :param metrics_file: file to write the metrics snapshot to periodically
         If any of the parameters are not specified, defaults are used.
         """
         # process parameters
@@ -45,39 +84,154 @@ class Server:
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.bind((self.address, self.port))
-            self.socket.settimeout(sett.SERVER_SOCKET_TIMEOUT_SELECT)
+            self.socket.setblocking(False)
             self.socket.listen()
         except OSError as e:
             log.critical("Ошибка инициализации сервера: %s", e)
             exit(-1)
         self.connections = {}
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        self.accepting = True
+        self.router = routing.Router()
+        self.evicted = set()
+        self.metrics = metrics.Metrics()
+        self.metrics.gauge("connections", lambda: len(self.connections))
+        self.metrics.gauge("accounts", lambda: len(self.router.accounts))
+        self.idle_wheel = wheel.TimingWheel(sett.IDLE_WHEEL_TICK, sett.IDLE_WHEEL_SLOTS, time.monotonic())
+        metrics_file = metrics_file if metrics_file else sett.SERVER_METRICS_FILE
+        if metrics_file:
+            metrics.SnapshotWriter(self.metrics, metrics_file, name="Metrics").start()
 
-    def _accept_connection(self) -> bool:
+    def _set_accepting(self, accepting: bool):
+        """ Start or stop waiting for new connections by (un)registering the server socket in the selector """
+        if accepting != self.accepting:
+            if accepting:
+                self.selector.register(self.socket, selectors.EVENT_READ)
+            else:
+                log.warning("Достигнут максимум соединений - %d. Новые соединения не принимаются.",
+                            sett.SERVER_MAX_CONNECTIONS)
+                self.selector.unregister(self.socket)
+            self.accepting = accepting
+
+    def _accept_connections(self):
         """
-        Accept a pending connection if any, if maximum number of connection has not been reached.
-        Add a new connection to the connections dictionary.
-        :return: True if a new connection accepted, False if timeout or maximum number of connections reached
+        Accept up to SERVER_ACCEPT_BATCH pending connections while maximum number of connections has not been reached.
+        Add new connections to the connections dictionary and register them in the selector.
+        :return: None
         """
-        if len(self.connections) >= sett.SERVER_MAX_CONNECTIONS:
-            return False
-        try:
-            connection, address = self.socket.accept()
-        except TimeoutError:
-            log.debug("Нет новых запросов на соединение.")
-            return False                # Timeout - no client connection requests available
-        else:
-            log.info("Клиент %s Соединение установлено.", self.address)
-            connection.settimeout(0)
+        for _ in range(sett.SERVER_ACCEPT_BATCH):
+            if len(self.connections) >= sett.SERVER_MAX_CONNECTIONS:
+                self._set_accepting(False)
+                return
+            try:
+                connection, address = self.socket.accept()
+            except BlockingIOError:
+                return                  # No more client connection requests available
+            log.info("Клиент %s Соединение установлено.", address)
+            self.metrics.count("connections_accepted")
+            connection.setblocking(False)
             self.connections[connection] = Connection(
                 connection=connection,
                 address=address,
                 chat=jim.Chat()
             )
-            return True
+            self.selector.register(connection, selectors.EVENT_READ, self.connections[connection])
+            self.idle_wheel.schedule(self.connections[connection], time.monotonic() + sett.CONNECTION_PROBE_INTERVAL)
+
+    def _close_connection(self, connection: Connection):
+        """ Unregister the connection, close it and remove from the connections dictionary and the account index """
+        self.router.unregister(connection)
+        connection.output.clear()
+        self.selector.unregister(connection.connection)
+        connection.connection.close()
+        del self.connections[connection.connection]
+        if len(self.connections) < sett.SERVER_MAX_CONNECTIONS:
+            self._set_accepting(True)
+
+    def _update_events(self, connection: Connection):
+        """
+        Apply the PAUSE overflow policy and register the connection for the events it waits for:
+        for read readiness unless reading from it is paused, for write readiness while its output is pending
+        """
+        if connection.output.full and connection.output.policy == buffers.OverflowPolicy.PAUSE:
+            if not connection.paused:
+                log.warning("Клиент %s Чтение приостановлено - клиент не успевает получать данные (%d байт в очереди).",
+                            connection.address, len(connection.output))
+            connection.paused = True
+        elif connection.paused and connection.output.drained:
+            log.info("Клиент %s Чтение возобновлено.", connection.address)
+            connection.paused = False
+        events = 0 if connection.paused else selectors.EVENT_READ
+        if len(connection.output):
+            events |= selectors.EVENT_WRITE
+        if events != connection.events:
+            self.selector.modify(connection.connection, events, connection)
+            connection.events = events
+
+    def _send(self, connection: Connection, data: bytes):
+        """
+        Send data to the connection without blocking: data is queued to the connection output buffer
+        and sent at once if nothing else is pending, the rest is sent on write readiness.
+        A slow consumer the data can't be queued for is evicted - closed once the current event is processed.
+        """
+        pending = len(connection.output)
+        if not connection.put(data):
+            log.warning("Клиент %s Соединение закрывается - клиент не успевает получать данные (%d байт в очереди).",
+                        connection.address, len(connection.output))
+            self.evicted.add(connection)
+            return
+        self.metrics.count("bytes_out", len(data))
+        if not pending and not self._flush(connection):
+            self.evicted.add(connection)
+
+    def _flush(self, connection: Connection) -> bool:
+        """
+        Send pending output of the connection and update the events it waits for.
+        :return: True if succeeded, False if the connection failed
+        """
+        try:
+            connection.output.send_to(connection.connection)
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            log.info("Клиент %s Ошибка отправки: %s", connection.address, e)
+            return False
+        self._update_events(connection)
+        return True
+
+    def _send_replies(self, connection: Connection, replies: list):
+        """
+        Frame the replies and send them in one write. They are framed when written, not when made, as the frames
+        compressed in the stream of the connection must be sent in the order they have been compressed in -
+        and a message forwarded to the connection itself is framed and sent in between.
+        """
+        self._send(connection, b"".join(connection.frame(reply) for reply in replies))
+
+    def _forward(self, connection: Connection, message: bytes, forward_list: list) -> jim.Responses:
+        """
+        Forward the message to everyone else for BROADCAST_RECIPIENT or to the recipient's connection
+        :return: Responses.OK if forwarded to all the recipients, the status of the first failed recipient otherwise
+        """
+        status = jim.Responses.OK
+        for recipient in forward_list:
+            if recipient == jim.BROADCAST_RECIPIENT:
+                for other_connection in self.connections.values():
+                    if other_connection is not connection:
+                        self._send(other_connection, other_connection.frame(message, shared=True))
+                continue
+            recipient_status, other_connection = self.router.lookup(recipient)
+            if other_connection is None:
+                log.info("Клиент %s Адресат %s недоступен: %s", connection.address, recipient, recipient_status.name)
+                if status == jim.Responses.OK:
+                    status = recipient_status
+            else:
+                self._send(other_connection, other_connection.frame(message))
+        return status
 
     def _process_message(self, connection: Connection) -> bool:
         """
-        For the specified connection, receive a peer's message, process it and reply to it if needed
+        For the specified connection, receive the peer's messages, process them and reply to them in one write
         :return: True if message exchange succeeded, False if failed for some reason
         """
         try:
@@ -85,62 +239,126 @@ class Server:
             if not data:
                 log.info("Клиент %s Соединение закрыто клиентом.", connection.address)
                 return False
-            log.debug("Клиент %s Получено сообщение: %s", connection.address, data)
-            success, response, forward_list = connection.chat.process_encoded_message(data)
-            if not success:
-                log.error("Клиент %s %s", connection.address, connection.chat.error_str)
-            log.debug("Клиент %s Отправляется ответ: %s", connection.address, response)
-            connection.connection.send(response)
-
-            # Forward message to other clients if requested
-            if forward_list:
-                log.debug("Клиент %s Пересылка сообщения клиентам: %s", connection.address, forward_list)
-                for other_connection in self.connections:
-                    if other_connection.fileno() != connection.connection.fileno():
-                        other_connection.send(data)
+            started = time.perf_counter_ns()
+            connection.last_activity = time.monotonic()
+            self.metrics.count("bytes_in", len(data))
+            trace = server_log_config.sample_messages()
+            if trace:
+                log.debug("Клиент %s Получены данные: %s", connection.address, data)
+            replies = []
+            for success, response, forward_list, message in connection.chat.process_data(data):
+                chat = connection.chat
+                self.metrics.count_message(chat, success)
+                if not success:
+                    log.error("Клиент %s %s", connection.address, chat.error_str)
+                elif chat.action == jim.Actions.PRESENCE and chat.account_name:
+                    status = self.router.register(chat.account_name, connection)
+                    if status != jim.Responses.OK:
+                        log.error("Клиент %s Учетная запись %s уже подключена.", connection.address, chat.account_name)
+                        response = chat.encode_response(status)
+                elif chat.action == jim.Actions.HISTORY:
+                    response = chat.encode_response(jim.Responses.SERVER_ERROR, "История сообщений не ведется")
+                elif chat.action == jim.Actions.STATS:
+                    response = self.metrics.stats_response(self.router.account_name(connection), connection.address,
+                                                             chat.request_id)
+                elif forward_list:
+                    # Forward message to other clients
+                    if trace:
+                        log.debug("Клиент %s Пересылка сообщения клиентам: %s", connection.address, forward_list)
+                    status = self._forward(connection, message, forward_list)
+                    self.metrics.observe("fanout", started)
+                    if status != jim.Responses.OK:
+                        response = chat.encode_response(status)
+                if trace:
+                    log.debug("Клиент %s Отправляется ответ: %s", connection.address, response)
+                replies.append(response)
+                if chat.action == jim.Actions.PRESENCE:
+                    # Framed as negotiated before, the PRESENCE negotiation takes effect with the next message
+                    self._send_replies(connection, replies)
+                    replies.clear()
+                self.metrics.observe("processing", started)
+                if success and chat.action == jim.Actions.QUIT:
+                    log.info("Клиент %s Соединение закрывается по запросу клиента.", connection.address)
+                    self._send_replies(connection, replies)
+                    return False
+            if replies:
+                self._send_replies(connection, replies)
             return True
-        except TimeoutError:
-            log.info("Клиент %s Соединение закрывается по таймауту.", connection.address)
+        except BlockingIOError:
+            return True                 # Spurious readiness - nothing to read yet
+        except jim.FrameError as e:
+            log.error("Клиент %s Соединение закрывается - ошибка формата кадра: %s", connection.address, e)
+            if replies:
+                self._send_replies(connection, replies)
             return False
         except ConnectionResetError:
             log.info("Клиент %s Соединение закрыто клиентом.", connection.address)
             return False
 
-    def _process_messages(self):
+    def _check_idle(self, connection: Connection, now: float) -> float | None:
         """
-        Process all the connections ready to communicate.
-        If message exchange with a given connection fails, close it and remove from the connections list.
-        :return: None
+        Probe the client silent for CONNECTION_PROBE_INTERVAL, evict it if it is still silent
+        when CONNECTION_TIMEOUT - CONNECTION_PROBE_INTERVAL more has passed
+        :return: time the connection is to be checked again at, None if it is closed
         """
-        read_ready, _, _ = select.select(self.connections, [], [], sett.SERVER_SELECT_TIMEOUT)
-        if not read_ready:
-            log.debug("Нет новых запросов от существующих соединений.")
-        else:
-            for connection in read_ready:
-                if not self._process_message(self.connections[connection]):
-                    connection.close()
-                    del self.connections[connection]
+        if self.connections.get(connection.connection) is not connection:
+            return None
+        idle = now - connection.last_activity
+        if idle < sett.CONNECTION_PROBE_INTERVAL:
+            return connection.last_activity + sett.CONNECTION_PROBE_INTERVAL
+        if connection.probed != connection.last_activity:     # Not probed since the client has been heard from last
+            connection.probed = connection.last_activity
+            self._send(connection, connection.frame(jim.Message(jim.Actions.PROBE).encoded))
+            self.metrics.count("probes_sent")
+            return now + sett.CONNECTION_TIMEOUT - sett.CONNECTION_PROBE_INTERVAL
+        log.info("Клиент %s Соединение закрывается - нет ответа на PROBE (%d секунд).", connection.address, idle)
+        self.metrics.count("connections_expired")
+        self.evicted.add(connection)
+        return None
+
+    def _expire_idle(self):
+        """ Check the connections whose deadlines have passed """
+        now = time.monotonic()
+        for connection in self.idle_wheel.advance(now):
+            deadline = self._check_idle(connection, now)
+            if deadline is not None:
+                self.idle_wheel.schedule(connection, deadline)
+        while self.evicted:
+            self._close_connection(self.evicted.pop())
 
     def service_connections(self):
         """ Accept connections and process client messages """
         while True:
             log.debug("Старт цикла обслуживания соединений.")
-            print("Существующие соединения: ", end="")
-            print(self.connections)
-            # Accept all pending connections
-            while self._accept_connection():
-                pass
-            self._process_messages()
+            events = self.selector.select(sett.SERVER_SELECT_TIMEOUT)
+            if not events:
+                log.debug("Нет новых запросов.")
+            for key, mask in events:
+                connection = key.data
+                if connection is None:
+                    self._accept_connections()
+                    continue
+                if self.connections.get(connection.connection) is not connection:
+                    continue            # Closed while processing previous events
+                success = not mask & selectors.EVENT_WRITE or self._flush(connection)
+                if success and mask & selectors.EVENT_READ and not connection.paused:
+                    success = self._process_message(connection)
+                if not success:
+                    self.evicted.add(connection)
+                while self.evicted:
+                    self._close_connection(self.evicted.pop())
+            self._expire_idle()
 
 
 def main():
     # Parse command-line arguments
     parser = argparse.ArgumentParser()
     parser.add_argument('-address', required=False)
-    parser.add_argument('-port', required=False)
+    parser.add_argument('-port', required=False, type=int)
+    parser.add_argument('-metrics', required=False, help="file to write the metrics snapshot to periodically")
     args = parser.parse_args()
     # Create a server and start listening
-    server = Server(args.address, args.port)
+    server = Server(args.address, args.port, args.metrics)
     # Process client messages
     try:
         server.service_connections()
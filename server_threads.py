@@ -1,53 +1,334 @@
+import time
 import socket
-import select
+import selectors
 import argparse
 import logging
 import threading
 import queue
+import concurrent.futures
+from dataclasses import dataclass
 
 import settings as sett
 import jim
+import routing
+import registry
+import buffers
+import offline
+import history
+import metrics
+import wheel
 import server_log_config
 
 
-class Connection(threading.Thread):
+# message to be processed by the server queue thread - parsed once by the connection thread
+@dataclass(frozen=True, slots=True)
+class Envelope:
+    sender: "Connection"            # connection the message has been received from
+    recipients: list = None         # recipients to forward the message to
+    message: bytes = b""            # message as received, to be forwarded untouched
+    received: int = 0               # time.perf_counter_ns() the message has been received at
+
+
+class Connection:
     """
-    Connection thread class - handles individual client connections
+    Client connection - in the thread per connection mode serve() runs in a thread of its own,
+    in the worker pool mode the dispatcher receives the data and the worker pool processes it with process_data().
     ATTRIBUTES:
     chat: jim.Chat                  # chat instance
     connection: socket.socket       # connection instance
     address: (str, int)             # client address
     queue: queue.Queue              # client message queue for messages to be processed by the server
+    connections: registry.ConnectionRegistry    # server connection registry the connection removes itself from
+    router: routing.Router          # server account index to route direct messages
+    flusher: Flusher                # thread sending pending output when the socket becomes writable
+    dispatcher: Dispatcher          # worker pool mode - thread waiting for the socket to become readable, else None
+    offline: offline.OfflineStore   # store of the messages for offline accounts, else None
+    history: history.HistoryStore   # history of the messages routed, else None
+    metrics: metrics.Metrics        # server metrics
+    last_activity: float            # time.monotonic() data has been received from the client at last
+    probed: float                   # last_activity PROBE has been sent to the client at, None if never
+    output: buffers.OutputBuffer    # data waiting to be sent
+    output_lock: threading.Condition    # lock guarding output, notified when output drains or the client is evicted
+    evicted: bool                   # the client has been disconnected as a slow consumer
+    reading_paused: bool            # worker pool mode - the dispatcher waits for output to drain before reading
+    closed: bool                    # the connection has been closed
+    draining: str                   # account the stored messages sent last are to be acknowledged for, else None
     """
+    __slots__ = ("chat", "connection", "address", "queue", "connections", "router", "flusher", "dispatcher",
+                 "offline", "history", "metrics", "last_activity", "probed", "output", "output_lock", "evicted",
+                 "reading_paused", "closed", "draining")
+
     def __init__(self, connection: socket.socket, address: (str, int), message_queue: queue.Queue,
-                 *args, **kwargs):
-        super().__init__(*args, **kwargs)       # Initialize thread
-        self.daemon = True                      # Terminate when the main thread (main()) terminates
+                 connections: registry.ConnectionRegistry, flusher: "Flusher", dispatcher: "Dispatcher" = None,
+                 offline_store: offline.OfflineStore = None, history_store: history.HistoryStore = None,
+                 server_metrics: metrics.Metrics = None):
         self.connection = connection
         self.address = address
         self.chat = jim.Chat()
         self.queue = message_queue
+        self.connections = connections
+        self.router = connections.router
+        self.flusher = flusher
+        self.dispatcher = dispatcher
+        self.offline = offline_store
+        self.history = history_store
+        self.metrics = server_metrics if server_metrics else metrics.Metrics()
+        self.last_activity = time.monotonic()
+        self.probed = None
+        self.output = buffers.OutputBuffer()
+        self.output_lock = threading.Condition()
+        self.evicted = False
+        self.reading_paused = False
+        self.closed = False
+        self.draining = None
 
-    def _process_messages(self):
+    def send(self, data: bytes, droppable: bool = True):
+        """
+        Send data to the client without blocking: data is queued to the output buffer and sent at once
+        if nothing else is pending, the rest is sent by the flusher when the socket becomes writable.
+        A slow consumer the data can't be queued for is evicted. May be called from any thread.
+        :param droppable: False if the DROP policy must not drop the data, see OutputBuffer.put
         """
-        Receive the peer's message, process it and reply to it if needed.
-        :return: True if message exchange succeeded, False if failed for some reason
+        with self.output_lock:
+            if self.evicted:
+                return
+            pending = len(self.output)
+            # The frames compressed in the stream of the connection are dropped before they are compressed, see frame()
+            if not self.output.put(data, droppable=droppable and self.chat.compressor is None):
+                self._evict("клиент не успевает получать данные ({} байт в очереди)".format(len(self.output)))
+                return
+            self.metrics.count("bytes_out", len(data))
+            if not pending and self.flush():
+                self.flusher.watch(self)
+
+    def frame(self, payload: bytes, shared: bool = False, droppable: bool = True) -> bytes:
+        """
+        Frame the payload for the client, see Chat.frame
+        :return: frame, empty if the payload can't be sent in the wire format of the client - it is skipped then,
+        or if it is droppable and dropped before it is compressed, see send()
         """
+        if droppable and self.chat.compressor is not None and self.output.drops(payload):
+            return b""
         try:
-            while True:
-                data = self.connection.recv(sett.MAX_DATA_LEN)
-                if not data:
-                    log.info("Клиент %s Соединение закрыто клиентом.", self.address)
-                    break
-                log.debug("Клиент %s Получено сообщение: %s", self.address, data)
-                chat_success, response, forward_list = self.chat.process_encoded_message(data)
+            return self.chat.frame(payload, shared)
+        except ValueError as e:
+            log.error("Клиент %s Сообщение не отправлено (%s): %s", self.address, e, payload[:100])
+            return b""
+
+    def deliver(self, *payloads: bytes, shared: bool = False, droppable: bool = True):
+        """
+        Frame the payloads and send them in one write. The payloads are framed under the output lock,
+        as the compressed frames must be sent in the order they have been compressed in. May be called from any thread.
+        :param shared: the payloads are broadcast to many clients, see Chat.frame
+        :param droppable: False if the DROP policy must not drop the payloads, see send()
+        """
+        with self.output_lock:
+            self.send(b"".join(self.frame(payload, shared, droppable) for payload in payloads), droppable)
+
+    def flush(self) -> bool:
+        """
+        Send as much pending output as the socket takes; must be called with output_lock acquired.
+        :return: True if some output is still pending
+        """
+        if self.evicted:
+            return False
+        try:
+            self.output.send_to(self.connection, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            self._evict("ошибка отправки: {}".format(e))
+        if self.output.drained:
+            self.output_lock.notify_all()
+            self._resume_reading()
+            self._continue_draining()
+        return len(self.output) > 0
+
+    def _evict(self, reason: str):
+        """ Disconnect the client - its thread exits once recv() fails; must be called with output_lock acquired """
+        log.warning("Клиент %s Соединение закрывается - %s.", self.address, reason)
+        self.evicted = True
+        self.output.clear()
+        self.output_lock.notify_all()
+        self._resume_reading()                  # Let the dispatcher find out the socket is shut down
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _resume_reading(self):
+        """ Worker pool mode - hand the connection back to the dispatcher; must be called with output_lock acquired """
+        if self.reading_paused:
+            self.reading_paused = False
+            log.info("Клиент %s Чтение возобновлено.", self.address)
+            self.dispatcher.watch(self)
+
+    def _wait_for_output(self):
+        """ Apply the PAUSE overflow policy - don't read from the client until its output drains """
+        with self.output_lock:
+            if self.output.full and self.output.policy == buffers.OverflowPolicy.PAUSE:
+                log.warning("Клиент %s Чтение приостановлено - клиент не успевает получать данные (%d байт в очереди).",
+                            self.address, len(self.output))
+                self.output_lock.wait_for(lambda: self.output.drained or self.evicted)
+                log.info("Клиент %s Чтение возобновлено.", self.address)
+
+    def _check_recipients(self, forward_list: list) -> jim.Responses:
+        """
+        Check the recipients are connected before the message is queued for forwarding
+        :return: Responses.OK if all the recipients are available, the status of the first unavailable one otherwise,
+        Responses.ACCEPTED if some of the recipients are offline and the message is to be stored for them
+        """
+        result = jim.Responses.OK
+        for recipient in forward_list:
+            if recipient != jim.BROADCAST_RECIPIENT:
+                status, _ = self.router.lookup(recipient)
+                if status == jim.Responses.GONE and self.offline:
+                    log.info("Клиент %s Адресат %s не в сети, сообщение сохраняется.", self.address, recipient)
+                    result = jim.Responses.ACCEPTED
+                elif status != jim.Responses.OK:
+                    log.info("Клиент %s Адресат %s недоступен: %s", self.address, recipient, status.name)
+                    return status
+        return result
+
+    def check_idle(self, now: float) -> float | None:
+        """
+        Probe the client silent for CONNECTION_PROBE_INTERVAL, evict it if it is still silent
+        when CONNECTION_TIMEOUT - CONNECTION_PROBE_INTERVAL more has passed; called by the heartbeat thread
+        :return: time the connection is to be checked again at, None if it has been closed
+        """
+        if self.closed or self.evicted:
+            return None
+        idle = now - self.last_activity
+        if idle < sett.CONNECTION_PROBE_INTERVAL:
+            return self.last_activity + sett.CONNECTION_PROBE_INTERVAL
+        if self.probed != self.last_activity:     # Not probed since the client has been heard from last
+            self.probed = self.last_activity
+            self.deliver(jim.Message(jim.Actions.PROBE).encoded)
+            self.metrics.count("probes_sent")
+            return now + sett.CONNECTION_TIMEOUT - sett.CONNECTION_PROBE_INTERVAL
+        self.metrics.count("connections_expired")
+        with self.output_lock:
+            self._evict("нет ответа на PROBE ({:.0f} секунд)".format(idle))
+        return None
+
+    def _query_history(self) -> bytes | None:
+        """
+        Have the history requested sent to the client when the history thread reads it
+        :return: None if the request has been queued, the encoded error response otherwise
+        """
+        if not self.history:
+            return self.chat.encode_response(jim.Responses.SERVER_ERROR, "История сообщений не ведется")
+        account_name = self.router.account_name(self)
+        if account_name is None:
+            return self.chat.encode_response(jim.Responses.LOGIN_REQUIRED)
+        self.history.query(account_name, self.chat.history_request,
+                           lambda response: self.deliver(response))
+        return None
+
+    def _deliver_stored(self, messages: list):
+        """
+        Send a chunk of the messages stored for the account of the connection in one write; called by the store thread.
+        The chunk is acknowledged and the next one taken once the output drains; until then it stays stored,
+        so a chunk the client is disconnected before is delivered at its next PRESENCE
+        """
+        account_name = self.router.account_name(self)
+        if self.closed or account_name is None:
+            log.info("Клиент %s Учетная запись отключилась, сообщения остаются в хранилище.", self.address)
+            return
+        log.info("Клиент %s Доставляется %d сохраненных сообщений.", self.address, len(messages))
+        with self.output_lock:
+            self.deliver(*messages, droppable=False)
+            if not self.evicted:
+                self.draining = account_name
+                self._continue_draining()
+
+    def _continue_draining(self):
+        """ Acknowledge the chunk of stored messages once the output has drained; must be called with output_lock """
+        if self.draining is not None and self.output.drained and not self.evicted:
+            self.offline.drain(self.draining, self._deliver_stored, acknowledged=True)
+            self.draining = None
+
+    def process_data(self, data: bytes) -> bool:
+        """
+        Process the data received from the client: reply to every complete message in it, in one write,
+        and queue the messages to be forwarded to the server queue.
+        :param data: data received, empty if the connection has been closed by the client
+        :return: True if the connection is to be kept, False if it is to be closed
+        """
+        if not data:
+            log.info("Клиент %s Соединение закрыто клиентом.", self.address)
+            return False
+        started = time.perf_counter_ns()
+        self.last_activity = time.monotonic()
+        self.metrics.count("bytes_in", len(data))
+        trace = server_log_config.sample_messages()
+        if trace:
+            log.debug("Клиент %s Получены данные: %s", self.address, data)
+        replies = []
+        try:
+            for chat_success, response, forward_list, message in self.chat.process_data(data):
+                self.metrics.count_message(self.chat, chat_success)
+                forward = False
                 if not chat_success:
                     log.error("Клиент %s %s", self.address, self.chat.error_str)
-                log.debug("Клиент %s Отправляется ответ: %s", self.address, response)
-                self.connection.send(response)
+                elif self.chat.action == jim.Actions.PRESENCE and self.chat.account_name:
+                    status = self.router.register(self.chat.account_name, self)
+                    if status != jim.Responses.OK:
+                        log.error("Клиент %s Учетная запись %s уже подключена.",
+                                  self.address, self.chat.account_name)
+                        response = self.chat.encode_response(status)
+                    elif self.offline:
+                        self.offline.drain(self.chat.account_name, self._deliver_stored)
+                elif self.chat.action == jim.Actions.HISTORY:
+                    response = self._query_history()
+                    if response is None:
+                        continue                        # The response is sent once the history is read
+                elif self.chat.action == jim.Actions.STATS:
+                    response = self.metrics.stats_response(self.router.account_name(self), self.address,
+                                                             self.chat.request_id)
+                elif forward_list:
+                    status = self._check_recipients(forward_list)
+                    forward = status in (jim.Responses.OK, jim.Responses.ACCEPTED)
+                    if status != jim.Responses.OK:
+                        response = self.chat.encode_response(status)
+                if trace:
+                    log.debug("Клиент %s Отправляется ответ: %s", self.address, response)
+                replies.append(response)
+                if self.chat.action == jim.Actions.PRESENCE:
+                    # Framed as negotiated before, the PRESENCE negotiation takes effect right after the reply -
+                    # atomically, as the other threads may be delivering to the account registered already
+                    with self.output_lock:
+                        self.deliver(*replies)
+                        self.chat.apply_negotiation()
+                    replies.clear()
+                self.metrics.observe("processing", started)
                 # Forward message to server to send it to other clients if requested
-                if forward_list:
-                    self.queue.put((data, self.connection))
+                if forward:
+                    self.queue.put(Envelope(self, forward_list, message, started))
+                    if self.history:
+                        self.history.record(self.chat.account_name or "", message)
+                elif chat_success and self.chat.action == jim.Actions.QUIT:
+                    log.info("Клиент %s Соединение закрывается по запросу клиента.", self.address)
+                    self.deliver(*replies)
+                    return False
+        except jim.FrameError as e:
+            log.error("Клиент %s Соединение закрывается - ошибка формата кадра: %s", self.address, e)
+            if replies:
+                self.deliver(*replies)
+            return False
+        if replies:
+            self.deliver(*replies)
+        return True
+
+    def _process_messages(self):
+        """
+        Receive the peer's messages, process them and reply to them until the connection is to be closed.
+        """
+        try:
+            while True:
+                self._wait_for_output()
+                if not self.process_data(self.connection.recv(sett.MAX_DATA_LEN)):
+                    break
         except TimeoutError:
             log.info("Клиент %s Соединение закрывается по таймауту.", self.address)
         except ConnectionResetError:
@@ -55,50 +336,76 @@ class Connection(threading.Thread):
         except Exception as e:
             log.critical("Клиент %s Неизвестная ошибка клиента: %s: %s", self.address, type(e), e)
 
-    def run(self):
+    def close(self):
+        """ Close the connection and let the server forget it at once """
+        self.router.unregister(self)
+        if self.connections.remove(self):
+            log.info("Клиент %s Соединение удаляется (всего %d соединений).", self.address, len(self.connections))
+        with self.output_lock:
+            self.evicted = True                 # Nothing more to send
+            self.closed = True
+            self.connection.close()
+        self.flusher.watch(self)                # Let the flusher forget the connection
+
+    def serve(self):
+        """ Thread per connection mode: process the client's messages in the current thread until it disconnects """
         log.debug("Клиент %s Поток запущен.", self.address)
         self._process_messages()
-        self.connection.close()
-        self.queue.put((jim.Message(jim.Actions.QUIT).json.encode(sett.DEFAULT_ENCODING), self.connection))
+        self.close()
         log.debug("Клиент %s Поток завершен.", self.address)
 
 
 class ServiceQueue(threading.Thread):
     """
     ATTRIBUTES:
-    connections - client connections dictionary with sockets as keys
+    connections - server connection registry, broadcasts iterate its snapshot without locking
     queue - client message queue for messages to be processed by the server
+    router - server account index to route direct messages
+    offline - store of the messages for offline accounts, else None
+    metrics - server metrics
     """
-    def __init__(self, message_queue: queue.Queue, connections: dict, *args, **kwargs):
+    def __init__(self, message_queue: queue.Queue, connections: registry.ConnectionRegistry,
+                 offline_store: offline.OfflineStore = None, server_metrics: metrics.Metrics = None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.daemon = True
         self.queue = message_queue
         self.connections = connections
+        self.router = connections.router
+        self.offline = offline_store
+        self.metrics = server_metrics if server_metrics else metrics.Metrics()
+
+    def _forward(self, envelope: Envelope):
+        """
+        Forward the message to everyone else for BROADCAST_RECIPIENT or to the recipient's connection
+        """
+        message_bytes = envelope.message
+        for recipient in envelope.recipients:
+            if recipient == jim.BROADCAST_RECIPIENT:
+                for other_connection in self.connections.connections:
+                    if other_connection is not envelope.sender:
+                        other_connection.deliver(message_bytes, shared=True)
+                continue
+            status, other_connection = self.router.lookup(recipient)
+            if status == jim.Responses.GONE and self.offline:
+                self.offline.put(recipient, message_bytes)
+            elif other_connection is None:      # Disconnected after the message was queued
+                log.info("Адресат %s недоступен: %s", recipient, status.name)
+            else:
+                other_connection.deliver(message_bytes)
 
     def service_queue(self):
         """
         Service the client message queue.
         """
         while True:
-            log.debug("Ожидание очереди сообщений клиентов")
-            message_bytes, connection = self.queue.get()      # Get tuple from queue
-            address = self.connections[connection].address
+            envelope = self.queue.get()
+            address = envelope.sender.address
             try:
-                message = jim.Message.from_str(message_bytes.decode(sett.DEFAULT_ENCODING))
-            except ValueError as e:
-                log.error("Клиент %s Некорректное сообщение (%s): %s", address, e, message_bytes)
-            else:
-                if message.action == jim.Actions.MESSAGE:
-                    log.debug("Клиент %s Пересылка сообщения адресатам: %s", address, message_bytes)
-                    for other_connection in self.connections:
-                        if other_connection.fileno() != connection.fileno():
-                            other_connection.send(message_bytes)
-                elif message.action == jim.Actions.QUIT:
-                    log.info("Клиент %s Соединение закрывается по запросу клиента.", address)
-                    connection.close()
-                    del self.connections[connection]
-                else:
-                    log.error("Клиент %s Неподдерживаемый запрос (%s): %s", address, message.action, message_bytes)
+                if server_log_config.sample_messages():
+                    log.debug("Клиент %s Пересылка сообщения адресатам %s: %s",
+                              address, envelope.recipients, envelope.message)
+                self._forward(envelope)
+                self.metrics.observe("fanout", envelope.received)
             finally:
                 self.queue.task_done()
 
@@ -106,22 +413,202 @@ class ServiceQueue(threading.Thread):
         self.service_queue()
 
 
+class Flusher(threading.Thread):
+    """
+    Sends pending output of the connections when their sockets become writable,
+    so that no thread ever blocks sending to a slow client.
+    ATTRIBUTES:
+    selector - write readiness selector with the connections having pending output
+    watched - queue of connections to (un)register in the selector, is only read by the flusher itself
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.daemon = True
+        self.selector = selectors.DefaultSelector()
+        self.watched = queue.SimpleQueue()
+        self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+        self._wakeup_receiver.setblocking(False)
+        self.selector.register(self._wakeup_receiver, selectors.EVENT_READ)
+
+    def watch(self, connection: Connection):
+        """ Ask the flusher to wait for the connection socket to become writable - or to forget a closed one """
+        self.watched.put(connection)
+        self._wakeup_sender.send(b"\0")
+
+    def _update_watched(self):
+        try:
+            while self._wakeup_receiver.recv(sett.MAX_DATA_LEN):
+                pass
+        except BlockingIOError:
+            pass
+        while not self.watched.empty():
+            connection = self.watched.get()
+            registered = self._is_registered(connection)
+            with connection.output_lock:
+                active = not connection.evicted and len(connection.output) > 0
+            if active and not registered:
+                self.selector.register(connection.connection, selectors.EVENT_WRITE, connection)
+            elif not active and registered:
+                self.selector.unregister(connection.connection)
+
+    def _is_registered(self, connection: Connection) -> bool:
+        try:
+            return self.selector.get_key(connection.connection).data is connection
+        except (KeyError, ValueError):
+            return False
+
+    def run(self):
+        while True:
+            for key, _ in self.selector.select():
+                connection = key.data
+                if connection is None:
+                    self._update_watched()
+                    continue
+                with connection.output_lock:
+                    pending = connection.flush()
+                if not pending:
+                    self.selector.unregister(connection.connection)
+
+
+class Heartbeat(threading.Thread):
+    """
+    Probes the idle clients and disconnects the ones not answering, keeping the connection deadlines
+    in a timing wheel
+    ATTRIBUTES:
+    idle_wheel - timing wheel with the connections to check, is only used by the heartbeat thread itself
+    watched - queue of new connections to be added to the wheel
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.daemon = True
+        self.idle_wheel = wheel.TimingWheel(sett.IDLE_WHEEL_TICK, sett.IDLE_WHEEL_SLOTS, time.monotonic())
+        self.watched = queue.SimpleQueue()
+
+    def watch(self, connection: Connection):
+        self.watched.put(connection)
+
+    def run(self):
+        while True:
+            time.sleep(self.idle_wheel.tick)
+            while not self.watched.empty():
+                connection = self.watched.get()
+                self.idle_wheel.schedule(connection, connection.last_activity + sett.CONNECTION_PROBE_INTERVAL)
+            now = time.monotonic()
+            for connection in self.idle_wheel.advance(now):
+                deadline = connection.check_idle(now)
+                if deadline is not None:
+                    self.idle_wheel.schedule(connection, deadline)
+
+
+class Dispatcher(threading.Thread):
+    """
+    Worker pool mode: waits for the client sockets to become readable, receives the data and hands it over
+    to a fixed pool of worker threads, so the number of threads doesn't depend on the number of clients.
+    A socket is not waited for while its data is being processed, so the messages of a client are processed
+    in order by one worker at a time and the pool never has more than one task per client queued.
+    ATTRIBUTES:
+    selector - read readiness selector with the connections waiting for data
+    pool_size - number of worker threads
+    pool - worker threads processing the data received
+    watched - queue of connections to register in the selector, is only read by the dispatcher itself
+    """
+    def __init__(self, pool_size: int = None, *args, **kwargs):
+        """
+        :param pool_size: number of worker threads, sett.SERVER_WORKER_POOL_SIZE if not specified
+        """
+        super().__init__(*args, **kwargs)
+        self.daemon = True
+        self.selector = selectors.DefaultSelector()
+        self.pool_size = pool_size if pool_size else sett.SERVER_WORKER_POOL_SIZE
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="Worker")
+        self.watched = queue.SimpleQueue()
+        self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+        self._wakeup_receiver.setblocking(False)
+        self.selector.register(self._wakeup_receiver, selectors.EVENT_READ)
+
+    def watch(self, connection: Connection):
+        """ Ask the dispatcher to wait for the connection socket to become readable """
+        self.watched.put(connection)
+        self._wakeup_sender.send(b"\0")
+
+    def _update_watched(self):
+        try:
+            while self._wakeup_receiver.recv(sett.MAX_DATA_LEN):
+                pass
+        except BlockingIOError:
+            pass
+        while not self.watched.empty():
+            connection = self.watched.get()
+            with connection.output_lock:
+                if connection.closed:
+                    continue
+                # Apply the PAUSE overflow policy - the flusher hands the connection back once its output drains
+                if not connection.evicted and connection.output.full \
+                        and connection.output.policy == buffers.OverflowPolicy.PAUSE:
+                    log.warning("Клиент %s Чтение приостановлено - клиент не успевает получать данные "
+                                "(%d байт в очереди).", connection.address, len(connection.output))
+                    connection.reading_paused = True
+                    continue
+            self.selector.register(connection.connection, selectors.EVENT_READ, connection)
+
+    def _dispatch(self, connection: Connection):
+        """ Receive the data from the readable socket and pass it to the worker pool """
+        self.selector.unregister(connection.connection)
+        try:
+            data = connection.connection.recv(sett.MAX_DATA_LEN)
+        except OSError as e:
+            log.info("Клиент %s Соединение разорвано: %s", connection.address, e)
+            data = None
+        self.pool.submit(self._process, connection, data)
+
+    def _process(self, connection: Connection, data: bytes | None):
+        """ Process the data in a worker thread, then wait for more data or close the connection """
+        try:
+            keep = data is not None and connection.process_data(data)
+        except Exception as e:
+            log.critical("Клиент %s Неизвестная ошибка клиента: %s: %s", connection.address, type(e), e)
+            keep = False
+        if keep:
+            self.watch(connection)
+        else:
+            connection.close()
+
+    def run(self):
+        while True:
+            for key, _ in self.selector.select():
+                if key.data is None:
+                    self._update_watched()
+                else:
+                    self._dispatch(key.data)
+
+
 class Server(threading.Thread):
     """
     ATTRIBUTES:
     address - server address
     port - server port
     socket - server socket
-    connections - client connections dictionary with sockets as keys
+    connections - client connection registry, connections remove themselves from it when closed
     queue - client message queue for messages to be processed by the server
     queue_thread - queue processing thread
-    !!! IMPLEMENT LOCK ON CONNECTIONS!!!
+    flusher - thread sending pending output of the connections
+    router - account index to route direct messages
+    mode - 'connection' to start a thread per connection, 'pool' to process all of them with the worker pool
+    dispatcher - worker pool mode - thread receiving the data and passing it to the worker pool, else None
+    offline - store of the messages for offline accounts
+    history - history of the messages routed
+    metrics - server metrics
+    metrics_file - file to write the metrics snapshot to periodically, if any
+    heartbeat - thread probing the idle clients
     """
-    def __init__(self, address: str = None, port: int = None, *args, **kwargs):
+    def __init__(self, address: str = None, port: int = None, mode: str = None, metrics_file: str = None,
+                 *args, **kwargs):
         """
         Initialize parameters and open a TCP server socket
         :param address: IP address of the interface to wait for client connections on
         :param port: port to wait for client connections on
+        :param mode: 'connection' or 'pool', see the mode attribute
+        :param metrics_file: file to write the metrics snapshot to periodically
         If any of the parameters are not specified, defaults are used.
         """
         super().__init__(*args, **kwargs)
@@ -130,41 +617,61 @@ class Server(threading.Thread):
         self.address = address if address else sett.DEFAULT_LISTEN_ADDRESS
         self.port = port if port else sett.DEFAULT_PORT
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.connections = {}
+        self.router = routing.Router()
+        self.connections = registry.ConnectionRegistry(self.router)
         self.queue = queue.Queue(sett.SERVER_QUEUE_MAXSIZE)
         self.queue_thread = None
+        self.flusher = Flusher(name="Flusher")
+        self.heartbeat = Heartbeat(name="Heartbeat")
+        self.mode = mode if mode else sett.SERVER_THREADS_MODE
+        self.dispatcher = Dispatcher(name="Dispatcher") if self.mode == "pool" else None
+        self.offline = offline.OfflineStore(name="Offline")
+        self.router.known_accounts.update(self.offline.accounts())
+        self.history = history.HistoryStore(name="History")
+        self.metrics = metrics.Metrics()
+        self.metrics.gauge("connections", lambda: len(self.connections))
+        self.metrics.gauge("accounts", lambda: len(self.router.accounts))
+        self.metrics.gauge("queue_depth", self.queue.qsize)
+        self.metrics_file = metrics_file if metrics_file else sett.SERVER_METRICS_FILE
 
     def accept_connections(self):
         """
         Accept connections if maximum number of connection has not been reached,
         otherwise send server error message until number of connections falls below maximum.
-        Create a new connection, add it to the connections dictionary and start the new connection's thread.
+        Create a new connection, add it to the connection registry and start the new connection's thread
+        or hand the connection to the dispatcher in the worker pool mode.
         :return: None
         """
         while True:
             # Accept connection
             log.debug("Ожидание входящих соединений.")
-            print("Существующие соединения: ", end="")
-            print(self.connections)
-            print(threading.enumerate())
-            print(f"Queue size: {self.queue.qsize()}")
             connection, address = self.socket.accept()
+            client = Connection(connection=connection,
+                                address=address,
+                                message_queue=self.queue,
+                                connections=self.connections,
+                                flusher=self.flusher,
+                                dispatcher=self.dispatcher,
+                                offline_store=self.offline,
+                                history_store=self.history,
+                                server_metrics=self.metrics)
             # If maximum number of connections reached, send error message and close connection
-            if len(self.connections) >= sett.SERVER_MAX_CONNECTIONS:
-                log.warning("Достигнут максимум соединений - %d. Попытка собрать мусор.")
-                # delete dead daemons
-                self.connections = dict([(key, value) for key, value in self.connections.items() if value.is_alive()])
-                if len(self.connections) >= sett.SERVER_MAX_CONNECTIONS:
-                    log.error("Клиент %s Отказ в соединении - достигнут максимум (%d).",
-                              address, sett.SERVER_MAX_CONNECTIONS)
-                    connection.send(jim.Response(jim.Responses.SERVER_ERROR).json.encode(sett.DEFAULT_ENCODING))
-                    connection.close()
+            if not self.connections.add(client, sett.SERVER_MAX_CONNECTIONS):
+                log.error("Клиент %s Отказ в соединении - достигнут максимум (%d).",
+                          address, sett.SERVER_MAX_CONNECTIONS)
+                connection.send(jim.encode_frame(jim.encode_response(jim.Responses.SERVER_ERROR),
+                                                 sett.DEFAULT_FRAMING))
+                connection.close()
+                self.metrics.count("connections_rejected")
             else:
-                self.connections[connection] = Connection(connection=connection,
-                                                          address=address,
-                                                          message_queue=self.queue,
-                                                          name="Client-" + "-".join([str(token) for token in address]))
-                self.connections[connection].start()
+                self.metrics.count("connections_accepted")
+                self.heartbeat.watch(client)
+                if self.dispatcher:
+                    self.dispatcher.watch(client)
+                else:
+                    # Terminate when the main thread (main()) terminates
+                    threading.Thread(target=client.serve, name="Client-" + "-".join([str(token) for token in address]),
+                                     daemon=True).start()
                 log.info("Клиент %s Соединение установлено (всего %d соединений).",
                          address, len(self.connections))
 
@@ -180,8 +687,17 @@ class Server(threading.Thread):
             return
         # Start queue processing thread
         self.queue_thread = ServiceQueue(message_queue=self.queue, connections=self.connections,
-                                         name="Queue")
+                                         offline_store=self.offline, server_metrics=self.metrics, name="Queue")
         self.queue_thread.start()
+        self.offline.start()
+        self.history.start()
+        if self.metrics_file:
+            metrics.SnapshotWriter(self.metrics, self.metrics_file, name="Metrics").start()
+        self.flusher.start()
+        self.heartbeat.start()
+        if self.dispatcher:
+            log.critical("Сообщения обрабатываются пулом из %d потоков.", self.dispatcher.pool_size)
+            self.dispatcher.start()
         # Accept incoming connections
         self.accept_connections()
 
@@ -190,10 +706,12 @@ def main():
     # Parse command-line arguments
     parser = argparse.ArgumentParser()
     parser.add_argument('-address', required=False)
-    parser.add_argument('-port', required=False)
+    parser.add_argument('-port', required=False, type=int)
+    parser.add_argument('-mode', required=False, choices=("connection", "pool"))
+    parser.add_argument('-metrics', required=False, help="file to write the metrics snapshot to periodically")
     args = parser.parse_args()
     # Create a server thread and start listening
-    server = Server(args.address, args.port, name="Server")
+    server = Server(args.address, args.port, args.mode, args.metrics, name="Server")
     server.start()
     # Process client messages
     try:
@@ -1,18 +1,70 @@
+import os
 import logging
 
 DEFAULT_PORT = 7777
 DEFAULT_LISTEN_ADDRESS = ''
 DEFAULT_SERVER_ADDRESS = '127.0.0.1'
 DEFAULT_ENCODING = 'UTF-8'
-MAX_DATA_LEN = 4096             # Maximum data size of the JIM message
-CONNECTION_TIMEOUT = 60         # Connection timeout in seconds
-SERVER_SOCKET_TIMEOUT_SELECT = 0.2      # Server socket timeout in seconds - select() version
-SERVER_SELECT_TIMEOUT = 1.0     # Server timeout for select.select() function waiting for clients
+JIM_JSON_BACKEND = None         # JSON backend: 'orjson', 'ujson', 'json' or None for the fastest one installed
+MAX_DATA_LEN = 4096             # Maximum data size received at once
+MAX_MESSAGE_LEN = 4096          # Maximum data size of the JIM message - longer ones are rejected without parsing
+MAX_FRAME_LEN = 64 * 1024       # Maximum JIM frame size - the connection is closed if exceeded
+DEFAULT_FRAMING = 'line'        # JIM framing in effect when a connection is established
+CLIENT_FRAMING = 'length'       # JIM framing the client requests at PRESENCE
+CLIENT_WIRE = 'json'            # JIM wire format the client requests at PRESENCE: 'json' or 'binary'
+CLIENT_COMPRESSION = 'none'     # JIM compression the client requests at PRESENCE: 'none' or 'zlib'
+COMPRESSION_THRESHOLD = 128     # Compression - payloads shorter than this are sent as is
+COMPRESSION_LEVEL = 6           # Compression - zlib level, 1 (fastest) to 9 (smallest)
+COMPRESSION_WINDOW_BITS = 12    # Compression - deflate window of 2 ** bits bytes and...
+COMPRESSION_MEM_LEVEL = 4       # ... zlib memory level, together about 24 KB of buffers per connection stream
+CONNECTION_TIMEOUT = 60         # Connection timeout in seconds - a client silent this long is disconnected...
+CONNECTION_PROBE_INTERVAL = 30  # ... after it has been sent PROBE for being silent this long
+IDLE_WHEEL_TICK = 1.0           # Idle connection timing wheel - tick duration in seconds...
+IDLE_WHEEL_SLOTS = 64           # ... and number of slots, best covering CONNECTION_TIMEOUT
+SERVER_SELECT_TIMEOUT = 1.0     # Server timeout for selector waiting for clients - select() version
+SERVER_ACCEPT_BATCH = 64        # Maximum connections accepted per server socket readiness - select() version
 SERVER_MAX_CONNECTIONS = 100    # Maximum number of server connections
+SERVER_OUTPUT_POLICY = 'pause'  # Slow consumer policy: 'drop' data, 'disconnect' consumer, 'pause' reading from it
+SERVER_OUTPUT_HIGH_WATERMARK = 256 * 1024   # Connection output size the consumer is considered slow above
+SERVER_OUTPUT_LOW_WATERMARK = 64 * 1024     # Connection output size the consumer is considered to have caught up at
+SERVER_OUTPUT_HARD_LIMIT = 1024 * 1024      # Maximum connection output size - the consumer is disconnected above it
 CLIENT_SELECT_TIMEOUT = 60.0     # Client timeout for select.select() function waiting for data
+CLIENT_REQUEST_WINDOW = 32       # Maximum number of requests the client sends without waiting for responses
+DEFAULT_ACCOUNT_NAME = 'test'    # Client account name if not specified in the command line
 
 SERVER_SOCKET_TIMEOUT_THREADS = 1.0     # Server socket timeout in seconds - threads version
 SERVER_QUEUE_MAXSIZE = 100              # Threads server - client message queue maximum size
+SERVER_THREADS_MODE = 'connection'      # Threads server - 'connection': thread per client, 'pool': worker pool
+SERVER_WORKER_POOL_SIZE = os.cpu_count() or 4   # Threads server - worker threads processing messages in 'pool' mode
+
+SERVER_ASYNCIO_MAX_CONNECTIONS = 100000 # Maximum number of server connections - asyncio version
+SERVER_ASYNCIO_BACKLOG = 1024           # Listening socket backlog - asyncio version
+CLUSTER_WORKERS = os.cpu_count() or 4   # Multi-process server - number of worker processes
+FEDERATION_RECONNECT_DELAY = 1.0        # Federation - seconds to wait before linking to a node again, doubled...
+FEDERATION_RECONNECT_MAX_DELAY = 30.0   # ... on every failure up to this value
+FEDERATION_ROUTE_BATCH = 1000           # Federation - maximum accounts advertised in one ROUTE message
+FEDERATION_RECENT_RELAYS = 10000        # Federation - number of recent relay ids kept to drop duplicates
+
+OFFLINE_DIRECTORY = 'offline'           # Offline store - directory of the message queues of offline accounts
+OFFLINE_SEGMENT_SIZE = 1024 * 1024      # Offline store - queue segment file size to start a new segment at
+OFFLINE_MAX_ACCOUNT_BYTES = 16 * 1024 * 1024    # Offline store - maximum queue size, the oldest segments are dropped
+OFFLINE_TTL = 7 * 24 * 3600.0           # Offline store - seconds a message is kept for
+OFFLINE_EXPIRE_INTERVAL = 60.0          # Offline store - seconds between expired segment removals
+OFFLINE_BATCH = 1000                    # Offline store - maximum requests written in one batch
+OFFLINE_DRAIN_BYTES = 128 * 1024        # Offline store - size of the stored messages sent at once
+OFFLINE_FSYNC = False                   # Offline store - flush every batch to the disk before the next one
+HISTORY_DATABASE = 'history.sqlite3'    # History - SQLite database file
+HISTORY_PAGE_SIZE = 100                 # History - maximum messages returned for one HISTORY request...
+HISTORY_PAGE_BYTES = 48 * 1024          # ... and their maximum total size, to fit in a frame
+HISTORY_BATCH = 1000                    # History - maximum messages written in one transaction
+SERVER_ADMIN_ACCOUNTS = ('admin', )     # Accounts allowed to read the server metrics with STATS...
+SERVER_ADMIN_ADDRESSES = ('127.0.0.1', '::1')   # ... connected from these addresses only, the names aren't secret
+SERVER_METRICS_FILE = None              # File to write the server metrics snapshot to periodically, if any
+SERVER_METRICS_INTERVAL = 10.0          # Seconds between the metrics snapshots
+
+LOADTEST_PORT = 7790                    # Load test - port to start the server on
+LOADTEST_SERVER_START_TIMEOUT = 10.0    # Load test - seconds to wait for the server to accept connections
+LOADTEST_DELIVERY_TIMEOUT = 5.0         # Load test - seconds to wait for the messages to be delivered after sending
 
 DIRECTORY_SEPARATOR = '/'
 
@@ -28,6 +80,9 @@ SERVER_LOG_FILENAME = DIRECTORY_SEPARATOR.join((LOG_DIRECTORY, 'server.log'))
 SERVER_LOG_BACKUP_DAYS_COUNT = 10       # Log backup days for daily logs
 SERVER_LOG_FILE_LEVEL = logging.NOTSET
 SERVER_LOG_FORMAT = "%(asctime)s %(levelname)-10s %(module)s %(threadName)-30s %(message)s"
+SERVER_LOG_QUEUE = True                 # Write the log in a background thread, see server_log_config.py
+SERVER_LOG_QUEUE_SIZE = 10000           # Maximum records waiting to be written - more are dropped
+SERVER_LOG_MESSAGES_SAMPLE = 100        # Write debug records of every N-th message only, or none if 0
 # Client log
 CLIENT_LOG_NAME = 'app.client'
 CLIENT_LOG_FILENAME = DIRECTORY_SEPARATOR.join((LOG_DIRECTORY, 'client.log'))
@@ -0,0 +1,40 @@
+import socket
+import unittest
+
+import buffers
+
+
+class TestOutputBuffer(unittest.TestCase):
+    def testPolicies(self):
+        output = buffers.OutputBuffer(buffers.OverflowPolicy.DROP, high_watermark=8, low_watermark=4, hard_limit=16)
+        self.assertTrue(output.put(b"12345678"))
+        self.assertTrue(output.put(b"9"))
+        self.assertEqual((len(output), output.queued_bytes, output.dropped_bytes), (8, 8, 1))
+        self.assertFalse(output.drops(b"9"))
+        self.assertTrue(output.put(b"9", droppable=False))
+        self.assertTrue(output.drops(b"9"))
+        self.assertFalse(output.put(b"12345678", droppable=False))
+        self.assertEqual((len(output), output.queued_bytes, output.dropped_bytes), (9, 9, 2))
+        output = buffers.OutputBuffer(buffers.OverflowPolicy.DISCONNECT, high_watermark=8, low_watermark=4,
+                                      hard_limit=16)
+        self.assertTrue(output.put(b"12345678"))
+        self.assertFalse(output.put(b"9"))
+        output = buffers.OutputBuffer(buffers.OverflowPolicy.PAUSE, high_watermark=8, low_watermark=4, hard_limit=16)
+        self.assertTrue(output.put(b"123456789"))
+        self.assertTrue(output.full)
+        self.assertFalse(output.put(b"12345678"))
+
+    def testSend(self):
+        output = buffers.OutputBuffer(buffers.OverflowPolicy.PAUSE, high_watermark=8, low_watermark=4, hard_limit=16)
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            output.put(b"123456789")
+            self.assertFalse(output.drained)
+            self.assertEqual(output.send_to(sender), 9)
+            self.assertTrue(output.drained)
+            self.assertEqual(receiver.recv(16), b"123456789")
+            self.assertEqual(output.sent_bytes, 9)
+
+
+if __name__ == "__main__":
+    unittest.main()
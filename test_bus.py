@@ -0,0 +1,56 @@
+import unittest
+
+import jim
+import bus
+
+
+class FakeBus:
+    def __init__(self):
+        self.frames = []
+
+    def send(self, frame: bytes):
+        self.frames.append(bus.parse_bus_frame(frame[jim.FRAME_HEADER.size:]))
+
+
+class TestBusFrame(unittest.TestCase):
+    def testParse(self):
+        for kind, account_name, message in ((bus.REGISTER, "alice", None),
+                                            (bus.DELIVER, "alice", b'{"action": "msg"}\n'),
+                                            (bus.BROADCAST, None, b'{"action": "msg"}')):
+            with self.subTest(kind=kind):
+                decoder = jim.FrameDecoder(jim.Framing.LENGTH)
+                decoder.feed(bus.bus_frame(kind, account_name, message))
+                self.assertEqual(bus.parse_bus_frame(decoder.next_frame()), (kind, account_name, message))
+
+
+class TestClusterRouter(unittest.TestCase):
+    def setUp(self) -> None:
+        self.bus = FakeBus()
+        self.router = bus.ClusterRouter(self.bus)
+        self.alice = object()
+
+    def testRegister(self):
+        self.assertEqual(self.router.register("alice", self.alice), jim.Responses.OK)
+        self.router.register("alicia", self.alice)
+        self.router.unregister(self.alice)
+        self.assertEqual(self.bus.frames, [(bus.REGISTER, "alice", None), (bus.UNREGISTER, "alice", None),
+                                           (bus.REGISTER, "alicia", None), (bus.UNREGISTER, "alicia", None)])
+
+    def testRemote(self):
+        self.router.bind_remote("bob", bus.RemoteAccount("bob", self.bus))
+        status, bob = self.router.lookup("bob")
+        self.assertEqual(status, jim.Responses.OK)
+        self.assertIsInstance(bob, bus.RemoteAccount)
+        self.assertEqual(self.router.register("bob", self.alice), jim.Responses.CONFLICT)
+        self.router.unbind_remote("bob")
+        self.assertEqual(self.router.lookup("bob"), (jim.Responses.GONE, None))
+
+    def testDropLocal(self):
+        self.router.register("alice", self.alice)
+        self.assertIs(self.router.drop_local("alice"), self.alice)
+        self.router.unregister(self.alice)          # Must not report the account registered by another worker
+        self.assertEqual(self.bus.frames, [(bus.REGISTER, "alice", None)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import asyncio
+import unittest
+
+import jim
+import client_asyncio
+
+
+class FakeServer:
+    """ Pushes a message from bob ahead of every response and PROBE after the first PRESENCE """
+    def __init__(self):
+        self.presences = 0
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        decoder = jim.FrameDecoder(jim.Framing.LINE)
+        while data := await reader.read(4096):
+            decoder.feed(data)
+            for frame in decoder:
+                message = jim.Message.from_bytes(frame)
+                if message.action == jim.Actions.PRESENCE:
+                    self.presences += 1
+                    writer.write(jim.encode_frame(jim.encode_response(jim.Responses.OK), decoder.framing))
+                    decoder.framing = jim.Framing(message.kwargs["framing"])
+                    if self.presences == 1:
+                        writer.write(jim.encode_frame(jim.Message(jim.Actions.PROBE).encoded, decoder.framing))
+                    continue
+                pushed = jim.Message(jim.Actions.MESSAGE, to="all", message=message.kwargs.get("message", "-"),
+                                     **{"from": "bob"})
+                writer.write(jim.encode_frame(pushed.encoded, decoder.framing))
+                response = jim.Responses.OK if message.action == jim.Actions.MESSAGE else jim.Responses.FORBIDDEN
+                writer.write(jim.encode_frame(jim.encode_response(response), decoder.framing))
+        writer.close()
+
+
+class TestAsyncClient(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.fake = FakeServer()
+        self.server = await asyncio.start_server(self.fake.handle, "127.0.0.1", 0)
+        self.client = client_asyncio.AsyncClient("alice", "127.0.0.1", self.server.sockets[0].getsockname()[1])
+
+    async def asyncTearDown(self) -> None:
+        await self.client.close(quit_message=False)
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def testPipelining(self):
+        self.assertEqual((await self.client.connect()).response, jim.Responses.OK)
+        responses = await asyncio.gather(self.client.send_message("bob", "1"), self.client.stats(),
+                                         self.client.send_message("bob", "3"))
+        self.assertEqual([response.response for response in responses],
+                         [jim.Responses.OK, jim.Responses.FORBIDDEN, jim.Responses.OK])
+        texts = []
+        async for message in self.client:
+            texts.append(message.kwargs["message"])
+            if len(texts) == 3:
+                break
+        self.assertEqual(texts, ["1", "-", "3"])
+        for _ in range(100):
+            if self.fake.presences == 2:                     # PROBE answered with PRESENCE
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(self.fake.presences, 2)
+
+
+class TestRejectedPresence(unittest.IsolatedAsyncioTestCase):
+    @staticmethod
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """ Rejects PRESENCE, so the framing and the compression stay as they are, and answers the rest """
+        while line := await reader.readline():
+            message = jim.Message.from_bytes(line)
+            response = jim.Responses.BAD_REQUEST if message.action == jim.Actions.PRESENCE else jim.Responses.OK
+            writer.write(jim.encode_frame(jim.encode_response(response, request_id=message.kwargs["id"])))
+        writer.close()
+
+    async def testRejectedPresence(self):
+        server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        client = client_asyncio.AsyncClient("alice", "127.0.0.1", server.sockets[0].getsockname()[1],
+                                            compression="zlib")
+        try:
+            connecting = asyncio.create_task(client.connect())
+            while client.writer is None:
+                await asyncio.sleep(0)
+            responses = await asyncio.wait_for(asyncio.gather(connecting, client.send_message("bob", "1")), 5)
+            self.assertEqual([response.response for response in responses],
+                             [jim.Responses.BAD_REQUEST, jim.Responses.OK])
+        finally:
+            await client.close(quit_message=False)
+            server.close()
+            await server.wait_closed()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+
+import jim
+import federation
+
+
+class FakeConnection:
+    def __init__(self):
+        self.delivered = []
+
+    def deliver(self, message: bytes, shared: bool = False):
+        self.delivered.append(message)
+
+
+class TestFederation(unittest.TestCase):
+    def setUp(self) -> None:
+        self.alice = FakeConnection()
+        self.bob = FakeConnection()
+        self.federation = federation.Federation("n0", "", 0, [], {self.alice, self.bob})
+        self.federation.router.register("alice", self.alice)
+        self.message = jim.Message(jim.Actions.MESSAGE, to="alice", message="hi").encoded
+
+    def deliver(self, federation_: federation.Federation, account_name: str, message: bytes):
+        """ Relay the message from the federation to the one of the test as it would go over a link """
+        frame = federation_._relay_frame(account_name, message)
+        self.federation._deliver(jim.MessageView(jim.json_loads(frame)), frame)
+
+    def testRelayFrame(self):
+        relay = jim.Message.from_bytes(self.federation._relay_frame("alice", self.message))
+        self.assertEqual(relay.action, jim.Actions.RELAY)
+        self.assertEqual(relay.kwargs["node"], "n0")
+        self.assertEqual(relay.kwargs["payload"], jim.json_loads(self.message))
+
+    def testDeliver(self):
+        frame = self.federation._relay_frame("alice", self.message)
+        relay = jim.MessageView(jim.json_loads(frame))
+        self.federation._deliver(relay, frame)
+        self.federation._deliver(relay, frame)      # Duplicate relays are dropped
+        self.assertEqual(self.alice.delivered, [self.message])
+        self.assertEqual(self.bob.delivered, [])
+        self.deliver(self.federation, jim.BROADCAST_RECIPIENT, self.message)
+        self.assertEqual((len(self.alice.delivered), len(self.bob.delivered)), (2, 1))
+
+    def testForwardedAsReceived(self):
+        message = b'{ "action": "msg", "time": 1.50, "to": "alice", "from": "bob", "message": "\\u0068i" }'
+        self.deliver(federation.Federation("n1", "", 0, [], set()), "alice", message)
+        self.assertEqual(self.alice.delivered, [message])
+
+    def testInvalidPayload(self):
+        sender = federation.Federation("n1", "", 0, [], set())
+        with self.assertLogs(federation.log, "ERROR"):
+            self.deliver(sender, "alice", jim.Message(jim.Actions.QUIT).encoded)
+            self.deliver(sender, "alice", b'{"action": "msg", "to": "alice", "message": 1}')
+            frame = sender._relay_frame("alice", self.message)
+            frame = frame[:-1] + b',"time":1}'      # The payload isn't the last field
+            self.federation._deliver(jim.MessageView(jim.json_loads(frame)), frame)
+        self.assertEqual(self.alice.delivered, [])
+
+    def testRestartedNode(self):
+        frame = self.federation._relay_frame("alice", self.message)
+        restarted = federation.Federation("n0", "", 0, [], set())
+        restarted._relay_epoch = "{:x}".format(int(self.federation._relay_epoch, 16) + 1)
+        frame_again = restarted._relay_frame("alice", self.message)
+        relay, relay_again = jim.MessageView(jim.json_loads(frame)), jim.MessageView(jim.json_loads(frame_again))
+        self.assertNotEqual(relay.fields["id"], relay_again.fields["id"])
+        self.federation._deliver(relay, frame)
+        self.federation._deliver(relay_again, frame_again)     # The counter starts over, the relay is new nonetheless
+        self.assertEqual(len(self.alice.delivered), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
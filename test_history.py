@@ -0,0 +1,63 @@
+import os
+import tempfile
+import unittest
+
+import jim
+import history
+import settings as sett
+
+
+def message(to: str, text: str) -> bytes:
+    return jim.Message(jim.Actions.MESSAGE, to=to, message=text).encoded
+
+
+class TestHistoryStore(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = history.HistoryStore(os.path.join(self.directory.name, "history.sqlite3"))
+        self.store.open()
+        self.responses = []
+
+    def tearDown(self) -> None:
+        self.store._db.close()
+        self.directory.cleanup()
+
+    def query(self, account_name: str, **request) -> jim.Response:
+        self.store._process([(account_name, request, self.responses.append)])
+        return jim.Response.from_bytes(self.responses.pop())
+
+    def testPages(self):
+        records = [("alice", message("bob", "a->b %d" % number), number) for number in range(5)]
+        records += [("bob", message("alice", "b->a"), 10), ("alice", message("carol", "a->c"), 11),
+                    ("carol", message(jim.BROADCAST_RECIPIENT, "all"), 12)]
+        self.store._process(records)
+        response = self.query("bob", peer="alice", limit=4)
+        self.assertEqual([item["message"] for item in response.kwargs["messages"]], ["a->b 0", "a->b 1", "a->b 2",
+                                                                                     "a->b 3"])
+        response = self.query("bob", peer="alice", limit=4, cursor=response.kwargs["cursor"])
+        self.assertEqual([item["message"] for item in response.kwargs["messages"]], ["a->b 4", "b->a"])
+        self.assertNotIn("cursor", response.kwargs)
+        response = self.query("alice", peer="bob", since=3, until=10)
+        self.assertEqual([item["time"] for item in response.kwargs["messages"]], [3, 4])
+        response = self.query("bob", peer=jim.BROADCAST_RECIPIENT)
+        self.assertEqual(response.kwargs["messages"], [{"time": 12, "from": "carol", "to": "all", "message": "all"}])
+
+    def testEscapedPageSize(self):
+        text = '"' * 500                                # Twice as long in JSON
+        self.store._process([("carol", message(jim.BROADCAST_RECIPIENT, text), number) for number in range(100)])
+        request = {"peer": jim.BROADCAST_RECIPIENT}
+        count = 0
+        while request.get("cursor", "") is not None:
+            self.store._process([("bob", request, self.responses.append)])
+            self.assertLess(len(self.responses[-1]), sett.MAX_FRAME_LEN)
+            response = jim.Response.from_bytes(self.responses.pop())
+            count += len(response.kwargs["messages"])
+            request["cursor"] = response.kwargs.get("cursor")
+        self.assertEqual(count, 100)
+
+    def testBadCursor(self):
+        self.assertEqual(self.query("bob", peer="alice", cursor="x").response, jim.Responses.BAD_REQUEST)
+
+
+if __name__ == "__main__":
+    unittest.main()
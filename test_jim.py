@@ -1,5 +1,6 @@
 import unittest
 
+import settings as sett
 import jim
 
 
@@ -26,6 +27,35 @@ class TestMessage(unittest.TestCase):
             raised = True
         self.assertFalse(raised, msg="Good Message init string raised an exception")
 
+    def testNotObject(self):
+        for message_bytes in (b'[1, 2]', b'{"time": 1}', b'\xff'):
+            with self.assertRaises(ValueError):
+                jim.Message.from_bytes(message_bytes)
+
+    def testJsonBackends(self):
+        message = jim.Message(jim.Actions.MESSAGE, to="all", message="Привет\nвсем")
+        for backend in jim.JSON_BACKENDS:
+            try:
+                _, loads, dumps = jim.load_json_backend(backend)
+            except ImportError:
+                continue
+            with self.subTest(backend=backend):
+                encoded = dumps({"action": message.action.value, "time": message.time, **message.kwargs})
+                self.assertNotIn(b"\n", encoded)
+                self.assertEqual(loads(encoded), loads(message.json))
+                self.assertEqual(loads(jim.Message.from_bytes(encoded).encoded), loads(encoded))
+
+
+class TestMessageView(unittest.TestCase):
+    def testView(self):
+        view = jim.MessageView(jim.json_loads(b'{"action": "msg", "to": "bob", "message": "hi", "id": 3}'))
+        self.assertEqual((view.action, view.to, view.request_id), (jim.Actions.MESSAGE, "bob", 3))
+        self.assertEqual(view.message.kwargs["message"], "hi")
+        for fields in ({"action": "msg", "to": "bob"}, {"action": "nope"}, ["msg"]):
+            with self.subTest(fields=fields):
+                with self.assertRaises(jim.ValidationError):
+                    jim.MessageView(fields)
+
 
 class TestResponse(unittest.TestCase):
     def testBadString(self):
@@ -43,5 +73,228 @@ class TestResponse(unittest.TestCase):
         self.assertFalse(raised, msg="Good Response init string raised an exception")
 
 
+class TestValidation(unittest.TestCase):
+    def testLimits(self):
+        chat = jim.Chat()
+        cases = (
+            ({"action": "presence", "user": {"account_name": "x" * 26}}, "account_name"),
+            ({"action": "presence", "user": "test"}, "user"),
+            ({"action": "msg", "to": "all", "message": "x" * 501}, "message"),
+            ({"action": "msg", "to": 1, "message": "test"}, "to"),
+            ({"action": "msg", "message": "test"}, "to"),
+            ({"action": "x" * 16}, "action"),
+        )
+        for message, field in cases:
+            with self.subTest(message=message):
+                success, response, _ = chat.process_encoded_message(jim.json_dumps(message))
+                self.assertFalse(success)
+                response = jim.Response.from_bytes(response)
+                self.assertEqual(response.response, jim.Responses.BAD_REQUEST)
+                self.assertIn(field, response.kwargs["error"])
+
+    def testTooLong(self):
+        chat = jim.Chat()
+        message = jim.Message(jim.Actions.MESSAGE, to="all", message="test", padding=" " * 5000).encoded
+        success, response, _ = chat.process_encoded_message(message)
+        self.assertFalse(success)
+        self.assertIn(str(sett.MAX_MESSAGE_LEN), jim.Response.from_bytes(response).kwargs["error"])
+
+    def testTooDeep(self):
+        saved_loads = jim.json_loads
+        jim.json_loads = jim.load_json_backend("json")[1]
+        try:
+            success, response, _ = jim.Chat().process_encoded_message(b"[" * sett.MAX_MESSAGE_LEN)
+        finally:
+            jim.json_loads = saved_loads
+        self.assertFalse(success)
+        self.assertEqual(jim.Response.from_bytes(response).response, jim.Responses.BAD_REQUEST)
+
+
+class TestResponseTemplates(unittest.TestCase):
+    def testSameAsResponse(self):
+        for code in jim.Responses:
+            self.assertEqual(jim.encode_response(code, 1653128454136720000).decode(),
+                             jim.Response(**code.response, time=1653128454136720000).json)
+
+    def testRequestId(self):
+        for request_id in ("req-1", 42):
+            with self.subTest(request_id=request_id):
+                self.assertEqual(jim.encode_response(jim.Responses.OK, 1653128454136720000, request_id=request_id),
+                                 jim.Response(time=1653128454136720000, id=request_id,
+                                              **jim.Responses.OK.response).json.encode())
+
+
+class TestBinaryWire(unittest.TestCase):
+    def testRoundTrip(self):
+        message = jim.Message(jim.Actions.PRESENCE, time=1653128454136720000, type="status", id=7, wire="binary",
+                              user={"account_name": "C0deMaver1ck", "status": "Тут"}, extra=[1, 2.5, None, True])
+        self.assertEqual(jim.Message.from_binary(message.binary).kwargs, message.kwargs)
+        self.assertLess(len(message.binary), len(message.encoded))
+        response = jim.Response(jim.Responses.NOT_FOUND, time=1653128454136720000, id="x", error="Нет")
+        self.assertEqual(jim.Response.from_binary(response.binary).kwargs, response.kwargs)
+        self.assertEqual(jim.binary_loads(jim.encode_binary_response(jim.Responses.OK, 1653128454136720000,
+                                                                      request_id=3)),
+                         jim.binary_loads(jim.Response(time=1653128454136720000, id=3,
+                                                       **jim.Responses.OK.response).binary))
+
+    def testCorrupt(self):
+        payload = jim.Message(jim.Actions.MESSAGE, to="all", message="test").binary
+        for corrupt in (b"", payload[:-1], payload + b"\x00", b"\x01\xff" + payload[2:], b"\x03" + payload[1:]):
+            with self.subTest(corrupt=corrupt):
+                with self.assertRaises(ValueError):
+                    jim.binary_loads(corrupt)
+
+
+class TestBinaryDepth(unittest.TestCase):
+    def testTooDeep(self):
+        nested = []
+        for _ in range(jim.BINARY_MAX_DEPTH * 3):
+            nested = [nested]
+        payload = jim.Message(jim.Actions.MESSAGE, to="all", message="test", extra=nested).encoded
+        with self.assertRaises(ValueError):
+            jim.json_to_binary(payload)
+        chat = jim.Chat()
+        list(chat.process_data(jim.Message(jim.Actions.PRESENCE, framing="length", wire="binary").encoded + b"\n"))
+        with self.assertRaises(ValueError):
+            chat.frame(payload)
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self) -> None:
+        self.sender = jim.StreamCompressor(threshold=64)
+        self.receiver = jim.StreamCompressor()
+        self.payload = jim.Message(jim.Actions.MESSAGE, to="all", message="Привет! " * 20, **{"from": "alice"}).encoded
+
+    def testRoundTrip(self):
+        first, second = self.sender.compress(self.payload), self.sender.compress(self.payload)
+        self.assertLess(len(second), len(first))                # The stream remembers the first one
+        self.assertEqual([self.receiver.decompress(first), self.receiver.decompress(second)], [self.payload] * 2)
+        short = jim.encode_response(jim.Responses.OK)
+        self.assertEqual(self.sender.compress(short), jim.COMPRESSED_RAW + short)
+        self.assertEqual(self.receiver.decompress(self.sender.compress(short)), short)
+
+    def testShared(self):
+        shared = self.sender.compress(self.payload, shared=True)
+        self.assertIs(jim.StreamCompressor().compress(self.payload, shared=True), shared)
+        self.assertEqual(self.receiver.decompress(shared), self.payload)
+        self.assertIsNone(self.sender.deflater)                 # The stream is left alone
+
+    def testCorrupt(self):
+        too_long = jim.compress_shared(b" " * (sett.MAX_FRAME_LEN + 1))
+        for corrupt in (b"\x01garbage", b"\x03" + self.payload, too_long, too_long[:10]):
+            with self.subTest(corrupt=corrupt[:10]):
+                with self.assertRaises(jim.FrameError):
+                    jim.StreamCompressor().decompress(corrupt)
+
+
+class TestFrameDecoder(unittest.TestCase):
+    def testCoalescedFrames(self):
+        decoder = jim.FrameDecoder(jim.Framing.LINE)
+        decoder.feed(b'{"a": 1}\n{"b": 2}\n{"c"')
+        self.assertEqual(list(decoder), [b'{"a": 1}', b'{"b": 2}'])
+        self.assertEqual(decoder.pending, 4)
+        decoder.feed(b': 3}\n')
+        self.assertEqual(list(decoder), [b'{"c": 3}'])
+        self.assertEqual(decoder.pending, 0)
+
+    def testLengthFrames(self):
+        decoder = jim.FrameDecoder(jim.Framing.LENGTH)
+        data = jim.encode_frame(b"first", jim.Framing.LENGTH) + jim.encode_frame(b"second", jim.Framing.LENGTH)
+        for i in range(len(data)):              # feed the stream byte by byte
+            decoder.feed(data[i:i + 1])
+            if i == 8:
+                self.assertTrue(decoder.has_frame)
+                self.assertEqual(decoder.next_frame(), b"first")
+        self.assertEqual(list(decoder), [b"second"])
+
+    def testFramingSwitch(self):
+        decoder = jim.FrameDecoder(jim.Framing.LINE)
+        decoder.feed(b"presence\n" + jim.encode_frame(b"msg\n", jim.Framing.LENGTH))
+        self.assertEqual(decoder.next_frame(), b"presence")
+        decoder.framing = jim.Framing.LENGTH
+        self.assertEqual(decoder.next_frame(), b"msg\n")
+
+    def testTooLongFrame(self):
+        decoder = jim.FrameDecoder(jim.Framing.LINE, max_frame_len=8)
+        decoder.feed(b"123456789")
+        with self.assertRaises(jim.FrameError):
+            decoder.next_frame()
+        decoder = jim.FrameDecoder(jim.Framing.LENGTH, max_frame_len=8)
+        decoder.feed(jim.encode_frame(b"123456789", jim.Framing.LENGTH))
+        with self.assertRaises(jim.FrameError):
+            decoder.next_frame()
+
+
+class TestChat(unittest.TestCase):
+    def testFramingNegotiation(self):
+        chat = jim.Chat()
+        presence = jim.Message(jim.Actions.PRESENCE, framing=jim.Framing.LENGTH).json.encode()
+        message = jim.Message(jim.Actions.MESSAGE, to="all", message="test").json.encode()
+        data = jim.encode_frame(presence, jim.Framing.LINE) + jim.encode_frame(message, jim.Framing.LENGTH)
+        results = []
+        for success, response, forward_list, message_bytes in chat.process_data(data):
+            results.append((success, forward_list, message_bytes))
+            self.assertEqual(jim.Response.from_str(response.decode()).response, jim.Responses.OK)
+        self.assertEqual(results, [(True, None, presence), (True, ["all"], message)])
+        self.assertEqual(chat.frame(b"x"), jim.encode_frame(b"x", jim.Framing.LENGTH))
+
+    def testApplyNegotiation(self):
+        chat = jim.Chat()
+        presence = jim.Message(jim.Actions.PRESENCE, framing="length", compression="zlib").encoded
+        results = chat.process_data(presence + jim.FRAME_DELIMITER)
+        next(results)
+        self.assertEqual(chat.frame(b"x"), jim.encode_frame(b"x", jim.Framing.LINE))
+        chat.apply_negotiation()                                # Before the generator gets to it
+        self.assertEqual(chat.frame(b"x"), jim.encode_frame(jim.COMPRESSED_RAW + b"x", jim.Framing.LENGTH))
+        list(results)
+        self.assertEqual(chat.frame(b"x"), jim.encode_frame(jim.COMPRESSED_RAW + b"x", jim.Framing.LENGTH))
+
+    def testBinaryWire(self):
+        chat = jim.Chat()
+        presence = jim.Message(jim.Actions.PRESENCE, framing="length", wire="binary").encoded
+        message = jim.Message(jim.Actions.MESSAGE, to="all", message="test", id=1)
+        data = jim.encode_frame(presence, jim.Framing.LINE) + jim.encode_frame(message.binary, jim.Framing.LENGTH)
+        results = list(chat.process_data(data))
+        self.assertEqual(jim.Response.from_bytes(results[0][1]).response, jim.Responses.OK)
+        self.assertEqual(jim.Response.from_binary(results[1][1]).kwargs["id"], 1)
+        self.assertEqual(jim.json_loads(results[1][3]), jim.json_loads(message.encoded))   # Forwarded as JSON
+        frame = chat.frame(message.encoded)
+        self.assertEqual(jim.binary_loads(frame[jim.FRAME_HEADER.size:]), jim.json_loads(message.encoded))
+
+    def testBinaryWireNeedsLength(self):
+        chat = jim.Chat()
+        presence = jim.Message(jim.Actions.PRESENCE, wire="binary").encoded
+        (success, response, _, _), = chat.process_data(presence + jim.FRAME_DELIMITER)
+        self.assertFalse(success)
+        self.assertEqual(chat.wire, jim.Wire.JSON)
+
+    def testCompression(self):
+        chat = jim.Chat()
+        client = jim.StreamCompressor(threshold=0)
+        presence = jim.Message(jim.Actions.PRESENCE, framing="length", compression="zlib").encoded
+        message = jim.Message(jim.Actions.MESSAGE, to="all", message="test", id=1).encoded
+        data = jim.encode_frame(presence, jim.Framing.LINE) + jim.encode_frame(client.compress(message),
+                                                                               jim.Framing.LENGTH)
+        results = list(chat.process_data(data))
+        self.assertEqual(results[1][3], message)
+        frame = chat.frame(b"x" * sett.COMPRESSION_THRESHOLD)
+        self.assertEqual(client.decompress(frame[jim.FRAME_HEADER.size:]), b"x" * sett.COMPRESSION_THRESHOLD)
+        self.assertLess(len(frame), sett.COMPRESSION_THRESHOLD)
+        (success, _, _, _), = chat.process_data(jim.encode_frame(client.compress(b"{"), jim.Framing.LENGTH))
+        self.assertFalse(success)                               # Decompressed, then rejected as bad JSON
+
+    def testNullLoggerShared(self):
+        handlers = len(jim.Chat().log.handlers)
+        jim.Chat()
+        self.assertEqual(len(jim.Chat().log.handlers), handlers)   # Not one more handler per connection
+
+    def testRequestIdEchoed(self):
+        chat = jim.Chat()
+        data = b'{"action": "quit", "id": 1}\n{"action": "msg", "id": "two"}\n{"action": "quit"}\n'
+        responses = [jim.Response.from_bytes(response) for _, response, _, _ in chat.process_data(data)]
+        self.assertEqual([(response.response, response.kwargs.get("id")) for response in responses],
+                         [(jim.Responses.OK, 1), (jim.Responses.BAD_REQUEST, "two"), (jim.Responses.OK, None)])
+
+
 if __name__ == "__main__":
     unittest.main()
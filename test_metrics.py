@@ -0,0 +1,51 @@
+import os
+import tempfile
+import unittest
+
+import settings as sett
+import jim
+import metrics
+
+
+class TestHistogram(unittest.TestCase):
+    def testPercentiles(self):
+        histogram = metrics.Histogram((10, 100, 1000))
+        self.assertIsNone(histogram.percentile(0.5))
+        for value in (5, 5, 50, 500, 5000):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1, 1])
+        self.assertEqual(histogram.snapshot(), {"count": 5, "mean": 1112, "p50": 100, "p95": 1000, "p99": 1000})
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self) -> None:
+        self.metrics = metrics.Metrics()
+        self.metrics.gauge("connections", lambda: 3)
+        chat = jim.Chat()
+        for _, _, _, _ in chat.process_data(b'{"action": "quit"}\n{"action": "bad"}\n'):
+            self.metrics.count_message(chat, chat.action is not None)
+
+    def testSnapshot(self):
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot["counters"], {"messages_quit": 1, "bad_requests": 1})
+        self.assertEqual(snapshot["gauges"], {"connections": 3})
+
+    def testStatsResponse(self):
+        admin = sett.SERVER_ADMIN_ACCOUNTS[0]
+        self.assertEqual(jim.Response.from_bytes(self.metrics.stats_response("alice", ("127.0.0.1", 1))).response,
+                         jim.Responses.FORBIDDEN)
+        self.assertEqual(jim.Response.from_bytes(self.metrics.stats_response(admin, ("192.0.2.1", 1))).response,
+                         jim.Responses.FORBIDDEN)
+        response = jim.Response.from_bytes(self.metrics.stats_response(admin, ("127.0.0.1", 1)))
+        self.assertEqual(response.kwargs["stats"]["counters"]["messages_quit"], 1)
+
+    def testSnapshotWriter(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "metrics.json")
+            metrics.SnapshotWriter(self.metrics, path).write()
+            with open(path, "rb") as snapshot_file:
+                self.assertEqual(jim.json_loads(snapshot_file.read())["gauges"], {"connections": 3})
+
+
+if __name__ == "__main__":
+    unittest.main()
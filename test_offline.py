@@ -0,0 +1,72 @@
+import os
+import time
+import tempfile
+import unittest
+
+import offline
+
+
+class TestOfflineStore(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = offline.OfflineStore(self.directory.name, segment_size=100)
+        self.drained = []
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def testDrain(self):
+        messages = [b'{"action": "msg", "message": "%d"}' % number for number in range(10)]
+        self.store._process([("alice", message, time.time_ns()) for message in messages])
+        self.assertGreater(len(self.store.index["alice"]), 1)           # Segments rotated
+        # The index is rebuilt from the files
+        self.assertEqual(offline.OfflineStore(self.directory.name).accounts(), ["alice"])
+        self.store._process([("alice", None, (self.drained.extend, False)),
+                             ("bob", None, (self.drained.extend, False))])
+        self.assertEqual(self.drained, messages)
+        self.store._process([("alice", None, (self.drained.extend, True))])      # Acknowledged, nothing left
+        self.assertEqual(self.drained, messages)
+        self.assertEqual(self.store.accounts(), [])
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def testChunks(self):
+        messages = [b'{"action": "msg", "message": "%d"}' % number for number in range(10)]
+        self.store._process([("alice", message, time.time_ns()) for message in messages])
+        self.store.drain_bytes = len(messages[0]) * 3
+        chunks = []
+        self.store._process([("alice", None, (chunks.append, False))])
+        self.store._process([("alice", None, (chunks.append, False))])          # Not acknowledged - taken again
+        self.assertEqual(chunks, [messages[:3], messages[:3]])
+        for _ in range(3):
+            self.store._process([("alice", None, (chunks.append, True))])
+        self.assertEqual(chunks[2:], [messages[3:6], messages[6:9], messages[9:]])
+        self.assertEqual(offline.OfflineStore(self.directory.name).accounts(), ["alice"])  # Until acknowledged
+        self.store._process([("alice", None, (chunks.append, True))])
+        self.assertEqual(self.store.accounts(), [])
+
+    def testLimits(self):
+        self.store._process([("alice", b"old", time.time_ns() - int(self.store.ttl * 2e9)),
+                             ("alice", b"x" * 100, time.time_ns()), ("alice", b"new", time.time_ns())])
+        self.store.max_account_bytes = 150
+        self.store._process([("alice", b"y" * 100, time.time_ns())])     # The oldest segment is dropped
+        self.store._process([("alice", None, (self.drained.extend, False))])
+        self.assertEqual(self.drained, [b"new", b"y" * 100])
+
+    def testEmptySegments(self):
+        account_directory = self.store._account_directory("alice")
+        os.makedirs(account_directory)
+        open(self.store._segment_path("alice", 0), "wb").close()
+        store = offline.OfflineStore(self.directory.name)
+        self.assertEqual(store.accounts(), [])
+        self.assertEqual(os.listdir(account_directory), [])
+        os.mkdir(self.store._segment_path("alice", 1))                    # The segment can't be opened
+        with self.assertRaises(OSError):
+            self.store._process([("alice", b"x" * 100, time.time_ns()), ("alice", b"y" * 100, time.time_ns())])
+        self.assertEqual([segment.sequence for segment in self.store.index["alice"]], [0])
+        self.store._expire()
+        self.store._process([("alice", None, (self.drained.extend, False))])
+        self.assertEqual(self.drained, [b"x" * 100])
+
+
+if __name__ == "__main__":
+    unittest.main()
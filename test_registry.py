@@ -0,0 +1,44 @@
+import unittest
+
+import registry
+
+
+class FakeConnection:
+    def __init__(self, address: (str, int)):
+        self.connection = object()
+        self.address = address
+
+
+class TestConnectionRegistry(unittest.TestCase):
+    def setUp(self) -> None:
+        self.registry = registry.ConnectionRegistry()
+        self.alice = FakeConnection(("127.0.0.1", 1))
+        self.bob = FakeConnection(("127.0.0.1", 2))
+
+    def testLookup(self):
+        self.assertTrue(self.registry.add(self.alice))
+        self.registry.router.register("alice", self.alice)
+        self.assertIs(self.registry.by_socket(self.alice.connection), self.alice)
+        self.assertIs(self.registry.by_address(("127.0.0.1", 1)), self.alice)
+        self.assertIs(self.registry.by_account("alice"), self.alice)
+        self.assertIsNone(self.registry.by_address(("127.0.0.1", 2)))
+
+    def testLimit(self):
+        self.assertTrue(self.registry.add(self.alice, limit=1))
+        self.assertFalse(self.registry.add(self.alice))
+        self.assertFalse(self.registry.add(self.bob, limit=1))
+        self.assertEqual(len(self.registry), 1)
+
+    def testSnapshot(self):
+        self.registry.add(self.alice)
+        self.registry.add(self.bob)
+        snapshot = self.registry.connections
+        self.assertTrue(self.registry.remove(self.alice))
+        self.assertFalse(self.registry.remove(self.alice))
+        self.assertEqual(snapshot, (self.alice, self.bob))      # Published snapshots are never changed
+        self.assertEqual(tuple(self.registry), (self.bob,))
+        self.assertIsNone(self.registry.by_socket(self.alice.connection))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+import unittest
+
+import jim
+import routing
+
+
+class TestRouter(unittest.TestCase):
+    def setUp(self) -> None:
+        self.router = routing.Router()
+        self.alice = object()
+        self.bob = object()
+
+    def testLookup(self):
+        self.assertEqual(self.router.register("alice", self.alice), jim.Responses.OK)
+        self.assertEqual(self.router.lookup("alice"), (jim.Responses.OK, self.alice))
+        self.assertEqual(self.router.lookup("bob"), (jim.Responses.NOT_FOUND, None))
+        self.router.unregister(self.alice)
+        self.assertEqual(self.router.lookup("alice"), (jim.Responses.GONE, None))
+
+    def testConflict(self):
+        self.router.register("alice", self.alice)
+        self.assertEqual(self.router.register("alice", self.bob), jim.Responses.CONFLICT)
+        self.router.unregister(self.bob)            # Must not unbind somebody else's account
+        self.assertEqual(self.router.lookup("alice"), (jim.Responses.OK, self.alice))
+
+    def testRename(self):
+        self.router.register("alice", self.alice)
+        self.router.register("alicia", self.alice)
+        self.assertEqual(self.router.lookup("alice"), (jim.Responses.GONE, None))
+        self.assertEqual(self.router.account_name(self.alice), "alicia")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,178 @@
+import os
+import socket
+import asyncio
+import tempfile
+import unittest
+
+import jim
+import buffers
+import settings as sett
+import loadtest
+import server_select
+import client_asyncio
+
+
+class TestSlowConsumer(unittest.TestCase):
+    def testDropCompressed(self):
+        output = buffers.OutputBuffer(buffers.OverflowPolicy.DROP, high_watermark=128, low_watermark=0,
+                                      hard_limit=4096)
+        connection = server_select.Connection(jim.Chat(), None, ("127.0.0.1", 0), output=output)
+        presence = jim.Message(jim.Actions.PRESENCE, framing="length", compression="zlib",
+                               user={"account_name": "bob", "status": "Online"}).encoded
+        for _ in connection.chat.process_data(presence + b"\n"):
+            pass
+        messages = [jim.Message(jim.Actions.MESSAGE, to="bob", message="Сообщение {} ".format(number) * 10,
+                                **{"from": "alice"}).encoded for number in range(20)]
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            for burst in (messages[:10], messages[10:]):    # The client reads nothing in between
+                for message in burst:
+                    self.assertTrue(connection.put(connection.frame(message)))
+                output.send_to(sender)
+            self.assertGreater(output.dropped_bytes, 0)
+            decoder = jim.FrameDecoder(jim.Framing.LENGTH)
+            decoder.feed(receiver.recv(65536))
+        decompressor = jim.StreamCompressor()
+        received = [decompressor.decompress(frame) for frame in decoder]
+        self.assertIn(messages[10], received)       # The stream is intact after the frames dropped
+        self.assertEqual(received, [message for message in messages if message in received])
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+class EngineTest:
+    """
+    Loopback test of a server engine, run as a separate process as it is run in production,
+    in a directory of its own so that no history or stored messages are left from the other runs
+    """
+    script = None
+    arguments = ()
+    offline = True                      # The engine stores the messages for the offline accounts
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.port = free_port()
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.server = loadtest.start_server(os.path.join(os.path.dirname(os.path.abspath(__file__)), cls.script),
+                                           cls.port, *cls.arguments, cwd=cls.directory.name)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.server.terminate()
+        cls.server.wait()
+        cls.directory.cleanup()
+
+    async def receive(self, client: client_asyncio.AsyncClient, count: int) -> list:
+        """ :return: texts of the next count messages pushed to the client """
+        texts = []
+        async for message in client:
+            texts.append(message.kwargs["message"])
+            if len(texts) == count:
+                break
+        return texts
+
+    async def chat(self):
+        alice = client_asyncio.AsyncClient("alice", "127.0.0.1", self.port)
+        bob = client_asyncio.AsyncClient("bob", "127.0.0.1", self.port)
+        carol = client_asyncio.AsyncClient("carol", "127.0.0.1", self.port, wire="binary", compression="zlib")
+        clients = (alice, bob, carol)
+        try:
+            for client in clients:
+                self.assertEqual((await client.connect()).response, jim.Responses.OK)
+            long_text = "Длинное сообщение " * 20          # Compressed for carol
+            self.assertEqual((await alice.send_message("carol", long_text)).response, jim.Responses.OK)
+            self.assertEqual((await carol.send_message("bob", "carol->bob")).response, jim.Responses.OK)
+            self.assertEqual((await carol.send_message("all", "carol->all")).response, jim.Responses.OK)
+            nested = []
+            for _ in range(jim.BINARY_MAX_DEPTH * 3):
+                nested = [nested]
+            deep = jim.Message(jim.Actions.MESSAGE, to="all", message="deep", extra=nested, **{"from": "alice"})
+            self.assertEqual((await alice.request(deep)).response, jim.Responses.OK)
+            self.assertEqual((await alice.send_message("all", "alice->all")).response, jim.Responses.OK)
+            self.assertEqual(await self.receive(alice, 1), ["carol->all"])
+            self.assertCountEqual(await self.receive(bob, 4), ["carol->bob", "carol->all", "deep", "alice->all"])
+            # Too deep for the binary wire format, the broadcast skips carol only
+            self.assertCountEqual(await self.receive(carol, 2), [long_text, "alice->all"])
+        finally:
+            for client in clients:
+                await client.close()
+
+    async def testChat(self):
+        await asyncio.wait_for(self.chat(), 10)
+
+    async def reply_order(self):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        try:
+            writer.write(jim.Message(jim.Actions.PRESENCE, framing="length", compression="zlib",
+                                     user={"account_name": "eve", "status": "Online"}).encoded + jim.FRAME_DELIMITER)
+            decoder = jim.FrameDecoder(jim.Framing.LINE)
+            decoder.feed(await reader.readuntil(jim.FRAME_DELIMITER))
+            self.assertEqual(jim.Response.from_bytes(decoder.next_frame()).response, jim.Responses.OK)
+            decoder.framing = jim.Framing.LENGTH
+            # Both the reply to the bad message and the message to the sender itself are compressed in one read
+            bad = jim.Message(jim.Actions.MESSAGE, message="no recipient").encoded
+            own = jim.Message(jim.Actions.MESSAGE, to="eve", message="Сообщение " * 50, **{"from": "eve"}).encoded
+            writer.write(b"".join(jim.encode_frame(jim.COMPRESSED_RAW + payload, jim.Framing.LENGTH)
+                                  for payload in (bad, own)))
+            decompressor = jim.StreamCompressor()
+            received = []
+            while len(received) < 3:
+                decoder.feed(await reader.read(sett.MAX_DATA_LEN))
+                received.extend(jim.json_loads(decompressor.decompress(frame)) for frame in decoder)
+            self.assertCountEqual([item.get("response", item.get("action")) for item in received],
+                                  [jim.Responses.BAD_REQUEST.value, jim.Responses.OK.value, jim.Actions.MESSAGE.value])
+        finally:
+            writer.close()
+
+    async def testReplyOrder(self):
+        await asyncio.wait_for(self.reply_order(), 10)
+
+    async def backlog(self):
+        alice = client_asyncio.AsyncClient("alice", "127.0.0.1", self.port)
+        dave = client_asyncio.AsyncClient("dave", "127.0.0.1", self.port)
+        try:
+            await dave.connect()
+            await dave.close()
+            await alice.connect()
+            text = "Сообщение " * 50
+            count = sett.SERVER_OUTPUT_HARD_LIMIT * 3 // 2 // len(text.encode()) + 1
+            responses = await asyncio.gather(*(alice.send_message("dave", text) for _ in range(count)))
+            self.assertEqual({response.response for response in responses}, {jim.Responses.ACCEPTED})
+            dave = client_asyncio.AsyncClient("dave", "127.0.0.1", self.port)
+            await dave.connect()
+            self.assertEqual(len(await self.receive(dave, count)), count)
+        finally:
+            await alice.close()
+            await dave.close()
+
+    async def testOfflineBacklog(self):
+        if not self.offline:
+            self.skipTest("{} doesn't store the messages for the offline accounts".format(self.script))
+        await asyncio.wait_for(self.backlog(), 60)
+
+
+class TestSelectServer(EngineTest, unittest.IsolatedAsyncioTestCase):
+    script = "server_select.py"
+    offline = False
+
+
+class TestThreadsServer(EngineTest, unittest.IsolatedAsyncioTestCase):
+    script = "server_threads.py"
+    arguments = ("-mode", "connection")
+
+
+class TestThreadsPoolServer(EngineTest, unittest.IsolatedAsyncioTestCase):
+    script = "server_threads.py"
+    arguments = ("-mode", "pool")
+
+
+class TestAsyncioServer(EngineTest, unittest.IsolatedAsyncioTestCase):
+    script = "server_asyncio.py"
+
+
+if __name__ == "__main__":
+    unittest.main()
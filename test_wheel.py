@@ -0,0 +1,28 @@
+import unittest
+
+import wheel
+
+
+class TestTimingWheel(unittest.TestCase):
+    def setUp(self) -> None:
+        self.wheel = wheel.TimingWheel(1.0, 4, 100.0)
+
+    def testAdvance(self):
+        self.wheel.schedule("b", 102.5)
+        self.wheel.schedule("a", 101.0)
+        self.wheel.schedule("far", 109.0)           # Two turns of the ring ahead
+        self.assertEqual(self.wheel.advance(100.9), [])
+        self.assertEqual(self.wheel.advance(101.0), ["a"])
+        self.assertEqual(self.wheel.advance(103.0), ["b"])
+        self.assertEqual(self.wheel.advance(108.9), [])
+        self.assertEqual(len(self.wheel), 1)
+        self.assertEqual(self.wheel.advance(109.0), ["far"])
+
+    def testPastDeadline(self):
+        self.wheel.advance(105.0)
+        self.wheel.schedule("late", 101.0)          # Due at the next tick processed
+        self.assertEqual(self.wheel.advance(106.0), ["late"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import math
+
+"""
+Hashed timing wheel: keeps deadlines of any number of items in a ring of slots, one slot per tick,
+so that scheduling an item takes O(1) and every tick only looks at the items of its own slot.
+Deadlines are rounded up to ticks. An item due more than a full turn of the ring ahead
+waits in its slot for the turns to pass, so the ring is best made longer than the usual delay.
+The servers keep one deadline per connection this way: instead of rescheduling it on every message,
+a connection only records the time of its last activity and gets rescheduled once its deadline comes
+(see the idle checks of the servers).
+"""
+
+
+class TimingWheel:
+    """
+    ATTRIBUTES:
+    tick - slot duration, seconds
+    slots - ring of slots, every slot is a list of (tick number, item)
+    start - time of tick 0
+    current - number of the next tick to process
+    """
+    def __init__(self, tick: float, slots: int, now: float):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.start = now
+        self.current = 0
+
+    def __len__(self):
+        return sum(len(slot) for slot in self.slots)
+
+    def schedule(self, item, deadline: float):
+        """ Have advance() return the item once the deadline has passed """
+        number = max(math.ceil((deadline - self.start) / self.tick), self.current)
+        self.slots[number % len(self.slots)].append((number, item))
+
+    def advance(self, now: float) -> list:
+        """
+        Process the ticks passed by now
+        :return: items whose deadlines have passed, in the order of the deadlines
+        """
+        expired = []
+        last = math.floor((now - self.start) / self.tick)
+        while self.current <= last:
+            index = self.current % len(self.slots)
+            slot = self.slots[index]
+            if slot:
+                waiting = []
+                for number, item in slot:
+                    if number <= self.current:
+                        expired.append(item)
+                    else:
+                        waiting.append((number, item))       # Due on a later turn of the ring
+                self.slots[index] = waiting
+            self.current += 1
+        return expired